@@ -0,0 +1,167 @@
+import asyncio
+import itertools
+import os
+import time
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter
+from logger import logger
+
+log = logger.get_logger('admin_jobs')
+
+# Как часто (в секундах) обновлять статусное сообщение задачи: правки сообщений тоже расходуют лимиты Telegram
+ADMIN_JOB_PROGRESS_INTERVAL = float(os.getenv("ADMIN_JOB_PROGRESS_INTERVAL", "5"))
+# Сколько завершенных задач показывать в /jobs
+ADMIN_JOB_HISTORY = int(os.getenv("ADMIN_JOB_HISTORY", "20"))
+
+_STATUS_TITLES = {
+    "running": "⏳ выполняется",
+    "done": "✅ завершена",
+    "failed": "❌ завершилась с ошибкой",
+    "cancelled": "⛔ отменена",
+}
+
+# Задачи по ID: выполняющиеся и последние ADMIN_JOB_HISTORY завершенных
+_jobs = {}
+_job_ids = itertools.count(1)
+
+
+class AdminJob:
+    """
+    Долгая операция администратора (рассылка, восстановление тикетов), выполняемая в фоне,
+    а не в обработчике команды. Ход выполнения показывается в одном статусном сообщении,
+    которое редактируется не чаще раза в ADMIN_JOB_PROGRESS_INTERVAL секунд.
+    """
+
+    def __init__(self, job_id: int, title: str, bot, chat_id: int, message_thread_id: int | None = None):
+        self.id = job_id
+        self.title = title
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_thread_id = message_thread_id
+        self.status = "running"
+        self.done = 0
+        self.total = None
+        self.note = ""
+        self.error = None
+        self.started = time.monotonic()
+        self.finished = None
+        self.message = None
+        self.task = None
+        # Отмену запросил администратор; иначе CancelledError означает остановку бота
+        self.cancel_requested = False
+        self._shown = None
+
+    def report(self, done: int, total: int | None = None, note: str | None = None):
+        """Обновляет прогресс задачи; сообщение обновится при следующей плановой правке."""
+        self.done = done
+        if total is not None:
+            self.total = total
+        if note is not None:
+            self.note = note
+
+    def cancel(self):
+        """Отменяет задачу по запросу администратора."""
+        self.cancel_requested = True
+        self.task.cancel()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    def describe(self) -> str:
+        progress = f"{self.done} из {self.total}" if self.total else str(self.done)
+        if self.total:
+            progress += f" ({self.done * 100 // self.total}%)"
+        text = (
+            f"Задача #{self.id}: {self.title}\n"
+            f"{_STATUS_TITLES[self.status]}, обработано {progress}, прошло {self.elapsed:.0f} с"
+        )
+        if self.note:
+            text += f"\n{self.note}"
+        if self.error:
+            text += f"\nОшибка: {self.error}"
+        return text
+
+    def _markup(self) -> InlineKeyboardMarkup | None:
+        if self.status != "running":
+            return None
+        return InlineKeyboardMarkup([[InlineKeyboardButton("⛔ Отменить", callback_data=f"cancel_job_{self.id}")]])
+
+    async def _show(self):
+        """Редактирует статусное сообщение, если его текст изменился."""
+        text = self.describe()
+        if self.message is None or text == self._shown:
+            return
+        try:
+            await self.message.edit_text(text, reply_markup=self._markup())
+            self._shown = text
+        except RetryAfter as e:
+            # Пропускаем правку: следующая покажет актуальное состояние
+            log.info(f"Задача #{self.id}: правка статуса отложена Telegram на {e.retry_after} с")
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                log.warning(f"Задача #{self.id}: не удалось обновить статусное сообщение: {e}")
+        except Exception as e:
+            log.warning(f"Задача #{self.id}: не удалось обновить статусное сообщение: {e}")
+
+    async def _refresh(self):
+        while True:
+            await asyncio.sleep(ADMIN_JOB_PROGRESS_INTERVAL)
+            await self._show()
+
+    async def _run(self, func):
+        refresher = asyncio.create_task(self._refresh())
+        try:
+            await func(self)
+            self.status = "done"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+            log.info(f"Задача #{self.id} ({self.title}) отменена.")
+            if not self.cancel_requested:
+                # Бот останавливается: статусное сообщение не трогаем, отмену пропускаем дальше
+                raise
+        except Exception as e:
+            self.status = "failed"
+            self.error = e
+            log.error(f"Задача #{self.id} ({self.title}) завершилась с ошибкой: {e}", exc_info=True)
+        finally:
+            refresher.cancel()
+            self.finished = time.monotonic()
+            _forget_finished_jobs()
+        await self._show()
+
+
+def _forget_finished_jobs():
+    finished = [job.id for job in _jobs.values() if job.status != "running"]
+    for job_id in finished[:-ADMIN_JOB_HISTORY or None]:
+        del _jobs[job_id]
+
+
+async def start_job(bot, chat_id: int, title: str, func, message_thread_id: int | None = None) -> AdminJob:
+    """
+    Запускает func(job) в фоне как задачу администратора и отправляет в chat_id ее статусное сообщение.
+    func сообщает о ходе выполнения через job.report(); отмена задачи прерывает func через CancelledError.
+    """
+    job = AdminJob(next(_job_ids), title, bot, chat_id, message_thread_id)
+    job.message = await bot.send_message(
+        chat_id, job.describe(), message_thread_id=message_thread_id, reply_markup=job._markup()
+    )
+    job._shown = job.message.text
+    _jobs[job.id] = job
+    job.task = asyncio.create_task(job._run(func))
+    log.info(f"Запущена задача #{job.id}: {title}")
+    return job
+
+
+def get_jobs() -> list[AdminJob]:
+    """Выполняющиеся и последние завершенные задачи, новые первыми."""
+    return sorted(_jobs.values(), key=lambda job: job.id, reverse=True)
+
+
+def cancel_job(job_id: int) -> bool:
+    """Отменяет выполняющуюся задачу; False, если такой задачи нет или она уже завершена."""
+    job = _jobs.get(job_id)
+    if job is None or job.status != "running" or job.task is None:
+        return False
+    job.cancel()
+    return True
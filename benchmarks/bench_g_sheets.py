@@ -0,0 +1,178 @@
+"""
+Бенчмарк горячих путей g_sheets на локальной БД и таблице в памяти (benchmarks/fake_sheets.py).
+К Google API не обращается. Для каждого размера таблицы выводит ops/sec и задержки p50/p99.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_g_sheets.py
+    python benchmarks/bench_g_sheets.py --sizes 1000,10000 --ops 500 --latency-ms 50
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+import g_sheets  # noqa: E402
+from rate_limiter import TokenBucket  # noqa: E402
+from benchmarks.fake_sheets import FakeWorksheet, FakeSheetsAPI  # noqa: E402
+
+STATUSES = ["Зарегистрировано", "В работе", "Передано на L2", "Передано на L3", "Завершено"]
+PRIORITIES = ["Критичный", "Высокий", "Средний", "Низкий"]
+
+
+def _percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+
+def _report(name: str, size: int, latencies: list):
+    total = sum(latencies)
+    ops_per_sec = len(latencies) / total if total else float("inf")
+    print(
+        f"{size:>7} | {name:<36} | {len(latencies):>5} | {ops_per_sec:>10.1f} | "
+        f"{_percentile(latencies, 0.5) * 1000:>9.3f} | {_percentile(latencies, 0.99) * 1000:>9.3f}"
+    )
+
+
+async def _measure(call, times: int) -> list:
+    latencies = []
+    for _ in range(times):
+        started = time.perf_counter()
+        result = call()
+        if asyncio.iscoroutine(result):
+            await result
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def _make_ticket(number: int, now: datetime) -> dict:
+    created = now - timedelta(days=random.uniform(0, 365))
+    status = random.choices(STATUSES, weights=[5, 10, 3, 2, 80])[0]
+    priority = random.choice(PRIORITIES)
+    ticket = {
+        "number": number,
+        "status": status,
+        "priority": priority,
+        "user_id": random.randint(1, max(1, number // 3)),
+        "type": "Ошибка",
+        "fio": f"Пользователь {number}",
+        "username": f"user{number}",
+        "platform": "Площадка",
+        "message": "Текст обращения " * 20,
+        "created_at": created.strftime(g_sheets.TIME_FORMAT),
+        "sla_deadline": (created + timedelta(hours=g_sheets.SLA_HOURS[priority])).strftime(g_sheets.TIME_FORMAT),
+        "topic_id": 100000 + number,
+        "sheet_row": number + 1,
+    }
+    if status == "Завершено":
+        ticket["closed_at"] = (created + timedelta(hours=random.uniform(1, 72))).strftime(g_sheets.TIME_FORMAT)
+    return ticket
+
+
+async def _prepare(db_dir: str, size: int, latency: float, quota: int):
+    """Новая БД в каталоге db_dir и таблица с size тикетами; состояние модуля g_sheets сбрасывается."""
+    database.DB_PATH = os.path.join(db_dir, f"bench_{size}.db")
+    await database.initialize_db()
+    now = datetime.now()
+    tickets = [_make_ticket(number, now) for number in range(1, size + 1)]
+    await database.import_tickets(tickets)
+
+    column_map = g_sheets._build_column_map(g_sheets.HEADERS)
+    worksheet = FakeWorksheet.create(
+        g_sheets.HEADERS, [g_sheets._ticket_to_row(ticket, column_map) for ticket in tickets],
+        latency=latency, quota_per_minute=quota,
+    )
+    g_sheets._worksheet_cache = worksheet
+    g_sheets._sheets_api = FakeSheetsAPI(worksheet)
+    g_sheets._column_map = column_map
+    g_sheets._write_queue = g_sheets._SheetWriteQueue(g_sheets.SHEET_FLUSH_INTERVAL_MS, g_sheets.SHEET_FLUSH_MAX_CELLS)
+    g_sheets._last_queued_op_id = 0
+    g_sheets._tickets_cache.invalidate()
+    # БД уже заполнена теми же тикетами, что и таблица
+    g_sheets._tickets_imported = True
+    if not quota:
+        # Без квоты ограничитель не должен влиять на замеры
+        g_sheets._read_bucket = TokenBucket("bench_read", 1e9, 1e9)
+        g_sheets._write_bucket = TokenBucket("bench_write", 1e9, 1e9)
+    return worksheet, tickets
+
+
+async def run_size(db_dir: str, size: int, ops: int, latency: float, quota: int):
+    worksheet, tickets = await _prepare(db_dir, size, latency, quota)
+    open_numbers = [ticket["number"] for ticket in tickets if ticket["status"] != "Завершено"] or [1]
+
+    _report("build_ticket_index", size, await _measure(g_sheets.build_ticket_index, 3))
+    _report("build_sla_schedule", size, await _measure(g_sheets.build_sla_schedule, 3))
+
+    def invalidate_and_get():
+        g_sheets._tickets_cache.invalidate()
+        return g_sheets.get_all_tickets()
+    _report("get_all_tickets (cold)", size, await _measure(invalidate_and_get, 3))
+    _report("get_all_tickets (cached)", size, await _measure(g_sheets.get_all_tickets, ops))
+    _report("get_ticket_columns (dashboard)", size, await _measure(
+        lambda: database.get_ticket_columns(("number", "status", "type", "fio", "username", "ticket_url")), 5
+    ))
+
+    _report("add_feedback", size, await _measure(
+        lambda: g_sheets.add_feedback(random.randint(1, 1000), "Ошибка", "ФИО", "user", "Площадка", "Текст", ""), ops
+    ))
+    _report("record_action (taken)", size, await _measure(
+        lambda: g_sheets.record_action(random.choice(open_numbers), "taken", datetime.now()), ops
+    ))
+    _report("get_ticket_details_by_topic_id", size, await _measure(
+        lambda: g_sheets.get_ticket_details_by_topic_id(100000 + random.randint(1, size)), ops
+    ))
+    _report("get_due_sla_tickets", size, await _measure(g_sheets.get_due_sla_tickets, ops))
+
+    # Выгрузка накопленных изменений (добавления и обновления ячеек) в таблицу
+    pending = await database.count_sheet_ops()
+    started = time.perf_counter()
+    while await database.count_sheet_ops():
+        await g_sheets.sync_tickets_to_sheet()
+        await g_sheets._write_queue.flush()
+    elapsed = time.perf_counter() - started
+    print(f"{size:>7} | {'sync_tickets_to_sheet (' + str(pending) + ' ops)':<36} | {1:>5} | "
+          f"{pending / elapsed if elapsed else 0:>10.1f} | {elapsed * 1000:>9.3f} | {'':>9}")
+
+    _report("archive_closed_tickets", size, await _measure(g_sheets.archive_closed_tickets, 1))
+
+    # Первый запуск на пустой БД: импорт всей таблицы. В новой БД отметки tickets_imported нет,
+    # а отметку в памяти, выставленную в _prepare, сбрасываем, иначе замерялся бы пустой вызов
+    database.DB_PATH = os.path.join(db_dir, f"bench_{size}_import.db")
+    await database.initialize_db()
+    g_sheets._tickets_imported = False
+    _report("load_tickets_from_sheet (import)", size, await _measure(g_sheets.load_tickets_from_sheet, 1))
+    print(f"{size:>7} | запросов к таблице: {worksheet.spreadsheet.requests}, ошибок квоты: {worksheet.spreadsheet.quota_errors}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="размеры таблицы через запятую")
+    parser.add_argument("--ops", type=int, default=200, help="операций на замер")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка каждого запроса к таблице, мс")
+    parser.add_argument("--quota", type=int, default=0, help="квота запросов в минуту (0 — без ограничения)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    # Логи операций искажают замеры
+    logging.getLogger("bot").setLevel(logging.WARNING)
+
+    print(f"{'rows':>7} | {'operation':<36} | {'ops':>5} | {'ops/sec':>10} | {'p50, ms':>9} | {'p99, ms':>9}")
+    with tempfile.TemporaryDirectory() as db_dir:
+        try:
+            for size in (int(value) for value in args.sizes.split(",")):
+                await run_size(db_dir, size, args.ops, args.latency_ms / 1000, args.quota)
+        finally:
+            await database.close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,186 @@
+import asyncio
+import re
+import threading
+import time
+from collections import deque
+from urllib.parse import unquote
+
+import gspread
+
+from g_sheets import _AsyncSheetsClient, SheetsAPIError
+
+
+class FakeSpreadsheet:
+    """
+    Таблица в памяти. Хранит листы и общие для них настройки: задержку каждого запроса
+    (latency, секунды) и квоту запросов в минуту (quota_per_minute, 0 — без ограничения),
+    сверх которой запросы получают 429.
+    """
+
+    def __init__(self, latency: float = 0.0, quota_per_minute: int = 0):
+        self.id = "fake-spreadsheet"
+        self.latency = latency
+        self.quota_per_minute = quota_per_minute
+        self.requests = 0
+        self.quota_errors = 0
+        self._recent = deque()
+        self._lock = threading.Lock()
+        self._sheets = {}
+
+    def _check_quota(self):
+        """Учитывает один запрос к API и бросает ошибку 429 сверх квоты."""
+        with self._lock:
+            self.requests += 1
+            if self.quota_per_minute:
+                now = time.monotonic()
+                while self._recent and now - self._recent[0] > 60:
+                    self._recent.popleft()
+                if len(self._recent) >= self.quota_per_minute:
+                    self.quota_errors += 1
+                    raise SheetsAPIError(429, "Quota exceeded (fake)")
+                self._recent.append(now)
+
+    def _request(self):
+        """Синхронный запрос (через gspread, только при подключении): задержка и проверка квоты."""
+        self._check_quota()
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add_sheet(self, title: str) -> "FakeWorksheet":
+        worksheet = FakeWorksheet(self, title, len(self._sheets))
+        self._sheets[title] = worksheet
+        return worksheet
+
+    @property
+    def sheet1(self) -> "FakeWorksheet":
+        return next(iter(self._sheets.values()))
+
+
+class FakeWorksheet:
+    """
+    Лист в памяти с теми методами gspread.Worksheet, которые g_sheets использует при подключении.
+    Значения хранятся как есть (без приведения типов, которое делает настоящий API).
+    """
+
+    def __init__(self, spreadsheet: FakeSpreadsheet, title: str, sheet_id: int, rows: list | None = None):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.rows = rows or []
+
+    @classmethod
+    def create(cls, headers: list, rows: list | None = None, latency: float = 0.0, quota_per_minute: int = 0):
+        """Создает таблицу с одним листом: заголовки и строки данных."""
+        spreadsheet = FakeSpreadsheet(latency, quota_per_minute)
+        worksheet = cls(spreadsheet, "Лист1", 0, [list(headers)] + [list(row) for row in rows or []])
+        spreadsheet._sheets[worksheet.title] = worksheet
+        return worksheet
+
+    def _write(self, row: int, col: int, values: list):
+        for offset, row_values in enumerate(values):
+            while len(self.rows) < row + offset:
+                self.rows.append([])
+            cells = self.rows[row + offset - 1]
+            end = col - 1 + len(row_values)
+            if len(cells) < end:
+                cells.extend([""] * (end - len(cells)))
+            cells[col - 1:end] = list(row_values)
+
+    def _read(self, a1: str, major_dimension: str = "ROWS") -> list:
+        """Значения диапазона как в ответе API: без хвостовых пустых ячеек и строк."""
+        start_row, start_col, end_row, end_col = 1, 1, None, None
+        if a1:
+            start, _, end = a1.partition(":")
+            start_row, start_col = gspread.utils.a1_to_rowcol(start if re.search(r"\d", start) else start + "1")
+            end = end or start
+            end_col = gspread.utils.a1_to_rowcol(re.sub(r"\d", "", end) + "1")[1]
+            end_row = int(digits) if (digits := re.sub(r"\D", "", end)) else None
+        rows = [list(row[start_col - 1:end_col]) for row in self.rows[start_row - 1:end_row]]
+        if major_dimension == "COLUMNS":
+            width = max((len(row) for row in rows), default=0)
+            rows = [[row[col] if len(row) > col else "" for row in rows] for col in range(width)]
+        for row in rows:
+            while row and row[-1] == "":
+                row.pop()
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def get_all_values(self) -> list:
+        self.spreadsheet._request()
+        return [list(row) for row in self.rows]
+
+    def row_values(self, row: int) -> list:
+        self.spreadsheet._request()
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def update(self, range_name: str, values: list):
+        self.spreadsheet._request()
+        self._write(*gspread.utils.a1_to_rowcol(range_name.split("!")[-1].split(":")[0]), values)
+
+
+class FakeSheetsAPI(_AsyncSheetsClient):
+    """
+    Асинхронный клиент g_sheets поверх таблицы в памяти: вместо HTTP-запросов к Sheets REST API
+    запросы обрабатываются локально, поэтому вся остальная логика клиента (диапазоны, разбор ответов) та же.
+    """
+
+    def __init__(self, worksheet: FakeWorksheet):
+        self.url = ""
+        self.sheet_title = worksheet.title
+        self.sheet_id = worksheet.id
+        self.spreadsheet = worksheet.spreadsheet
+
+    def _sheet(self, range_name: str) -> tuple:
+        title, _, a1 = unquote(range_name).partition("!")
+        if title.startswith("'"):
+            title = title[1:-1].replace("''", "'")
+        if title not in self.spreadsheet._sheets:
+            raise SheetsAPIError(400, f"Unable to parse range: {range_name}")
+        return self.spreadsheet._sheets[title], a1
+
+    async def _request(self, method: str, path: str, params=None, json=None) -> dict:
+        self.spreadsheet._check_quota()
+        if self.spreadsheet.latency:
+            await asyncio.sleep(self.spreadsheet.latency)
+        params = params or []
+
+        if path == "":
+            return {"spreadsheetId": self.spreadsheet.id, "sheets": [
+                {"properties": {"title": sheet.title, "sheetId": sheet.id}} for sheet in self.spreadsheet._sheets.values()
+            ]}
+        if path == "/values:batchGet":
+            major_dimension = dict(params).get("majorDimension", "ROWS")
+            value_ranges = []
+            for key, range_name in params:
+                if key == "ranges":
+                    worksheet, a1 = self._sheet(range_name)
+                    value_ranges.append({"range": range_name, "values": worksheet._read(a1, major_dimension)})
+            return {"valueRanges": value_ranges}
+        if path == "/values:batchUpdate":
+            for item in json["data"]:
+                worksheet, a1 = self._sheet(item["range"])
+                worksheet._write(*gspread.utils.a1_to_rowcol(a1.split(":")[0]), item["values"])
+            return {}
+        if path == ":batchUpdate":
+            by_id = {sheet.id: sheet for sheet in self.spreadsheet._sheets.values()}
+            for request in json["requests"]:
+                if "addSheet" in request:
+                    self.spreadsheet.add_sheet(request["addSheet"]["properties"]["title"])
+                elif "deleteDimension" in request:
+                    target = request["deleteDimension"]["range"]
+                    del by_id[target["sheetId"]].rows[target["startIndex"]:target["endIndex"]]
+            return {}
+        if path.endswith(":append"):
+            worksheet, _ = self._sheet(path[len("/values/"):-len(":append")])
+            rows = json["values"]
+            start = len(worksheet.rows) + 1
+            worksheet.rows.extend(list(row) for row in rows)
+            last_col = re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, max((len(row) for row in rows), default=1)))
+            return {"updates": {
+                "updatedRange": f"'{worksheet.title}'!A{start}:{last_col}{start + len(rows) - 1}", "updatedRows": len(rows),
+            }}
+        if path.startswith("/values/"):
+            worksheet, a1 = self._sheet(path[len("/values/"):])
+            return {"values": worksheet._read(a1)}
+        raise SheetsAPIError(404, f"Unknown request: {method} {path}")
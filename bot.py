@@ -5,7 +5,7 @@ import asyncio
 from datetime import datetime, time, timedelta, timezone
 from dotenv import load_dotenv
 from dashboard_storage import save_dashboard_messages, load_dashboard_messages
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, Message, ReplyKeyboardMarkup, InputMediaPhoto, InputMediaDocument, BotCommand, BotCommandScopeChat, BotCommandScopeChatAdministrators, User, ForumTopic
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, Message, ReplyKeyboardMarkup, InputMediaPhoto, BotCommand, BotCommandScopeChat, BotCommandScopeChatAdministrators, User, ForumTopic
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -22,7 +22,10 @@ import html
 from g_sheets import (
     add_feedback,
     set_priority_and_sla,
-    get_open_tickets_for_sla_check,
+    build_sla_schedule,
+    set_sla_listener,
+    get_next_sla_deadline,
+    get_due_sla_tickets,
     mark_sla_notification_sent,
     get_all_tickets,
     get_ticket_details_by_id,
@@ -32,13 +35,35 @@ from g_sheets import (
     update_ticket_status,
     record_action,
     update_ticket_url,
+    load_tickets_from_sheet,
+    build_ticket_index,
+    start_worksheet_warmup,
+    sync_tickets_to_sheet,
+    run_sheet_writer,
+    flush_sheet_writes,
+    close_sheets,
+    run_sheets_keepalive,
+    get_write_queue_stats,
+    get_rate_limiter_stats,
+    get_sheets_health,
+    get_tickets_cache_stats,
+    archive_closed_tickets,
+    SHEET_SYNC_INTERVAL,
+    ARCHIVE_INTERVAL,
 )
 from database import (
-    initialize_db, get_all_users, get_user_fio, set_user_fio, 
+    initialize_db, get_user_fio, set_user_fio, 
     get_or_create_user, delete_user, set_user_username, get_user_username,
-    set_topic_id, get_all_topic_ids, delete_all_topics
+    set_topic_id, get_all_topic_ids, delete_all_topics, get_ticket_columns, db_executor, close_db,
+    get_profile_cache_stats, count_users, mark_user_unreachable, mark_user_reachable,
+    create_broadcast_job, get_broadcast_job, get_broadcast_jobs, iter_pending_deliveries, set_delivery_status,
+    count_deliveries, finish_broadcast_job, retry_failed_deliveries,
 )
+from executors import get_executor_stats
 from logger import logger
+from broadcast import Broadcast, is_unreachable_error
+from digest import DigestPlan, DIGEST_VIA_STAGING
+from admin_jobs import AdminJob, start_job, get_jobs, cancel_job
 import telegram.error
 import re
 from telegram.constants import ParseMode, ChatAction
@@ -86,6 +111,9 @@ TOPIC_NAMES = {
     "l2_support": "Линия 2",
     "l3_support": "Линия 3",
 }
+# Служебный топик, куда дайджест выкладывается один раз перед рассылкой копий
+if DIGEST_VIA_STAGING:
+    TOPIC_NAMES["digest_staging"] = "📨 Дайджесты"
 
 # Состояния для ConversationHandler
 # Основной диалог
@@ -1300,15 +1328,19 @@ async def digest_document_save(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def show_digest_preview(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """ Показывает предпросмотр дайджеста, группируя по типам контента. """
-    text_items = context.user_data.get('digest_content_text', [])
-    photo_items = context.user_data.get('digest_content_photos', [])
-    document_items = context.user_data.get('digest_content_documents', [])
+    # План отправки собирается один раз: предпросмотр и рассылка воспроизводят одни и те же сообщения
+    plan = DigestPlan.compile(
+        context.user_data.get('digest_content_text', []),
+        context.user_data.get('digest_content_photos', []),
+        context.user_data.get('digest_content_documents', []),
+    )
+    context.user_data['digest_plan'] = plan
 
     admin_chat_id = update.effective_chat.id
     logger.set_context(update)
     log.info("Пользователь запросил предпросмотр дайджеста." )
 
-    if not text_items and not photo_items and not document_items:
+    if plan.is_empty:
         await context.bot.send_message(admin_chat_id, "Дайджест пуст. Добавьте контент перед предпросмотром.")
         # Возвращаемся к выбору контента
         reply_markup = InlineKeyboardMarkup(DIGEST_CHOOSE)
@@ -1317,52 +1349,15 @@ async def show_digest_preview(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     await context.bot.send_message(admin_chat_id, "Вот как будет выглядеть дайджест:")
 
-    # 1. Отправляем весь текст
-    if text_items:
-        full_text_content = "\n\n".join(text_items)
-        # Разделяем на части, если текст слишком длинный для одного сообщения Telegram
-        text_chunks = [full_text_content[i:i + 4096] for i in range(0, len(full_text_content), 4096)]
-        log.info(f"Текст разбит на {len(text_chunks)} частей для отправки. Начало отправки")
-        for chunk in text_chunks:
-            try:
-                await context.bot.send_message(admin_chat_id, chunk)
-                await asyncio.sleep(0.01)
-            except Exception as e:
-                log.error("Ошибка при отправке текстового блока предпросмотра пользователю: %s", e )
-                await context.bot.send_message(admin_chat_id, f"Ошибка при показе текстового блока предпросмотра: {e}")
-
-    # 2. Отправляем все фотографии медиагруппами
-    if photo_items:
-        current_media_group = []
-        log.info(f"Начало отправки {len(photo_items)} фото")
-        for i, photo_item in enumerate(photo_items):
-            current_media_group.append(InputMediaPhoto(media=photo_item['file_id']))
-            if (len(current_media_group) == 10) or (i == len(photo_items) - 1):
-                try:
-                    await context.bot.send_media_group(admin_chat_id, current_media_group, read_timeout=20, write_timeout=20)
-                    await asyncio.sleep(0.01)
-                except Exception as e:
-                    log.error("Ошибка при отправке фото медиагруппы предпросмотра пользователю: %s", e )
-                    await context.bot.send_message(admin_chat_id, f"Ошибка при показе фото медиагруппы предпросмотра: {e}")
-                current_media_group = []
-
-    # 3. Отправляем все документы медиагруппами
-    if document_items:
-        current_document_group = []
-        log.info(f"Начало отправки {len(document_items)} документов")
-        for i, doc_item in enumerate(document_items):
-            current_document_group.append(InputMediaDocument(media=doc_item['file_id']))
-            if len(current_document_group) == 10 or (i == len(document_items) - 1):
-                try:
-                    await context.bot.send_media_group(admin_chat_id, current_document_group, read_timeout=20, write_timeout=20)
-                    await asyncio.sleep(0.01)
-                except Exception as e:
-                    log.error("Ошибка при отправке документов медиагруппы предпросмотра пользователю: %s", e )
-                    await context.bot.send_message(admin_chat_id, f"Ошибка при показе документов медиагруппы предпросмотра: {e}")
-                current_document_group = []
+    log.info(f"Дайджест: {len(plan.text_chunks)} текстовых частей, {len(plan.media_groups)} медиагрупп. Начало отправки")
+    for kind, call, _ in plan.requests(context.bot, admin_chat_id):
+        try:
+            await call()
+        except Exception as e:
+            log.error("Ошибка при отправке блока предпросмотра (%s) пользователю: %s", kind, e )
+            await context.bot.send_message(admin_chat_id, f"Ошибка при показе блока предпросмотра ({kind}): {e}")
 
-    all_users = await get_all_users()
-    user_count = len([user_id for user_id in all_users if user_id not in ADMIN_USER_IDS])
+    user_count = await count_users(exclude_ids=ADMIN_USER_IDS)
     log.info(f"Дайджест будет отправлен {user_count} пользователям")
 
     keyboard = [
@@ -1399,6 +1394,8 @@ async def handle_broadcast_confirmation(update: Update, context: ContextTypes.DE
     elif query.data == "add_something_to_digest":
         log.info("Пользователь решил дополнить дайджест")
         await query.edit_message_text("Рассылка приостановлена. Вы можете добавить ещё контент.")
+        # Содержимое изменится, план соберется заново при следующем предпросмотре
+        context.user_data.pop('digest_plan', None)
         reply_markup = InlineKeyboardMarkup(DIGEST_CHOOSE)
         await context.bot.send_message(query.message.chat.id, "Что вы хотите добавить в дайджест?", reply_markup=reply_markup)
         return CHOOSING_DIGEST_CONTENT
@@ -1408,109 +1405,257 @@ async def handle_broadcast_confirmation(update: Update, context: ContextTypes.DE
         await cancel_digest_creation(update, context)
         return ConversationHandler.END
 
-async def send_final_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Отправляет собранный дайджест всем пользователям, группируя фото и документы в альбомы."""
+async def track_user_reachability(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Пользователь написал боту — значит, снова доступен для рассылок."""
+    if update.effective_user:
+        await mark_user_reachable(update.effective_user.id)
 
-    text_items = context.user_data.get('digest_content_text', [])
-    photo_items = context.user_data.get('digest_content_photos', [])
-    document_items = context.user_data.get('digest_content_documents', [])
+async def send_final_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сохраняет собранный дайджест как задание рассылки и рассылает его всем пользователям."""
+    # Рассылается ровно тот план, что был показан в предпросмотре
+    plan = context.user_data.get('digest_plan') or DigestPlan.compile(
+        context.user_data.get('digest_content_text', []),
+        context.user_data.get('digest_content_photos', []),
+        context.user_data.get('digest_content_documents', []),
+    )
 
     admin_chat_id = update.effective_chat.id
-    log.info(f"Начало финальной рассылки дайджеста. Текст: {len(text_items)}, фото: {len(photo_items)}, документы: {len(document_items)}")
+    log.info(f"Начало финальной рассылки дайджеста. Текстовых частей: {len(plan.text_chunks)}, медиагрупп: {len(plan.media_groups)}")
 
-    if not text_items and not photo_items and not document_items:
+    if plan.is_empty:
         log.warning("Попытка отправить пустой дайджест." )
         await context.bot.send_message(admin_chat_id, "Дайджест пуст. Ничего не отправлено.")
         return
 
-    all_users = await get_all_users()
-    users_to_broadcast = [user_id for user_id in all_users if user_id not in ADMIN_USER_IDS]
-    log.info(f"Всего пользователей для рассылки: {len(users_to_broadcast)}")
-
-    success_count = 0
-    fail_count = 0
-    total_users_to_send = len(users_to_broadcast)
-
-    await context.bot.send_message(admin_chat_id, f"Начинаю рассылку дайджеста для {total_users_to_send} пользователей...")
-
-    for user_id in users_to_broadcast:
-        user_send_successful = True
+    if DIGEST_VIA_STAGING and ADMIN_CHAT_ID:
+        # Получатели получат копии этих сообщений: один запрос copy_messages вместо запроса на каждую часть
         try:
-            # 1. Отправляем весь текст
-            if text_items:
-                full_text_content = "\n\n".join(text_items)
-                text_chunks = [full_text_content[i:i + 4096] for i in range(0, len(full_text_content), 4096)]
-                for chunk in text_chunks:
-                    try:
-                        await context.bot.send_message(user_id, chunk)
-                        await asyncio.sleep(0.05)
-                    except Exception as e:
-                        log.error("Ошибка при отправке текстового блока пользователю %s: %s", user_id, e )
-                        user_send_successful = False
-                        break
-                await asyncio.sleep(0.1)
-
-            # 2. Отправляем все фотографии медиагруппами
-            if photo_items and user_send_successful: # Продолжаем, только если не было ошибок ранее для этого пользователя
-                current_media_group = []
-                for i, photo_item in enumerate(photo_items):
-                    current_media_group.append(InputMediaPhoto(media=photo_item['file_id']))
-                    if (len(current_media_group) == 10) or (i == len(photo_items) - 1):
-                        try:
-                            await context.bot.send_media_group(user_id, current_media_group, read_timeout=20, write_timeout=20)
-                            await asyncio.sleep(0.05)
-                        except Exception as e:
-                            log.error("Ошибка при отправке фото пользователю %s: %s", user_id, e )
-                            user_send_successful = False
-                            break
-                        current_media_group = []
-                await asyncio.sleep(0.1)
-
-            # 3. Отправляем все документы медиагруппами
-            if document_items and user_send_successful: 
-                current_document_group = []
-                for i, doc_item in enumerate(document_items):
-                    current_document_group.append(InputMediaDocument(media=doc_item['file_id']))
-                    if len(current_document_group) == 10 or (i == len(document_items) - 1):
-                        try:
-                            await context.bot.send_media_group(user_id, current_document_group, read_timeout=20, write_timeout=20)
-                            await asyncio.sleep(0.05)
-                        except Exception as e:
-                            log.error("Ошибка при отправке документов пользователю %s: %s", user_id, e )
-                            user_send_successful = False
-                            break
-                        current_document_group = []
-                await asyncio.sleep(0.1)
-
+            plan = await plan.stage(
+                Broadcast("digest-staging"), context.bot, ADMIN_CHAT_ID, context.bot_data.get('digest_staging_topic_id')
+            )
+            log.info(f"Дайджест выложен в служебный топик, запросов на получателя: {plan.request_count}")
         except Exception as e:
-            log.error("Общая ошибка при отправке дайджеста пользователю %s: %s", user_id, e )
-            user_send_successful = False
-            
-        if user_send_successful:
-            success_count += 1
-        else:
-            fail_count += 1
-            log.warning(f"Не удалось отправить дайджест пользователю {user_id}")
-            
-        await asyncio.sleep(0.2) # Общая задержка между отправками разным пользователям
+            log.error(f"Не удалось выложить дайджест в служебный топик, рассылка пойдет без копирования: {e}")
 
-    await context.bot.send_message(
-        admin_chat_id,
-        f"Рассылка дайджеста завершена!\n"
-        f"Успешно отправлено {success_count} пользователям.\n"
-        f"Не удалось отправить {fail_count} пользователям."
-    )
-    log.info("Рассылка дайджеста завершена. Успешно: %d, Ошибок: %d.", success_count, fail_count )
+    # Содержимое и список получателей сохраняются в БД до начала отправки:
+    # прерванная перезапуском рассылка продолжится с тех, кому дайджест еще не отправлен
+    job_id = await create_broadcast_job("digest", plan.to_payload(), admin_chat_id, exclude_ids=ADMIN_USER_IDS)
+    job = await get_broadcast_job(job_id)
+    log.info(f"Создано задание рассылки №{job_id}, получателей: {job['total']}")
 
-    # Очищаем данные дайджеста после рассылки
+    # Дайджест уже сохранен в задании, черновик больше не нужен
     if 'digest_content_text' in context.user_data:
         del context.user_data['digest_content_text']
     if 'digest_content_photos' in context.user_data:
         del context.user_data['digest_content_photos']
     if 'digest_content_documents' in context.user_data:
         del context.user_data['digest_content_documents']
+    context.user_data.pop('digest_plan', None)
+
+    # Рассылка идет в фоне, ход виден в статусном сообщении задачи; диалог завершается сразу
+    await start_job(
+        context.bot, admin_chat_id, f"рассылка дайджеста №{job_id} для {job['total']} пользователей",
+        lambda admin_job: run_digest_job(context.bot, job_id, admin_job),
+        message_thread_id=_message_thread_id(update),
+    )
     return ConversationHandler.END
 
+# Задания рассылок, которые выполняются сейчас: одно задание не должно отправляться дважды параллельно
+_running_broadcast_jobs = set()
+
+async def run_digest_job(bot, job_id: int, admin_job: AdminJob | None = None) -> None:
+    """
+    Рассылает дайджест из задания job_id получателям, которым он еще не отправлен,
+    записывая результат каждой отправки в журнал доставки, и сохраняет итоги задания.
+    Ход рассылки сообщается через admin_job.report(). Отмененное администратором задание
+    сохраняется как cancelled; при остановке бота оно остается running и продолжится после запуска.
+    """
+    if job_id in _running_broadcast_jobs:
+        log.warning(f"Рассылка №{job_id} уже выполняется, повторный запуск пропущен.")
+        return
+    _running_broadcast_jobs.add(job_id)
+    try:
+        job = await get_broadcast_job(job_id)
+        plan = DigestPlan.from_payload(job['payload'])
+        # Получатели, обработанные до перезапуска или в прошлых попытках, тоже входят в прогресс
+        processed = job['total'] - (await count_deliveries(job_id)).get('pending', 0)
+
+        async def deliver(broadcast: Broadcast, user_id: int):
+            # Сначала весь текст, затем альбомы фото и документов; ошибка прерывает отправку этому получателю
+            await plan.deliver(broadcast, bot, user_id)
+
+        async def on_result(user_id: int, error: Exception | None):
+            nonlocal processed
+            processed += 1
+            if admin_job:
+                admin_job.report(processed, job['total'])
+            if error is None:
+                await set_delivery_status(job_id, user_id, 'delivered')
+                return
+            log.warning(f"Не удалось отправить дайджест №{job_id} пользователю {user_id}: {error}")
+            # Заблокировавших бота больше не включаем в рассылки, пока они снова не напишут
+            if is_unreachable_error(error):
+                await set_delivery_status(job_id, user_id, 'unreachable', str(error))
+                await mark_user_unreachable(user_id)
+            else:
+                await set_delivery_status(job_id, user_id, 'failed', str(error))
+
+        # Получатели обслуживаются параллельно, скорость ограничена только лимитами Telegram
+        try:
+            stats = await Broadcast(f"digest-{job_id}").run(iter_pending_deliveries(job_id), deliver, on_result)
+        except asyncio.CancelledError:
+            # Отменена администратором: без этого задание продолжилось бы после перезапуска
+            if admin_job and admin_job.cancel_requested:
+                await finish_broadcast_job(job_id, 'cancelled')
+                log.info(f"Рассылка дайджеста №{job_id} отменена.")
+            raise
+        job = await finish_broadcast_job(job_id)
+    finally:
+        _running_broadcast_jobs.discard(job_id)
+
+    log.info(
+        "Рассылка дайджеста №%d завершена. Успешно: %d, Ошибок: %d, запросов: %d (%.1f/с), RetryAfter: %d.",
+        job_id, job['delivered'], job['failed'] + job['unreachable'], stats['requests'],
+        stats['requests_per_second'], stats['retry_after']
+    )
+    try:
+        await bot.send_message(
+            job['chat_id'],
+            f"Рассылка дайджеста №{job_id} завершена за {stats['elapsed']} с!\n"
+            f"Успешно отправлено {job['delivered']} из {job['total']} пользователей.\n"
+            f"Не удалось отправить {job['failed'] + job['unreachable']} пользователям"
+            f" (из них недоступны и исключены из следующих рассылок: {job['unreachable']})."
+            + (f"\nПовторить отправку с ошибками: /broadcast_retry {job_id}" if job['failed'] else "")
+        )
+    except Exception as e:
+        log.error(f"Не удалось отправить отчет о рассылке №{job_id}: {e}")
+
+async def resume_broadcast_jobs(bot) -> None:
+    """Продолжает рассылки, прерванные перезапуском бота, с получателей, которым еще не отправлено."""
+    for job in reversed(await get_broadcast_jobs(status='running', limit=100)):
+        log.info(f"Продолжаю прерванную рассылку №{job['id']}")
+        try:
+            admin_job = await start_job(
+                bot, job['chat_id'], f"продолжение рассылки дайджеста №{job['id']} после перезапуска",
+                lambda admin_job, job_id=job['id']: run_digest_job(bot, job_id, admin_job),
+            )
+        except Exception as e:
+            log.error(f"Не удалось продолжить рассылку №{job['id']}: {e}", exc_info=True)
+            continue
+        # Рассылки продолжаются по очереди, чтобы вместе не превышать лимиты Telegram
+        await admin_job.task
+
+async def broadcasts_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает администратору последние рассылки и их итоги."""
+    user_id = update.message.from_user.id
+    if user_id not in ADMIN_USER_IDS:
+        await update.message.reply_text("У вас нет прав для выполнения этой команды.")
+        return
+
+    jobs = await get_broadcast_jobs(limit=10)
+    if not jobs:
+        await update.message.reply_text("Рассылок еще не было.")
+        return
+
+    lines = ["📬 Последние рассылки"]
+    for job in jobs:
+        if job['status'] == 'running':
+            # Итоги незавершенной рассылки считаются по журналу доставки
+            counts = await count_deliveries(job['id'])
+            lines.append(
+                f"\n№{job['id']} от {job['created_at']}: идет, отправлено {counts.get('delivered', 0)} из {job['total']}, "
+                f"ошибок: {counts.get('failed', 0) + counts.get('unreachable', 0)}"
+            )
+        else:
+            lines.append(
+                f"\n№{job['id']} от {job['created_at']}: {'отменена' if job['status'] == 'cancelled' else 'завершена'} {job['finished_at']}, "
+                f"отправлено {job['delivered']} из {job['total']}, ошибок: {job['failed']}, недоступны: {job['unreachable']}"
+            )
+    await update.message.reply_text("\n".join(lines))
+
+async def broadcast_retry_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Повторяет рассылку только тем получателям, которым она не была отправлена из-за ошибки."""
+    user_id = update.message.from_user.id
+    logger.set_context(update)
+    if user_id not in ADMIN_USER_IDS:
+        await update.message.reply_text("У вас нет прав для выполнения этой команды.")
+        return
+
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Пожалуйста, укажите номер рассылки. Пример: /broadcast_retry <номер>")
+        return
+
+    job_id = int(context.args[0])
+    job = await get_broadcast_job(job_id)
+    if job is None:
+        await update.message.reply_text(f"Рассылка №{job_id} не найдена.")
+        return
+    if job_id in _running_broadcast_jobs:
+        await update.message.reply_text(f"Рассылка №{job_id} еще выполняется.")
+        return
+
+    count = await retry_failed_deliveries(job_id)
+    if not count:
+        await update.message.reply_text(f"В рассылке №{job_id} нет получателей с ошибками для повтора.")
+        return
+
+    log.info(f"Администратор {user_id} повторяет рассылку №{job_id} для {count} получателей")
+    await start_job(
+        context.bot, update.effective_chat.id, f"повтор рассылки дайджеста №{job_id} для {count} пользователей",
+        lambda admin_job: run_digest_job(context.bot, job_id, admin_job),
+        message_thread_id=_message_thread_id(update),
+    )
+
+def _message_thread_id(update: Update) -> int | None:
+    """Топик, из которого пришла команда, чтобы статус задачи появился там же."""
+    message = update.effective_message
+    return message.message_thread_id if message and message.is_topic_message else None
+
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает администратору фоновые задачи: выполняющиеся и последние завершенные."""
+    user_id = update.message.from_user.id
+    if user_id not in ADMIN_USER_IDS:
+        await update.message.reply_text("У вас нет прав для выполнения этой команды.")
+        return
+
+    jobs = get_jobs()
+    if not jobs:
+        await update.message.reply_text("Фоновых задач нет.")
+        return
+    text = "\n\n".join(job.describe() for job in jobs)
+    if any(job.status == "running" for job in jobs):
+        text += "\n\nОтменить задачу: /cancel_job <номер>"
+    await update.message.reply_text(text)
+
+async def cancel_job_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отменяет фоновую задачу по номеру: командой /cancel_job или кнопкой в статусном сообщении."""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    logger.set_context(update)
+    if user_id not in ADMIN_USER_IDS:
+        if query:
+            await query.answer("У вас нет прав для выполнения этого действия.", show_alert=True)
+        else:
+            await update.message.reply_text("У вас нет прав для выполнения этой команды.")
+        return
+
+    if query:
+        job_id = int(query.data.removeprefix("cancel_job_"))
+    elif context.args and context.args[0].isdigit():
+        job_id = int(context.args[0])
+    else:
+        await update.message.reply_text("Пожалуйста, укажите номер задачи. Пример: /cancel_job <номер>")
+        return
+
+    cancelled = cancel_job(job_id)
+    if cancelled:
+        log.info(f"Администратор {user_id} отменил задачу #{job_id}")
+    text = f"Задача #{job_id} отменяется." if cancelled else f"Задача #{job_id} не найдена или уже завершена."
+    if query:
+        await query.answer(text)
+    else:
+        await update.message.reply_text(text)
+
 async def cancel_digest_creation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Отменяет создание дайджеста и очищает временные данные."""
     if update.message:
@@ -1528,6 +1673,7 @@ async def cancel_digest_creation(update: Update, context: ContextTypes.DEFAULT_T
         del context.user_data['digest_content_photos']
     if 'digest_content_documents' in context.user_data:
         del context.user_data['digest_content_documents']
+    context.user_data.pop('digest_plan', None)
     return ConversationHandler.END
 
 async def get_photo_by_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1865,25 +2011,31 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data.clear()
     return ConversationHandler.END
 
+SLA_JOB_NAME = "sla_check"
+
+def schedule_sla_check(application: Application) -> None:
+    """Ставит единственный таймер проверки SLA на ближайший дедлайн (вместо периодического опроса)."""
+    for job in application.job_queue.get_jobs_by_name(SLA_JOB_NAME):
+        job.schedule_removal()
+    deadline = get_next_sla_deadline()
+    if deadline is None:
+        return
+    delay = max(0.0, (deadline - datetime.now()).total_seconds())
+    application.job_queue.run_once(check_sla_breaches, when=delay, name=SLA_JOB_NAME)
+    log.info(f"Следующая проверка SLA в {deadline.strftime('%H:%M:%S %d.%m.%Y')}")
+
 async def check_sla_breaches(context: ContextTypes.DEFAULT_TYPE):
+    """Отправляет уведомления по заявкам, у которых наступил срок SLA, и переставляет таймер."""
+    try:
+        await notify_sla_breaches(context)
+    finally:
+        schedule_sla_check(context.application)
+
+async def notify_sla_breaches(context: ContextTypes.DEFAULT_TYPE):
     """Проверяет просроченные заявки и отправляет уведомления."""
     logger.set_context()
     log.info("Запуск проверки SLA..." )
-    breached_tickets = []
-    open_tickets = await get_open_tickets_for_sla_check()
-    now = datetime.now()
-
-    for ticket in open_tickets:
-        try:
-            sla_time_str = ticket.get("SLA (Время на решение)")
-            if sla_time_str:
-                sla_time = datetime.strptime(sla_time_str, "%H:%M:%S %d.%m.%Y")
-                if now > sla_time:
-                    breached_tickets.append(ticket)
-        except (ValueError, TypeError) as e:
-            logger.set_context()
-            log.error(f"Ошибка парсинга времени SLA для заявки #{ticket.get('Номер')}: {e}" )
-            continue
+    breached_tickets = await get_due_sla_tickets()
 
     if not breached_tickets:
         log.info("Просроченных заявок не найдено." )
@@ -1930,6 +2082,63 @@ async def check_sla_breaches(context: ContextTypes.DEFAULT_TYPE):
         await mark_sla_notification_sent(entry_id)
         log.info(f"Заявка №{entry_id} помечена как уведомленная")
 
+async def sync_tickets_job(context: ContextTypes.DEFAULT_TYPE):
+    """Выгружает изменения тикетов из локальной БД в Google Sheets."""
+    await sync_tickets_to_sheet()
+
+async def archive_tickets_job(context: ContextTypes.DEFAULT_TYPE):
+    """Переносит давно завершенные тикеты с основного листа Google Sheets в архив."""
+    await archive_closed_tickets()
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает администратору состояние очереди записи в Google Sheets."""
+    user_id = update.message.from_user.id
+    if user_id not in ADMIN_USER_IDS:
+        await update.message.reply_text("У вас нет прав для выполнения этой команды.")
+        return
+
+    stats = get_write_queue_stats()
+    health = await get_sheets_health()
+    state = {"closed": "🟢 доступна", "half_open": "🟡 проверка связи", "open": "🔴 недоступна"}.get(health['state'], health['state'])
+    text = (
+        f"📄 Google Sheets: {state}"
+        + (f", повтор через {health['retry_in']} с" if health['state'] == "open" else "")
+        + f"\nОшибок подряд: {health['consecutive_failures']}, отключений: {health['times_opened']}\n"
+        f"Изменений ожидают выгрузки: {health['pending_ops']}\n\n"
+        "📊 Очередь записи в Google Sheets\n"
+        f"Ячеек в очереди: {stats['queue_depth']}\n"
+        f"Отправок: {stats['flushes']} (ошибок: {stats['failed_flushes']})\n"
+        f"Записано ячеек: {stats['cells_written']}, объединено записей: {stats['merged_writes']}\n"
+        f"Последняя пачка: {stats['last_batch_size']} яч. за {stats['last_flush_ms']} мс\n"
+        f"Максимальное время отправки: {stats['max_flush_ms']} мс\n"
+    )
+    for name, bucket in get_rate_limiter_stats().items():
+        waiting = ", ".join(f"{lane}: {count}" for lane, count in bucket['waiting'].items())
+        text += (
+            f"\n⏱ Квота ({name}): {bucket['level']}/{bucket['capacity']} токенов, {bucket['rate_per_minute']}/мин\n"
+            f"Ожидают: {waiting}\n"
+            f"Пропущено: {bucket['granted']}, ждали квоту: {bucket['throttled']} "
+            f"(в среднем {bucket['avg_wait_ms']} мс, максимум {bucket['max_wait_ms']} мс)\n"
+        )
+    cache = get_tickets_cache_stats()
+    text += (
+        f"\n🗂 Кэш тикетов: {cache['size']} шт., возраст {cache['age']} с\n"
+        f"Попаданий: {cache['hits']}, устаревших: {cache['stale_hits']}, промахов: {cache['misses']}\n"
+    )
+    profiles = get_profile_cache_stats()
+    text += (
+        f"\n👤 Кэш профилей: {profiles['size']}/{profiles['capacity']}, "
+        f"попаданий: {profiles['hits']} ({profiles['hit_rate']}%), промахов: {profiles['misses']}\n"
+    )
+    for name, pool in get_executor_stats().items():
+        text += (
+            f"\n🧵 Пул потоков ({name}): занято {pool['active']}/{pool['workers']}, в очереди {pool['queue_depth']}\n"
+            f"Вызовов: {pool['completed']} (ошибок: {pool['failed']}), "
+            f"ожидание {pool['avg_wait_ms']} мс (макс. {pool['max_wait_ms']}), "
+            f"выполнение {pool['avg_run_ms']} мс (макс. {pool['max_run_ms']})\n"
+        )
+    await update.message.reply_text(text)
+
 async def delete_me(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Удаляет данные пользователя из базы данных."""
     user_id = update.message.from_user.id
@@ -2015,6 +2224,8 @@ async def setup_admin_group_topics(application: Application) -> None:
 async def post_init_setup(application: Application) -> None:
     """Выполняет настройку после инициализации бота (команды, топики)."""
     log.info("--- Запуск post_init_setup ---")
+    # Подключаемся к Google Sheets в фоне, пока настраиваются команды и топики
+    start_worksheet_warmup()
     # Установка команд для меню
     user_commands = [
         BotCommand("start", "Перезапустить бота / Регистрация"),
@@ -2029,7 +2240,10 @@ async def post_init_setup(application: Application) -> None:
         BotCommand("start_digest", "Создать рассылку"),
         BotCommand("get_photo", "Получить фото по ID"),
         BotCommand("recreate_topics", "Пересоздать системные топики"),
-        BotCommand("fast_answer", "Быстрый ответ пользователю")
+        BotCommand("fast_answer", "Быстрый ответ пользователю"),
+        BotCommand("stats", "Статистика выгрузки в Google Sheets"),
+        BotCommand("broadcasts", "Последние рассылки и их итоги"),
+        BotCommand("jobs", "Фоновые задачи и их ход"),
     ]
     
     ## Устанавливаем полный набор команд для администраторов в их личных чатах с ботом
@@ -2055,6 +2269,13 @@ async def post_init_setup(application: Application) -> None:
         except Exception as e:
             log.warning(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось установить админские команды для чата {ADMIN_CHAT_ID}: {e}", exc_info=True)
 
+    # Переносим тикеты из Google Sheets в локальную БД; пока импорт не удался, он повторяется при каждом запуске
+    await load_tickets_from_sheet()
+    # Индекс тикетов в памяти для поиска по номеру, топику и пользователю
+    await build_ticket_index()
+    # Очередь дедлайнов SLA; при построении ставится таймер на ближайший
+    await build_sla_schedule()
+
     # Загружаем ID топиков из БД один раз при старте
     await setup_admin_group_topics(application)
     log.info("--- Завершение post_init_setup ---")
@@ -2069,17 +2290,18 @@ async def update_dashboard(application: Application) -> None:
         log.warning("Dashboard topic ID or ADMIN_CHAT_ID not set, skipping update.")
         return
 
-    all_tickets = await get_all_tickets()
+    # Дашборду нужны только эти поля, текст обращений и остальные столбцы не читаем
+    all_tickets = await get_ticket_columns(("number", "status", "type", "fio", "username", "ticket_url"))
     if not all_tickets:
         log.warning("No tickets found in Google Sheets. Clearing dashboard.")
         dashboard_text = "📊 <b>Панель управления</b>\n\n<i>Нет активных обращений.</i>"
     else:
         # Группировка тикетов по статусам
-        new_tickets = [t for t in all_tickets if t.get('Статус обращения') == 'Зарегистрировано']
-        in_work_tickets = [t for t in all_tickets if t.get('Статус обращения') == 'В работе']
-        l2_tickets = [t for t in all_tickets if 'L2' in t.get('Статус обращения', '')]
-        l3_tickets = [t for t in all_tickets if 'L3' in t.get('Статус обращения', '')]
-        recovered_tickets = [t for t in all_tickets if t.get('Статус обращения') == 'Восстановлено']
+        new_tickets = [t for t in all_tickets if t[1] == 'Зарегистрировано']
+        in_work_tickets = [t for t in all_tickets if t[1] == 'В работе']
+        l2_tickets = [t for t in all_tickets if 'L2' in (t[1] or '')]
+        l3_tickets = [t for t in all_tickets if 'L3' in (t[1] or '')]
+        recovered_tickets = [t for t in all_tickets if t[1] == 'Восстановлено']
 
         dashboard_lines = ["📊 <b>Панель управления</b>\n"]
 
@@ -2096,10 +2318,9 @@ async def update_dashboard(application: Application) -> None:
             if not tickets:
                 dashboard_lines.append("  <i>Нет обращений</i>")
             else:
-                for ticket in tickets:
-                    user_info = f"@{ticket.get('Логин') or ticket.get('ФИО')}"
-                    ticket_url = ticket.get('Ticket URL', '#')
-                    dashboard_lines.append(f"  - <a href='{ticket_url}'>Обращение #{ticket.get('Номер')}</a> ({html.escape(ticket.get('Тип', ''))}) от {html.escape(user_info)}")
+                for number, _, ticket_type, fio, username, ticket_url in tickets:
+                    user_info = f"@{username or fio}"
+                    dashboard_lines.append(f"  - <a href='{ticket_url or ''}'>Обращение #{number}</a> ({html.escape(ticket_type or '')}) от {html.escape(user_info)}")
             dashboard_lines.append("")
 
         dashboard_text = "\n".join(dashboard_lines)
@@ -2268,6 +2489,9 @@ async def main() -> None:
         .build()
     )
 
+    # Таймер проверки SLA переставляется при каждой смене ближайшего дедлайна
+    set_sla_listener(lambda: schedule_sla_check(application))
+
     # Вручную вызываем настройку после создания application
     await post_init_setup(application)
 
@@ -2334,6 +2558,8 @@ async def main() -> None:
     )
     log.info("Обработчик дайджеста создан")
 
+    # Отдельная группа: срабатывает на любое личное сообщение и не мешает остальным обработчикам
+    application.add_handler(MessageHandler(filters.ChatType.PRIVATE, track_user_reachability), group=-1)
     application.add_handler(registration_handler)
     application.add_handler(conv_handler)
     application.add_handler(digest_conv_handler)
@@ -2341,6 +2567,12 @@ async def main() -> None:
     application.add_handler(CommandHandler("delete_me", delete_me))
     application.add_handler(CommandHandler("recreate_topics", recreate_topics))
     application.add_handler(CommandHandler("fast_answer", fast_answer_handler))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("broadcasts", broadcasts_command))
+    application.add_handler(CommandHandler("broadcast_retry", broadcast_retry_command))
+    application.add_handler(CommandHandler("jobs", jobs_command))
+    application.add_handler(CommandHandler("cancel_job", cancel_job_command))
+    application.add_handler(CallbackQueryHandler(cancel_job_command, pattern="^cancel_job_"))
     application.add_handler(CallbackQueryHandler(fast_answer_handler, pattern="^fast_answer_"))
     application.add_handler(CallbackQueryHandler(take_ticket, pattern="^take_ticket_"))
     application.add_handler(CallbackQueryHandler(take_escalated_ticket, pattern="^take_escalated_"))
@@ -2377,8 +2609,12 @@ async def main() -> None:
         forward_user_reply_to_topic
     ))
 
-    # Запускаем фоновую проверку SLA
-    application.job_queue.run_repeating(check_sla_breaches, interval=300, first=10)
+    # Запускаем фоновую выгрузку изменений тикетов в Google Sheets
+    application.job_queue.run_repeating(sync_tickets_job, interval=SHEET_SYNC_INTERVAL, first=SHEET_SYNC_INTERVAL)
+
+    # Периодически переносим давно завершенные тикеты в архив, чтобы основной лист оставался небольшим
+    if ARCHIVE_INTERVAL > 0:
+        application.job_queue.run_repeating(archive_tickets_job, interval=ARCHIVE_INTERVAL, first=60)
 
     # Загружаем инструкции в кеш при старте
     load_instruction_files()
@@ -2386,11 +2622,29 @@ async def main() -> None:
     # Запускаем бота до принудительной остановки
     log.info("Бот готов к работе...")
     
-    async with application:
-        await application.start()
-        await application.updater.start_polling()
-        # Бесконечно ждем, пока не получим сигнал остановки (например, Ctrl+C)
-        await asyncio.Event().wait()
+    # Фоновые задачи, которые при остановке нужно отменить до закрытия БД
+    background_tasks = []
+    try:
+        async with application:
+            await application.start()
+            # Фоновая отправка накопленных изменений ячеек в Google Sheets
+            background_tasks.append(asyncio.create_task(run_sheet_writer()))
+            # Заранее обновляет токен Google API и поддерживает соединение при простое
+            background_tasks.append(asyncio.create_task(run_sheets_keepalive()))
+            # Продолжаем рассылки, прерванные прошлой остановкой бота
+            background_tasks.append(asyncio.create_task(resume_broadcast_jobs(application.bot)))
+            await application.updater.start_polling()
+            # Бесконечно ждем, пока не получим сигнал остановки (например, Ctrl+C)
+            await asyncio.Event().wait()
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        # Последний раз отправляем накопленные ячейки, пока соединения с БД открыты
+        await flush_sheet_writes()
+        await close_sheets()
+        # Соединения с БД закрываем последними, когда обработчики уже остановлены
+        await close_db()
 
 async def recreate_topics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Принудительно удаляет и пересоздает системные топики."""
@@ -2590,8 +2844,15 @@ async def restore_tickets_from_sheet(update: Update, context: ContextTypes.DEFAU
         await update.message.reply_text("⛔️ У вас нет прав для выполнения этой команды.")
         return
 
-    await update.message.reply_text("⏳ Начинаю процесс восстановления... Это может занять время.")
+    # Восстановление занимает минуты (пауза после каждого тикета), поэтому идет в фоне
+    await start_job(
+        context.bot, update.effective_chat.id, "восстановление обращений из таблицы",
+        lambda job: _restore_tickets_job(job, update, context),
+        message_thread_id=_message_thread_id(update),
+    )
 
+async def _restore_tickets_job(job: AdminJob, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Восстанавливает топики обращений из Google Sheets, сообщая о ходе через job.report()."""
     all_sheet_tickets = await get_all_tickets()
     if not all_sheet_tickets:
         await update.message.reply_text("Не удалось загрузить обращения из таблицы или таблица пуста.")
@@ -2615,6 +2876,10 @@ async def restore_tickets_from_sheet(update: Update, context: ContextTypes.DEFAU
     while current_index < len(tickets_to_process):
         ticket_data = tickets_to_process[current_index]
         processed_count += 1
+        job.report(
+            processed_count, len(tickets_to_process),
+            f"Восстановлено: {restored_count}, пропущено: {skipped_exist + skipped_condition}"
+        )
         entry_id_str = str(ticket_data.get('Номер', '')).strip()
         status = str(ticket_data.get('Статус обращения', '')).strip()
 
@@ -2795,7 +3060,7 @@ async def send_reply_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Не удалось найти обращение для ответа. Попробуйте снова.")
         return ConversationHandler.END
 
-    ticket_data = get_ticket_details_by_id(ticket_id)
+    ticket_data = await db_executor.run(get_ticket_details_by_id, ticket_id)
     if not ticket_data:
         await update.message.reply_text("Не удалось найти информацию по обращению.")
         return ConversationHandler.END
@@ -2928,7 +3193,7 @@ async def forward_admin_reply_to_user(update: Update, context: ContextTypes.DEFA
     # Если не нашли, идем в гугл-таблицу
     if not ticket_data:
         log.info(f"Не найдено данных в bot_data для topic_id {topic_id}, обращаюсь к Google Sheets...")
-        ticket_data = await asyncio.to_thread(get_ticket_details_by_topic_id, topic_id)
+        ticket_data = await db_executor.run(get_ticket_details_by_topic_id, topic_id)
     
     if ticket_data and ticket_data.get('user_id'):
         user_id = ticket_data['user_id']
@@ -2952,7 +3217,7 @@ async def forward_user_reply_to_topic(update: Update, context: ContextTypes.DEFA
     user_info = f"{user_fio} (@{update.effective_user.username}, id: {user_id})"
 
     # Ищем последнее "открытое" обращение пользователя
-    ticket_data = await asyncio.to_thread(get_last_open_ticket_by_user_id, user_id)
+    ticket_data = await db_executor.run(get_last_open_ticket_by_user_id, user_id)
 
     if ticket_data and ticket_data.get('topic_id'):
         topic_id = int(ticket_data['topic_id'])
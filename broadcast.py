@@ -0,0 +1,173 @@
+import asyncio
+import os
+import time
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from logger import logger
+from rate_limiter import TokenBucket
+from resilience import backoff_delay
+
+log = logger.get_logger('broadcast')
+
+# Лимиты Telegram Bot API для рассылок: не больше ~30 сообщений в секунду во все чаты
+# и не чаще одного сообщения в секунду в один чат.
+BROADCAST_RATE_PER_SECOND = float(os.getenv("BROADCAST_RATE_PER_SECOND", "30"))
+BROADCAST_CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL", "1"))
+# Сколько получателей обслуживается одновременно и сколько раз повторять запрос при сетевой ошибке
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "50"))
+BROADCAST_RETRY_ATTEMPTS = int(os.getenv("BROADCAST_RETRY_ATTEMPTS", "3"))
+
+# Лимит Telegram общий для бота, поэтому все рассылки (в том числе одновременные) берут токены
+# из одной корзины и вместе приостанавливаются на RetryAfter
+_send_bucket = TokenBucket("telegram_broadcast", BROADCAST_RATE_PER_SECOND, max(1.0, BROADCAST_RATE_PER_SECOND))
+_paused_until = 0.0
+
+
+def is_unreachable_error(e: Exception) -> bool:
+    """Пользователь заблокировал бота, удален или чат с ним не существует — повторять отправку бессмысленно."""
+    return isinstance(e, Forbidden) or (isinstance(e, BadRequest) and "chat not found" in str(e).lower())
+
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    retry_after = e.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+class Broadcast:
+    """
+    Рассылка множеству получателей. До concurrency получателей обслуживаются параллельно,
+    а все запросы к Bot API проходят через корзину токенов bucket (по умолчанию общую для всех
+    рассылок) под глобальный лимит Telegram;
+    в один чат запросы уходят не чаще раза в chat_interval секунд.
+    На RetryAfter все отправки приостанавливаются на указанное Telegram время, скорость
+    снижается вдвое и затем постепенно восстанавливается после успешных отправок.
+    """
+
+    def __init__(self, name: str = "broadcast", bucket: TokenBucket | None = None,
+                 concurrency: int = BROADCAST_CONCURRENCY, chat_interval: float = BROADCAST_CHAT_INTERVAL,
+                 attempts: int = BROADCAST_RETRY_ATTEMPTS):
+        self.name = name
+        self._bucket = bucket or _send_bucket
+        self.max_rate = BROADCAST_RATE_PER_SECOND if bucket is None else bucket.rate
+        self.min_rate = self.max_rate / 10
+        self.concurrency = concurrency
+        self.chat_interval = chat_interval
+        self.attempts = attempts
+        self._last_sent = {}  # чат -> время последней отправки, пока получатель обслуживается
+        self.started = None
+        self.finished = None
+        self.delivered = 0
+        self.failed = 0
+        self.unreachable = 0
+        self.requests = 0
+        self.retry_after = 0
+
+    async def send(self, chat_id: int, call, cost: float = 1):
+        """
+        Выполняет запрос к чату chat_id с учетом лимитов. call — функция без аргументов,
+        возвращающая корутину Bot API; cost — сколько сообщений он отправляет (для альбомов — число файлов).
+        Сетевые ошибки повторяются, RetryAfter выжидается; остальные ошибки пробрасываются.
+        """
+        attempt = 0
+        while True:
+            pause = _paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            last = self._last_sent.get(chat_id)
+            if last is not None:
+                wait = last + self.chat_interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            # Корзина выдает за раз не больше capacity токенов, поэтому большую стоимость
+            # (пакет copy_messages до 100 сообщений) списываем частями
+            remaining = cost
+            while remaining > 0:
+                await self._bucket.acquire(cost=min(remaining, self._bucket.capacity))
+                remaining -= self._bucket.capacity
+            try:
+                result = await call()
+            except RetryAfter as e:
+                self._slow_down(_retry_after_seconds(e))
+                continue
+            except NetworkError as e:
+                # BadRequest — тоже NetworkError, но повтор его не исправит
+                attempt += 1
+                if isinstance(e, BadRequest) or attempt >= self.attempts:
+                    raise
+                await asyncio.sleep(backoff_delay(attempt, 1, 10))
+                continue
+            self._last_sent[chat_id] = time.monotonic()
+            self.requests += 1
+            self._speed_up()
+            return result
+
+    def _slow_down(self, seconds: float):
+        global _paused_until
+        self.retry_after += 1
+        _paused_until = max(_paused_until, time.monotonic() + seconds)
+        self._bucket.set_rate(max(self.min_rate, self._bucket.rate / 2))
+        log.warning(
+            f"Рассылка '{self.name}': Telegram просит подождать {seconds:.0f} с, "
+            f"скорость снижена до {self._bucket.rate:.1f} сообщ./с"
+        )
+
+    def _speed_up(self):
+        if self._bucket.rate < self.max_rate:
+            self._bucket.set_rate(min(self.max_rate, self._bucket.rate + self.max_rate / 50))
+
+    async def run(self, recipients, deliver, on_result=None) -> dict:
+        """
+        Рассылает всем получателям из recipients (асинхронный итератор ID чатов).
+        deliver(broadcast, chat_id) отправляет получателю все сообщения через broadcast.send;
+        on_result(chat_id, error) вызывается после каждого получателя (error — None при успехе).
+        Получатели читаются по мере отправки, поэтому память не зависит от их количества.
+        """
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        self.started = time.monotonic()
+
+        async def produce():
+            async for chat_id in recipients:
+                await queue.put(chat_id)
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+        async def work():
+            while (chat_id := await queue.get()) is not None:
+                error = None
+                try:
+                    await deliver(self, chat_id)
+                except Exception as e:
+                    error = e
+                finally:
+                    self._last_sent.pop(chat_id, None)
+                if error is None:
+                    self.delivered += 1
+                else:
+                    self.failed += 1
+                    self.unreachable += is_unreachable_error(error)
+                if on_result:
+                    try:
+                        await on_result(chat_id, error)
+                    except Exception as e:
+                        log.error(f"Рассылка '{self.name}': ошибка обработки результата для {chat_id}: {e}")
+
+        workers = [asyncio.create_task(work()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(produce(), *workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.finished = time.monotonic()
+        return self.stats()
+
+    def stats(self) -> dict:
+        elapsed = ((self.finished or time.monotonic()) - self.started) if self.started else 0.0
+        return {
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'unreachable': self.unreachable,
+            'requests': self.requests,
+            'retry_after': self.retry_after,
+            'rate': round(self._bucket.rate, 1),
+            'elapsed': round(elapsed, 1),
+            'requests_per_second': round(self.requests / elapsed, 1) if elapsed else 0.0,
+        }
@@ -1,9 +1,12 @@
 import sqlite3
 import os
-import asyncio
-import aiosqlite
+import json
+import threading
 import logging
+from collections import OrderedDict
+from datetime import datetime
 from logger import logger
+from executors import BoundedExecutor
 
 log = logger.get_logger('database')
 
@@ -24,227 +27,820 @@ DB_PATH = os.path.join(DB_FOLDER, DB_NAME)
 # На сервере она должна быть смонтирована, локально — будет создана.
 os.makedirs(DB_FOLDER, exist_ok=True)
 
-def _initialize_db_sync():
-    """Синхронная функция для инициализации БД (для run_in_executor)."""
-    print(f"!!! АБСОЛЮТНЫЙ ПУТЬ К БАЗЕ ДАННЫХ: {os.path.abspath(DB_PATH)} !!!")
-    conn = sqlite3.connect(DB_PATH, timeout=15)
+# Все синхронные запросы к SQLite выполняются в собственном пуле потоков, а не в общем пуле
+# asyncio.to_thread, чтобы медленные вызовы других сервисов не задерживали работу с БД.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+db_executor = BoundedExecutor("sqlite", DB_POOL_SIZE)
+
+# Каждый поток пула держит одно долгоживущее соединение (открывается при первом запросе потока),
+# поэтому соединение не открывается заново на каждый вызов, а разобранные запросы остаются в его кэше.
+# База работает в режиме WAL: чтение идет параллельно с записью, а synchronous=NORMAL
+# не делает fsync на каждый commit.
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "256"))
+_local = threading.local()
+_connections = set()
+_connections_lock = threading.Lock()
+# Увеличивается при close_db: соединения потоков прошлого поколения открываются заново
+_generation = 0
+
+# Колонки таблицы tickets. Порядок совпадает с порядком столбцов в Google Sheets.
+TICKET_COLUMNS = (
+    "number", "status", "priority", "user_id", "type", "fio", "username", "platform", "message", "photo_id",
+    "created_at", "taken_at",
+    "transfer_l2_at", "transfer_l3_at",
+    "duration_l1", "duration_l2", "duration_l3",
+    "closed_at", "resolution_time", "sla_deadline", "sla_compliance", "sla_notified",
+    "topic_id",
+    "ticket_url",
+)
+
+def _open_connection(path: str) -> sqlite3.Connection:
+    # Соединение используется только своим потоком, но закрывается при остановке из другого
+    conn = sqlite3.connect(path, timeout=15, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with _connections_lock:
+        _connections.add(conn)
+    return conn
+
+def _connection() -> sqlite3.Connection:
+    """Долгоживущее соединение текущего потока с DB_PATH."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.path == DB_PATH and _local.generation == _generation:
+        return conn
+    if conn is not None and _local.generation == _generation:
+        # Путь к базе изменился (тесты, бенчмарки): старое соединение больше не нужно
+        with _connections_lock:
+            _connections.discard(conn)
+        conn.close()
+    conn = _open_connection(DB_PATH)
+    _local.conn, _local.path, _local.generation = conn, DB_PATH, _generation
+    return conn
+
+def _dict_cursor(conn: sqlite3.Connection) -> sqlite3.Cursor:
+    """Курсор, строки которого можно преобразовать в dict."""
     cursor = conn.cursor()
-    
-    # Создаем таблицу, если она не существует
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            fio TEXT
-        )
-    ''')
-    
-    # Проверяем, существует ли колонка fio, и добавляем ее, если нет
-    cursor.execute("PRAGMA table_info(users)")
-    columns = [column[1] for column in cursor.fetchall()]
-    if 'fio' not in columns:
-        cursor.execute('ALTER TABLE users ADD COLUMN fio TEXT')
-    if 'username' not in columns:
-        cursor.execute('ALTER TABLE users ADD COLUMN username TEXT')
+    cursor.row_factory = sqlite3.Row
+    return cursor
 
-    conn.commit()
-    conn.close()
+def _close_db_sync():
+    global _generation
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+        _generation += 1
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            log.warning(f"Ошибка при закрытии соединения с БД: {e}")
 
-async def initialize_db():
-    """Инициализирует базу данных и создает таблицы, если они не существуют."""
-    db_dir = os.path.dirname(DB_PATH)
-    if not os.path.exists(db_dir):
-        os.makedirs(db_dir)
-        print(f"!!! СОЗДАНА ДИРЕКТОРИЯ ДЛЯ БАЗЫ ДАННЫХ: {db_dir} !!!")
-    
-    print(f"!!! АБСОЛЮТНЫЙ ПУТЬ К БАЗЕ ДАННЫХ: {os.path.abspath(DB_PATH)} !!!")
-    
-    conn = await aiosqlite.connect(DB_PATH)
-    try:
-        await conn.execute('''
+async def close_db():
+    """Закрывает соединения с БД всех потоков; вызывается при остановке бота."""
+    await db_executor.run(_close_db_sync)
+    log.info("Соединения с базой данных закрыты.")
+
+def _initialize_db_sync():
+    """Синхронно создает таблицы и добавляет недостающие колонки в старые БД."""
+    conn = _connection()
+    with conn:
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 fio TEXT,
-                username TEXT
+                username TEXT,
+                unreachable_at TEXT
             )
         ''')
-        
-        await conn.execute('''
+        # Проверяем, существуют ли колонки fio и username, и добавляем их, если нет
+        columns = [column[1] for column in conn.execute("PRAGMA table_info(users)").fetchall()]
+        if 'fio' not in columns:
+            conn.execute('ALTER TABLE users ADD COLUMN fio TEXT')
+        if 'username' not in columns:
+            conn.execute('ALTER TABLE users ADD COLUMN username TEXT')
+        # Когда выяснилось, что пользователь недоступен (заблокировал бота); NULL — доступен
+        if 'unreachable_at' not in columns:
+            conn.execute('ALTER TABLE users ADD COLUMN unreachable_at TEXT')
+
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS topics (
                 key TEXT PRIMARY KEY,
                 thread_id INTEGER
             )
         ''')
 
-        await conn.execute('''
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS settings (
                 key TEXT PRIMARY KEY,
                 value TEXT
             )
         ''')
-        
-        await conn.commit()
-    finally:
-        await conn.close()
 
-def _get_or_create_user_sync(user_id: int) -> str | None:
-    conn = sqlite3.connect(DB_PATH, timeout=15)
-    cursor = conn.cursor()
+        # Тикеты: основное хранилище состояния обращений.
+        # Google Sheets — только зеркало для отчетности (см. sheet_outbox).
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tickets (
+                number INTEGER PRIMARY KEY,
+                status TEXT,
+                priority TEXT,
+                user_id INTEGER,
+                type TEXT,
+                fio TEXT,
+                username TEXT,
+                platform TEXT,
+                message TEXT,
+                photo_id TEXT,
+                created_at TEXT,
+                taken_at TEXT,
+                transfer_l2_at TEXT,
+                transfer_l3_at TEXT,
+                duration_l1 TEXT,
+                duration_l2 TEXT,
+                duration_l3 TEXT,
+                closed_at TEXT,
+                resolution_time TEXT,
+                sla_deadline TEXT,
+                sla_compliance TEXT,
+                sla_notified TEXT,
+                topic_id INTEGER,
+                ticket_url TEXT,
+                sheet_row INTEGER,
+                archive_sheet TEXT
+            )
+        ''')
+        # Номер строки тикета в Google Sheets (из ответа на append) и лист архива,
+        # куда перенесен закрытый тикет; добавляем в старые БД
+        ticket_columns = [column[1] for column in conn.execute("PRAGMA table_info(tickets)").fetchall()]
+        if 'sheet_row' not in ticket_columns:
+            conn.execute('ALTER TABLE tickets ADD COLUMN sheet_row INTEGER')
+        if 'archive_sheet' not in ticket_columns:
+            conn.execute('ALTER TABLE tickets ADD COLUMN archive_sheet TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tickets_topic_id ON tickets (topic_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tickets_user_status ON tickets (user_id, status)')
+
+        # Очередь изменений тикетов, которые еще не выгружены в Google Sheets
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sheet_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                number INTEGER NOT NULL,
+                op TEXT NOT NULL,
+                fields TEXT
+            )
+        ''')
+
+        # Рассылки: задание с содержимым и итогами и журнал доставки каждому получателю.
+        # По журналу прерванная рассылка продолжается после перезапуска с недоставленных получателей.
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                chat_id INTEGER,
+                status TEXT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                delivered INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                unreachable INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT,
+                finished_at TEXT
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                job_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                error TEXT,
+                updated_at TEXT,
+                PRIMARY KEY (job_id, user_id)
+            ) WITHOUT ROWID
+        ''')
 
-    # Добавляем пользователя, игнорируя, если он уже существует
-    cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+async def initialize_db():
+    """Инициализирует базу данных и создает таблицы, если они не существуют."""
+    db_dir = os.path.dirname(DB_PATH)
+    if not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+        print(f"!!! СОЗДАНА ДИРЕКТОРИЯ ДЛЯ БАЗЫ ДАННЫХ: {db_dir} !!!")
+    
+    print(f"!!! АБСОЛЮТНЫЙ ПУТЬ К БАЗЕ ДАННЫХ: {os.path.abspath(DB_PATH)} !!!")
+    await db_executor.run(_initialize_db_sync)
+
+class _ProfileCache:
+    """
+    LRU-кэш профилей пользователей (ФИО и логин) на capacity записей.
+    Запись идет сквозная: сначала в БД, затем в кэш. Отсутствие пользователя тоже кэшируется (None).
+    Используется только из цикла событий, поэтому без блокировок.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._profiles = OrderedDict()  # user_id -> {'fio': ..., 'username': ...} или None
+        # Счетчик записей: загрузка из БД, во время которой была запись, в кэш не попадает
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int):
+        """Возвращает (найден ли в кэше, профиль или None)."""
+        if user_id in self._profiles:
+            self._profiles.move_to_end(user_id)
+            self.hits += 1
+            return True, self._profiles[user_id]
+        self.misses += 1
+        return False, None
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def store(self, user_id: int, profile: dict | None, version: int | None = None):
+        """Сохраняет профиль, прочитанный из БД; version — значение self.version до чтения."""
+        if version is not None and version != self._version:
+            return
+        self._profiles[user_id] = profile
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.capacity:
+            self._profiles.popitem(last=False)
+
+    def update(self, user_id: int, **fields):
+        """Применяет записанные в БД поля к профилю, если он в кэше."""
+        self._version += 1
+        profile = self._profiles.get(user_id)
+        if profile is not None:
+            profile.update(fields)
+
+    def delete(self, user_id: int):
+        self._version += 1
+        self.store(user_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._profiles),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total * 100, 1) if total else 0.0,
+        }
+
+# Профили пользователей читаются на каждое сообщение, поэтому держим последние PROFILE_CACHE_SIZE в памяти
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+_profile_cache = _ProfileCache(PROFILE_CACHE_SIZE)
 
-    # Получаем ФИО
-    cursor.execute("SELECT fio FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
+def get_profile_cache_stats() -> dict:
+    """Размер кэша профилей пользователей и количество попаданий и промахов."""
+    return _profile_cache.stats()
 
-    conn.commit()
-    conn.close()
+def _profile_from_row(row) -> dict | None:
+    return {'fio': row[0] or None, 'username': row[1] or None, 'unreachable': row[2] is not None} if row else None
 
-    if result and result[0]:
-        return result[0]
-    return None
+def _get_profile_sync(user_id: int) -> dict | None:
+    """Синхронно получает ФИО, логин и доступность пользователя; None, если пользователя нет."""
+    row = _connection().execute("SELECT fio, username, unreachable_at FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    return _profile_from_row(row)
+
+async def _get_profile(user_id: int) -> dict | None:
+    found, profile = _profile_cache.get(user_id)
+    if not found:
+        version = _profile_cache.version
+        profile = await db_executor.run(_get_profile_sync, user_id)
+        _profile_cache.store(user_id, profile, version)
+    return profile
+
+def _get_or_create_user_sync(user_id: int) -> dict:
+    conn = _connection()
+    with conn:
+        # Добавляем пользователя, игнорируя, если он уже существует
+        conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        # Получаем ФИО и логин
+        row = conn.execute("SELECT fio, username, unreachable_at FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    return _profile_from_row(row)
 
 async def get_or_create_user(user_id: int) -> str | None:
     """Асинхронно получает ФИО пользователя или создает нового, если его нет."""
-    return await asyncio.to_thread(_get_or_create_user_sync, user_id)
+    found, profile = _profile_cache.get(user_id)
+    if not found or profile is None:
+        version = _profile_cache.version
+        profile = await db_executor.run(_get_or_create_user_sync, user_id)
+        _profile_cache.store(user_id, profile, version)
+        # Создание пользователя — тоже запись: параллельные чтения, заставшие «пользователя нет», не сохранятся
+        _profile_cache.update(user_id)
+    return profile['fio']
 
 def _set_user_fio_sync(user_id: int, fio: str):
-    conn = sqlite3.connect(DB_PATH, timeout=15)
-    cursor = conn.cursor()
-    
-    cursor.execute("UPDATE users SET fio = ? WHERE user_id = ?", (fio, user_id))
-    
-    conn.commit()
-    conn.close()
+    conn = _connection()
+    with conn:
+        conn.execute("UPDATE users SET fio = ? WHERE user_id = ?", (fio, user_id))
 
 async def set_user_fio(user_id: int, fio: str):
     """Асинхронно устанавливает или обновляет ФИО для пользователя."""
-    await asyncio.to_thread(_set_user_fio_sync, user_id, fio)
-
-def _get_user_fio_sync(user_id: int) -> str | None:
-    """Синхронно получает ФИО пользователя из БД."""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT fio FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result and result[0] else None
+    await db_executor.run(_set_user_fio_sync, user_id, fio)
+    _profile_cache.update(user_id, fio=fio or None)
 
 async def get_user_fio(user_id: int) -> str | None:
-    """Асинхронно получает ФИО пользователя из БД."""
-    return await asyncio.to_thread(_get_user_fio_sync, user_id)
+    """Асинхронно получает ФИО пользователя (из кэша профилей или из БД)."""
+    profile = await _get_profile(user_id)
+    return profile['fio'] if profile else None
 
-def _get_all_users_sync():
-    conn = sqlite3.connect(DB_PATH, timeout=15)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT user_id FROM users")
-    # Преобразуем список кортежей [(id1,), (id2,)] в простой список [id1, id2]
-    users = [row[0] for row in cursor.fetchall()]
-    
-    conn.close()
-    return users
+# Сколько получателей рассылки читается из журнала доставки за один запрос (iter_pending_deliveries)
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "500"))
 
-async def get_all_users():
-    """Асинхронно возвращает список всех ID пользователей из базы данных."""
-    return await asyncio.to_thread(_get_all_users_sync)
+def _users_filter(exclude_ids, reachable_only: bool) -> tuple[list[str], list]:
+    """Условия отбора пользователей для рассылок: без exclude_ids, при reachable_only — без отмеченных недоступными."""
+    conditions, params = [], []
+    if reachable_only:
+        conditions.append("unreachable_at IS NULL")
+    if exclude_ids:
+        conditions.append(f"user_id NOT IN ({', '.join('?' for _ in exclude_ids)})")
+        params += list(exclude_ids)
+    return conditions, params
+
+def _count_users_sync(exclude_ids: tuple, reachable_only: bool) -> int:
+    conditions, params = _users_filter(exclude_ids, reachable_only)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return _connection().execute(f"SELECT COUNT(*) FROM users{where}", params).fetchone()[0]
+
+async def count_users(exclude_ids=(), reachable_only: bool = True) -> int:
+    """Асинхронно считает пользователей с теми же фильтрами, по которым create_broadcast_job выбирает получателей."""
+    return await db_executor.run(_count_users_sync, tuple(exclude_ids), reachable_only)
 
 def _delete_user_sync(user_id: int):
     """Синхронно удаляет пользователя из БД."""
-    conn = sqlite3.connect(DB_PATH, timeout=15)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    conn = _connection()
+    with conn:
+        conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
 
 async def delete_user(user_id: int):
     """Асинхронно удаляет пользователя из базы данных."""
-    await asyncio.to_thread(_delete_user_sync, user_id)
+    await db_executor.run(_delete_user_sync, user_id)
+    _profile_cache.delete(user_id)
 
 def _set_user_username_sync(user_id: int, username: str):
-    conn = sqlite3.connect(DB_PATH, timeout=15)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user_id))
-    conn.commit()
-    conn.close()
+    conn = _connection()
+    with conn:
+        conn.execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user_id))
 
 async def set_user_username(user_id: int, username: str):
-    await asyncio.to_thread(_set_user_username_sync, user_id, username)
-
-def _get_user_username_sync(user_id: int) -> str | None:
-    conn = sqlite3.connect(DB_PATH, timeout=15)
-    cursor = conn.cursor()
-    cursor.execute("SELECT username FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    if result and result[0]:
-        return result[0]
-    return None
+    await db_executor.run(_set_user_username_sync, user_id, username)
+    _profile_cache.update(user_id, username=username or None)
 
 async def get_user_username(user_id: int) -> str | None:
-    return await asyncio.to_thread(_get_user_username_sync, user_id) 
+    profile = await _get_profile(user_id)
+    return profile['username'] if profile else None
+
+def _set_user_unreachable_sync(user_id: int, unreachable_at: str | None):
+    conn = _connection()
+    with conn:
+        conn.execute("UPDATE users SET unreachable_at = ? WHERE user_id = ?", (unreachable_at, user_id))
+
+async def mark_user_unreachable(user_id: int):
+    """Отмечает пользователя недоступным (заблокировал бота или удалил чат): рассылки его пропускают."""
+    await db_executor.run(_set_user_unreachable_sync, user_id, datetime.now().isoformat(timespec="seconds"))
+    _profile_cache.update(user_id, unreachable=True)
+    log.info(f"Пользователь {user_id} отмечен недоступным, рассылки будут его пропускать.")
+
+async def mark_user_reachable(user_id: int):
+    """Снимает отметку недоступности, когда пользователь снова пишет боту. Без отметки в БД не пишет."""
+    profile = await _get_profile(user_id)
+    if profile and profile['unreachable']:
+        await db_executor.run(_set_user_unreachable_sync, user_id, None)
+        _profile_cache.update(user_id, unreachable=False)
+        log.info(f"Пользователь {user_id} снова доступен для рассылок.")
+
+def _set_topic_id_sync(topic_key: str, thread_id: int):
+    conn = _connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO topics (key, thread_id) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET thread_id = excluded.thread_id",
+            (topic_key, thread_id)
+        )
 
 async def set_topic_id(topic_key: str, thread_id: int):
     """Сохраняет или обновляет thread_id для системного топика."""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute(
-                "INSERT INTO topics (key, thread_id) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET thread_id = excluded.thread_id",
-                (topic_key, thread_id)
-            )
-            await conn.commit()
-            log.info(f"ID топика для '{topic_key}' сохранен/обновлен: {thread_id}")
-    except aiosqlite.Error as e:
+        await db_executor.run(_set_topic_id_sync, topic_key, thread_id)
+        log.info(f"ID топика для '{topic_key}' сохранен/обновлен: {thread_id}")
+    except sqlite3.Error as e:
         log.error(f"Ошибка при сохранении ID топика '{topic_key}': {e}")
 
+def _get_all_topic_ids_sync() -> list:
+    return _connection().execute("SELECT key, thread_id FROM topics").fetchall()
+
 async def get_all_topic_ids() -> dict:
     """Возвращает словарь со всеми сохраненными ID топиков."""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT key, thread_id FROM topics")
-            rows = await cursor.fetchall()
-            log.info(f"Загружено {len(rows)} ID системных топиков из БД.")
-            return {row[0]: row[1] for row in rows}
-    except aiosqlite.Error as e:
+        rows = await db_executor.run(_get_all_topic_ids_sync)
+        log.info(f"Загружено {len(rows)} ID системных топиков из БД.")
+        return {row[0]: row[1] for row in rows}
+    except sqlite3.Error as e:
         log.error(f"Ошибка при загрузке ID топиков из БД: {e}")
         return {} 
 
+def _delete_all_topics_sync():
+    conn = _connection()
+    with conn:
+        conn.execute('DROP TABLE IF EXISTS topics')
+
 async def delete_all_topics() -> None:
     """Удаляет таблицу топиков из базы данных, если она существует."""
-    conn = await aiosqlite.connect(DB_PATH)
     try:
-        await conn.execute('DROP TABLE IF EXISTS topics')
-        await conn.commit()
+        await db_executor.run(_delete_all_topics_sync)
         log.info("Таблица 'topics' успешно удалена.")
     except Exception as e:
         log.error(f"Ошибка при удалении таблицы 'topics': {e}")
-    finally:
-        await conn.close() 
+
+def _set_setting_sync(key: str, value: str):
+    conn = _connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
 
 async def set_setting(key: str, value: str):
     """Сохраняет или обновляет значение для указанного ключа в настройках."""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute(
-                "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
-                (key, str(value))  # Убедимся, что значение всегда строка
-            )
-            await conn.commit()
-            log.info(f"Настройка '{key}' сохранена/обновлена: {value}")
-    except aiosqlite.Error as e:
+        # Убедимся, что значение всегда строка
+        await db_executor.run(_set_setting_sync, key, str(value))
+        log.info(f"Настройка '{key}' сохранена/обновлена: {value}")
+    except sqlite3.Error as e:
         log.error(f"Ошибка при сохранении настройки '{key}': {e}")
 
+def _get_setting_sync(key: str):
+    return _connection().execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+
 async def get_setting(key: str) -> str | None:
     """Возвращает значение для указанного ключа из настроек."""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT value FROM settings WHERE key = ?", (key,))
-            row = await cursor.fetchone()
-            if row:
-                log.info(f"Загружена настройка '{key}': {row[0]}")
-                return row[0]
-            else:
-                log.info(f"Настройка '{key}' не найдена в БД.")
-                return None
-    except aiosqlite.Error as e:
+        row = await db_executor.run(_get_setting_sync, key)
+        if row:
+            log.info(f"Загружена настройка '{key}': {row[0]}")
+            return row[0]
+        else:
+            log.info(f"Настройка '{key}' не найдена в БД.")
+            return None
+    except sqlite3.Error as e:
         log.error(f"Ошибка при загрузке настройки '{key}' из БД: {e}")
-        return None 
\ No newline at end of file
+        return None
+
+def _ticket_from_row(row: sqlite3.Row | None) -> dict | None:
+    return dict(row) if row else None
+
+def _create_ticket_sync(fields: dict) -> int:
+    """Синхронно создает тикет и ставит его выгрузку в очередь для Google Sheets."""
+    columns = [column for column in TICKET_COLUMNS if column != "number" and column in fields]
+    placeholders = ", ".join("?" for _ in columns)
+    conn = _connection()
+    with conn:
+        # number — INTEGER PRIMARY KEY, поэтому SQLite сам выдает следующий номер (max + 1)
+        cursor = conn.execute(
+            f"INSERT INTO tickets ({', '.join(columns)}) VALUES ({placeholders})",
+            [fields[column] for column in columns]
+        )
+        number = cursor.lastrowid
+        conn.execute("INSERT INTO sheet_outbox (number, op) VALUES (?, 'append')", (number,))
+    return number
+
+async def create_ticket(fields: dict) -> int:
+    """Асинхронно создает тикет и возвращает его номер."""
+    return await db_executor.run(_create_ticket_sync, fields)
+
+def _update_ticket_sync(number: int, fields: dict) -> bool:
+    """Синхронно обновляет поля тикета и ставит изменения в очередь для Google Sheets."""
+    columns = [column for column in fields if column in TICKET_COLUMNS and column != "number"]
+    if not columns:
+        return False
+    assignments = ", ".join(f"{column} = ?" for column in columns)
+    conn = _connection()
+    with conn:
+        cursor = conn.execute(
+            f"UPDATE tickets SET {assignments} WHERE number = ?",
+            [fields[column] for column in columns] + [number]
+        )
+        if cursor.rowcount == 0:
+            return False
+        conn.execute(
+            "INSERT INTO sheet_outbox (number, op, fields) VALUES (?, 'update', ?)",
+            (number, json.dumps(columns))
+        )
+    return True
+
+async def update_ticket(number: int, fields: dict) -> bool:
+    """Асинхронно обновляет поля тикета. Возвращает False, если тикет не найден."""
+    return await db_executor.run(_update_ticket_sync, number, fields)
+
+def _get_ticket_sync(number: int) -> dict | None:
+    """Синхронно получает тикет по номеру."""
+    cursor = _dict_cursor(_connection()).execute("SELECT * FROM tickets WHERE number = ?", (number,))
+    return _ticket_from_row(cursor.fetchone())
+
+async def get_ticket(number: int) -> dict | None:
+    """Асинхронно получает тикет по номеру."""
+    return await db_executor.run(_get_ticket_sync, number)
+
+def _get_ticket_by_topic_id_sync(topic_id: int) -> dict | None:
+    """Синхронно получает тикет по ID топика."""
+    cursor = _dict_cursor(_connection()).execute(
+        "SELECT * FROM tickets WHERE topic_id = ? ORDER BY number DESC LIMIT 1", (topic_id,)
+    )
+    return _ticket_from_row(cursor.fetchone())
+
+def _get_user_tickets_sync(user_id: int) -> list[dict]:
+    """Синхронно получает все тикеты пользователя, начиная с последнего."""
+    cursor = _dict_cursor(_connection()).execute(
+        "SELECT * FROM tickets WHERE user_id = ? ORDER BY number DESC", (user_id,)
+    )
+    return [dict(row) for row in cursor.fetchall()]
+
+def _get_tickets_sync(numbers: list[int] | None = None, active_only: bool = False) -> list[dict]:
+    """
+    Синхронно получает тикеты по списку номеров (или все, если список не передан).
+    active_only — без тикетов, перенесенных в архив.
+    """
+    cursor = _dict_cursor(_connection())
+    if numbers is None:
+        where = "WHERE archive_sheet IS NULL " if active_only else ""
+        cursor.execute(f"SELECT * FROM tickets {where}ORDER BY number")
+    else:
+        if not numbers:
+            return []
+        placeholders = ", ".join("?" for _ in numbers)
+        cursor.execute(f"SELECT * FROM tickets WHERE number IN ({placeholders}) ORDER BY number", list(numbers))
+    return [dict(row) for row in cursor.fetchall()]
+
+async def get_tickets(numbers: list[int] | None = None, active_only: bool = False) -> list[dict]:
+    """Асинхронно получает тикеты по списку номеров (или все тикеты)."""
+    return await db_executor.run(_get_tickets_sync, numbers, active_only)
+
+def _get_ticket_columns_sync(fields: tuple, active_only: bool = True) -> list[tuple]:
+    """
+    Синхронно читает только указанные поля всех тикетов и возвращает кортежи в порядке fields.
+    Для сканирований, которым не нужны все столбцы (в том числе текст обращения).
+    """
+    unknown = [field for field in fields if field not in TICKET_COLUMNS]
+    if unknown:
+        raise ValueError(f"Неизвестные поля тикета: {', '.join(unknown)}")
+    where = "WHERE archive_sheet IS NULL " if active_only else ""
+    return _connection().execute(f"SELECT {', '.join(fields)} FROM tickets {where}ORDER BY number").fetchall()
+
+async def get_ticket_columns(fields: tuple, active_only: bool = True) -> list[tuple]:
+    """Асинхронно читает только указанные поля тикетов (кортежи в порядке fields)."""
+    return await db_executor.run(_get_ticket_columns_sync, tuple(fields), active_only)
+
+def _count_tickets_sync() -> int:
+    return _connection().execute("SELECT COUNT(*) FROM tickets").fetchone()[0]
+
+async def count_tickets() -> int:
+    """Асинхронно возвращает количество тикетов в локальном хранилище."""
+    return await db_executor.run(_count_tickets_sync)
+
+def _import_tickets_sync(tickets: list[dict]) -> int:
+    """Синхронно импортирует уже существующие в Google Sheets тикеты (без постановки в очередь выгрузки)."""
+    conn = _connection()
+    imported = 0
+    with conn:
+        for ticket in tickets:
+            columns = [column for column in TICKET_COLUMNS + ("sheet_row", "archive_sheet") if column in ticket]
+            placeholders = ", ".join("?" for _ in columns)
+            cursor = conn.execute(
+                f"INSERT OR IGNORE INTO tickets ({', '.join(columns)}) VALUES ({placeholders})",
+                [ticket[column] for column in columns]
+            )
+            imported += cursor.rowcount
+    return imported
+
+async def import_tickets(tickets: list[dict]) -> int:
+    """Асинхронно импортирует тикеты из Google Sheets в локальное хранилище."""
+    return await db_executor.run(_import_tickets_sync, tickets)
+
+def _set_ticket_sheet_rows_sync(rows: dict[int, int]):
+    """Синхронно сохраняет номера строк Google Sheets для тикетов ({номер тикета: строка})."""
+    conn = _connection()
+    with conn:
+        conn.executemany("UPDATE tickets SET sheet_row = ? WHERE number = ?", [(row, number) for number, row in rows.items()])
+
+async def set_ticket_sheet_rows(rows: dict[int, int]):
+    """Асинхронно сохраняет номера строк Google Sheets для тикетов."""
+    await db_executor.run(_set_ticket_sheet_rows_sync, rows)
+
+def _get_closed_active_tickets_sync() -> list[dict]:
+    """Синхронно получает завершенные тикеты, еще не перенесенные в архив."""
+    cursor = _dict_cursor(_connection()).execute(
+        "SELECT * FROM tickets WHERE status = 'Завершено' AND archive_sheet IS NULL ORDER BY number"
+    )
+    return [dict(row) for row in cursor.fetchall()]
+
+async def get_closed_active_tickets() -> list[dict]:
+    """Асинхронно получает завершенные тикеты, еще не перенесенные в архив."""
+    return await db_executor.run(_get_closed_active_tickets_sync)
+
+def _set_tickets_archived_sync(archived: dict[int, tuple[str, int | None]]):
+    """Синхронно отмечает тикеты перенесенными в архив ({номер: (лист архива, строка в нем)})."""
+    conn = _connection()
+    with conn:
+        conn.executemany(
+            "UPDATE tickets SET archive_sheet = ?, sheet_row = ? WHERE number = ?",
+            [(sheet, row, number) for number, (sheet, row) in archived.items()]
+        )
+
+async def set_tickets_archived(archived: dict[int, tuple[str, int | None]]):
+    """Асинхронно отмечает тикеты перенесенными в архив."""
+    await db_executor.run(_set_tickets_archived_sync, archived)
+
+def _get_archived_numbers_sync(numbers: list[int]) -> set[int]:
+    """Синхронно возвращает те номера из списка, которые уже перенесены в архив."""
+    if not numbers:
+        return set()
+    conn = _connection()
+    archived = set()
+    # Ограничение SQLite на количество параметров в запросе
+    for start in range(0, len(numbers), 500):
+        chunk = list(numbers[start:start + 500])
+        placeholders = ", ".join("?" for _ in chunk)
+        cursor = conn.execute(
+            f"SELECT number FROM tickets WHERE archive_sheet IS NOT NULL AND number IN ({placeholders})", chunk
+        )
+        archived.update(row[0] for row in cursor.fetchall())
+    return archived
+
+async def get_archived_numbers(numbers: list[int]) -> set[int]:
+    """Асинхронно возвращает те номера из списка, которые уже перенесены в архив."""
+    return await db_executor.run(_get_archived_numbers_sync, numbers)
+
+def _get_sheet_ops_sync(limit: int, after_id: int = 0) -> list[dict]:
+    """Синхронно получает из очереди изменения, ожидающие выгрузки в Google Sheets (с id больше after_id)."""
+    cursor = _connection().execute(
+        "SELECT id, number, op, fields FROM sheet_outbox WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)
+    )
+    return [
+        {'id': row[0], 'number': row[1], 'op': row[2], 'fields': json.loads(row[3]) if row[3] else []}
+        for row in cursor.fetchall()
+    ]
+
+async def get_sheet_ops(limit: int = 500, after_id: int = 0) -> list[dict]:
+    """Асинхронно получает изменения, ожидающие выгрузки в Google Sheets."""
+    return await db_executor.run(_get_sheet_ops_sync, limit, after_id)
+
+def _delete_sheet_ops_sync(op_ids: list[int]):
+    if not op_ids:
+        return
+    placeholders = ", ".join("?" for _ in op_ids)
+    conn = _connection()
+    with conn:
+        conn.execute(f"DELETE FROM sheet_outbox WHERE id IN ({placeholders})", list(op_ids))
+
+async def delete_sheet_ops(op_ids: list[int]):
+    """Асинхронно удаляет из очереди изменения, успешно выгруженные в Google Sheets."""
+    await db_executor.run(_delete_sheet_ops_sync, op_ids)
+
+def _count_sheet_ops_sync() -> int:
+    return _connection().execute("SELECT COUNT(*) FROM sheet_outbox").fetchone()[0]
+
+async def count_sheet_ops() -> int:
+    """Асинхронно возвращает количество изменений, еще не выгруженных в Google Sheets."""
+    return await db_executor.run(_count_sheet_ops_sync)
+
+# --- Задания рассылок ---
+# Статусы задания: running — идет или прервана перезапуском, finished — все получатели обработаны,
+# cancelled — остановлена администратором (оставшиеся получатели ждут /broadcast_retry).
+# Статусы получателя: pending — еще не отправлено, delivered, failed, unreachable (заблокировал бота).
+
+def _job_from_row(row: sqlite3.Row | None) -> dict | None:
+    if row is None:
+        return None
+    job = dict(row)
+    job['payload'] = json.loads(job['payload'])
+    return job
+
+def _create_broadcast_job_sync(kind: str, payload: dict, chat_id: int, exclude_ids: tuple) -> int:
+    conditions, params = _users_filter(exclude_ids, reachable_only=True)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    now = datetime.now().isoformat(timespec="seconds")
+    conn = _connection()
+    with conn:
+        job_id = conn.execute(
+            "INSERT INTO broadcast_jobs (kind, payload, chat_id, status, created_at) VALUES (?, ?, ?, 'running', ?)",
+            (kind, json.dumps(payload, ensure_ascii=False), chat_id, now)
+        ).lastrowid
+        # Получатели фиксируются при создании: зарегистрировавшиеся позже в задание не попадают
+        total = conn.execute(
+            f"INSERT INTO broadcast_deliveries (job_id, user_id) SELECT ?, user_id FROM users{where}",
+            [job_id] + params
+        ).rowcount
+        conn.execute("UPDATE broadcast_jobs SET total = ? WHERE id = ?", (total, job_id))
+    return job_id
+
+async def create_broadcast_job(kind: str, payload: dict, chat_id: int, exclude_ids=()) -> int:
+    """
+    Создает задание рассылки и журнал доставки на всех доступных пользователей, кроме exclude_ids.
+    payload — содержимое рассылки (JSON), chat_id — куда сообщать о ходе рассылки. Возвращает ID задания.
+    """
+    return await db_executor.run(_create_broadcast_job_sync, kind, payload, chat_id, tuple(exclude_ids))
+
+def _get_broadcast_job_sync(job_id: int) -> dict | None:
+    row = _dict_cursor(_connection()).execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+    return _job_from_row(row)
+
+async def get_broadcast_job(job_id: int) -> dict | None:
+    return await db_executor.run(_get_broadcast_job_sync, job_id)
+
+def _get_broadcast_jobs_sync(status: str | None, limit: int) -> list[dict]:
+    where = "WHERE status = ? " if status else ""
+    params = [status] if status else []
+    rows = _dict_cursor(_connection()).execute(
+        f"SELECT * FROM broadcast_jobs {where}ORDER BY id DESC LIMIT ?", params + [limit]
+    ).fetchall()
+    return [_job_from_row(row) for row in rows]
+
+async def get_broadcast_jobs(status: str | None = None, limit: int = 10) -> list[dict]:
+    """Последние задания рассылок (новые первыми), при status — только с этим статусом."""
+    return await db_executor.run(_get_broadcast_jobs_sync, status, limit)
+
+def _get_pending_deliveries_sync(job_id: int, after_id: int | None, limit: int) -> list[int]:
+    conditions, params = ["job_id = ?", "status = 'pending'"], [job_id]
+    if after_id is not None:
+        conditions.append("user_id > ?")
+        params.append(after_id)
+    cursor = _connection().execute(
+        f"SELECT user_id FROM broadcast_deliveries WHERE {' AND '.join(conditions)} ORDER BY user_id LIMIT ?",
+        params + [limit]
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+async def iter_pending_deliveries(job_id: int, page_size: int | None = None):
+    """
+    Асинхронный генератор получателей задания, которым еще не отправлено. Читает журнал страницами
+    по page_size (по умолчанию USERS_PAGE_SIZE), поэтому память не зависит от числа получателей.
+    """
+    page_size = page_size or USERS_PAGE_SIZE
+    after_id = None
+    while True:
+        page = await db_executor.run(_get_pending_deliveries_sync, job_id, after_id, page_size)
+        for user_id in page:
+            yield user_id
+        if len(page) < page_size:
+            return
+        after_id = page[-1]
+
+def _set_delivery_status_sync(job_id: int, user_id: int, status: str, error: str | None):
+    conn = _connection()
+    with conn:
+        conn.execute(
+            "UPDATE broadcast_deliveries SET status = ?, error = ?, updated_at = ? WHERE job_id = ? AND user_id = ?",
+            (status, error, datetime.now().isoformat(timespec="seconds"), job_id, user_id)
+        )
+
+async def set_delivery_status(job_id: int, user_id: int, status: str, error: str | None = None):
+    """Записывает в журнал результат отправки получателю: delivered, failed или unreachable."""
+    await db_executor.run(_set_delivery_status_sync, job_id, user_id, status, error)
+
+def _count_deliveries_sync(job_id: int) -> dict:
+    rows = _connection().execute(
+        "SELECT status, COUNT(*) FROM broadcast_deliveries WHERE job_id = ? GROUP BY status", (job_id,)
+    ).fetchall()
+    return dict(rows)
+
+async def count_deliveries(job_id: int) -> dict:
+    """Количество получателей задания по статусам: {'pending': ..., 'delivered': ..., ...}."""
+    return await db_executor.run(_count_deliveries_sync, job_id)
+
+def _finish_broadcast_job_sync(job_id: int, status: str) -> dict | None:
+    counts = _count_deliveries_sync(job_id)
+    conn = _connection()
+    with conn:
+        conn.execute(
+            "UPDATE broadcast_jobs SET status = ?, delivered = ?, failed = ?, unreachable = ?, finished_at = ? "
+            "WHERE id = ?",
+            (status, counts.get('delivered', 0), counts.get('failed', 0), counts.get('unreachable', 0),
+             datetime.now().isoformat(timespec="seconds"), job_id)
+        )
+    return _get_broadcast_job_sync(job_id)
+
+async def finish_broadcast_job(job_id: int, status: str = 'finished') -> dict | None:
+    """Завершает (или отменяет) задание и сохраняет итоги по журналу доставки. Возвращает задание с итогами."""
+    return await db_executor.run(_finish_broadcast_job_sync, job_id, status)
+
+def _retry_failed_deliveries_sync(job_id: int) -> int:
+    conn = _connection()
+    with conn:
+        # Пользователи, с тех пор отмеченные недоступными, не повторяются
+        conn.execute(
+            "UPDATE broadcast_deliveries SET status = 'pending', error = NULL WHERE job_id = ? AND status = 'failed' "
+            "AND user_id NOT IN (SELECT user_id FROM users WHERE unreachable_at IS NOT NULL)",
+            (job_id,)
+        )
+        # Вместе с возвращенными — получатели отмененного задания, до которых рассылка не дошла
+        count = conn.execute(
+            "SELECT COUNT(*) FROM broadcast_deliveries WHERE job_id = ? AND status = 'pending'", (job_id,)
+        ).fetchone()[0]
+        if count:
+            conn.execute("UPDATE broadcast_jobs SET status = 'running', finished_at = NULL WHERE id = ?", (job_id,))
+    return count
+
+async def retry_failed_deliveries(job_id: int) -> int:
+    """
+    Возвращает получателей с ошибкой отправки в очередь задания и снова открывает его.
+    Возвращает, скольким получателям осталось отправить (вместе с неотправленными в отмененном задании).
+    """
+    return await db_executor.run(_retry_failed_deliveries_sync, job_id)
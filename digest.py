@@ -0,0 +1,140 @@
+import functools
+import os
+from telegram import InputMediaDocument, InputMediaPhoto
+
+# Ограничения Telegram: длина одного сообщения и количество файлов в одном альбоме
+TEXT_LIMIT = 4096
+MEDIA_GROUP_LIMIT = 10
+# Сколько сообщений можно скопировать одним вызовом copy_messages
+COPY_MESSAGES_LIMIT = 100
+# Отправлять дайджест один раз в служебный топик чата администраторов и рассылать его копии
+# (copy_messages): один запрос на получателя вместо запроса на каждую часть текста и альбом
+DIGEST_VIA_STAGING = os.getenv("DIGEST_VIA_STAGING", "false").lower() in ("1", "true", "yes")
+# Вид альбома -> тип его файлов; порядок задает порядок альбомов в дайджесте
+MEDIA_TYPES = {"фото": InputMediaPhoto, "документы": InputMediaDocument}
+
+
+def _find_cut(text: str, limit: int) -> int:
+    """Позиция разреза не дальше limit: по абзацу, строке или слову и не внутри HTML-тега или сущности."""
+    cut = limit
+    for separator in ("\n\n", "\n", " "):
+        position = text.rfind(separator, 0, limit)
+        # Слишком короткие части хуже разреза посреди слова
+        if position > limit // 2:
+            cut = position
+            break
+    tag_start = text.rfind("<", 0, cut)
+    if tag_start > text.rfind(">", 0, cut) and tag_start > 0:
+        cut = tag_start
+    entity_start = text.rfind("&", 0, cut)
+    if entity_start > 0 and cut - entity_start <= 10 and ";" not in text[entity_start:cut]:
+        cut = entity_start
+    return cut
+
+
+def split_text(text: str, limit: int = TEXT_LIMIT) -> tuple[str, ...]:
+    """Делит текст на части не длиннее limit, по возможности по границам абзацев, строк и слов."""
+    chunks = []
+    while len(text) > limit:
+        cut = _find_cut(text, limit)
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return tuple(chunk for chunk in chunks if chunk)
+
+
+class DigestPlan:
+    """
+    Готовый план отправки дайджеста: части текста и альбомы по MEDIA_GROUP_LIMIT файлов.
+    Собирается один раз из digest_content_* и не меняется, а предпросмотр и каждый получатель
+    только воспроизводят его, не разбивая текст и не собирая альбомы заново.
+    План, выложенный в служебный чат (stage), рассылается копиями уже отправленных сообщений.
+    """
+
+    def __init__(self, text_chunks: tuple, media_groups: tuple, staged: tuple | None = None):
+        self.text_chunks = text_chunks
+        self.media_groups = media_groups  # ((описание, (InputMedia, ...)), ...)
+        self.staged = staged  # (ID служебного чата, ((ID сообщений, ...), ...)) или None
+
+    @classmethod
+    def compile(cls, text_items: list, photo_items: list, document_items: list) -> "DigestPlan":
+        text_chunks = split_text("\n\n".join(text_items)) if text_items else ()
+        media_groups = tuple(
+            (kind, tuple(MEDIA_TYPES[kind](media=item['file_id']) for item in items[i:i + MEDIA_GROUP_LIMIT]))
+            for kind, items in (("фото", photo_items), ("документы", document_items))
+            for i in range(0, len(items), MEDIA_GROUP_LIMIT)
+        )
+        return cls(text_chunks, media_groups)
+
+    def to_payload(self) -> dict:
+        """План в виде JSON-совместимого словаря для хранения в задании рассылки."""
+        return {
+            'text_chunks': list(self.text_chunks),
+            'media_groups': [[kind, [media.media for media in group]] for kind, group in self.media_groups],
+            'staged': [self.staged[0], [list(batch) for batch in self.staged[1]]] if self.staged else None,
+        }
+
+    @classmethod
+    def from_payload(cls, payload: dict) -> "DigestPlan":
+        """Восстанавливает план, сохраненный to_payload."""
+        return cls(
+            tuple(payload['text_chunks']),
+            tuple(
+                (kind, tuple(MEDIA_TYPES[kind](media=file_id) for file_id in file_ids))
+                for kind, file_ids in payload['media_groups']
+            ),
+            (staged[0], tuple(tuple(batch) for batch in staged[1])) if (staged := payload.get('staged')) else None,
+        )
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.text_chunks and not self.media_groups
+
+    @property
+    def request_count(self) -> int:
+        """Сколько запросов к Bot API нужно на одного получателя."""
+        if self.staged:
+            return len(self.staged[1])
+        return len(self.text_chunks) + len(self.media_groups)
+
+    def requests(self, bot, chat_id: int):
+        """
+        Запросы отправки дайджеста в chat_id по порядку: (описание, функция без аргументов,
+        возвращающая корутину Bot API, сколько сообщений она отправляет).
+        """
+        for chunk in self.text_chunks:
+            yield "текст", functools.partial(bot.send_message, chat_id, chunk), 1
+        for kind, group in self.media_groups:
+            call = functools.partial(bot.send_media_group, chat_id, group, read_timeout=20, write_timeout=20)
+            yield kind, call, len(group)
+
+    async def stage(self, broadcast, bot, chat_id: int, message_thread_id: int | None = None) -> "DigestPlan":
+        """
+        Отправляет дайджест один раз в служебный чат chat_id (топик message_thread_id) через broadcast.send
+        и возвращает план, который рассылает копии этих сообщений пакетами до COPY_MESSAGES_LIMIT.
+        Альбом целиком попадает в один пакет, поэтому при копировании остается альбомом.
+        """
+        batches, batch = [], []
+        for _, call, cost in self.requests(bot, chat_id):
+            sent = await broadcast.send(chat_id, functools.partial(call, message_thread_id=message_thread_id), cost=cost)
+            message_ids = [message.message_id for message in sent] if isinstance(sent, (tuple, list)) else [sent.message_id]
+            if len(batch) + len(message_ids) > COPY_MESSAGES_LIMIT:
+                batches.append(tuple(batch))
+                batch = []
+            batch += message_ids
+        if batch:
+            batches.append(tuple(batch))
+        return DigestPlan(self.text_chunks, self.media_groups, (chat_id, tuple(batches)))
+
+    async def deliver(self, broadcast, bot, chat_id: int):
+        """Отправляет дайджест получателю через broadcast.send; первая ошибка прерывает отправку."""
+        if self.staged:
+            from_chat_id, batches = self.staged
+            for message_ids in batches:
+                # Лимит Telegram считается по сообщениям, а не по запросам
+                call = functools.partial(bot.copy_messages, chat_id, from_chat_id, message_ids)
+                await broadcast.send(chat_id, call, cost=len(message_ids))
+            return
+        for _, call, cost in self.requests(bot, chat_id):
+            await broadcast.send(chat_id, call, cost=cost)
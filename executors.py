@@ -0,0 +1,90 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logger import logger
+
+log = logger.get_logger('executors')
+
+# Все созданные пулы по имени, для /stats
+_executors = {}
+
+
+class BoundedExecutor:
+    """
+    Пул потоков фиксированного размера для блокирующих вызовов одного вида (SQLite, Google Sheets).
+    У каждого вида свой пул, поэтому медленный внешний сервис не занимает потоки локальной БД.
+    Считает глубину очереди, время ожидания свободного потока и время выполнения вызовов.
+    """
+
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+        _executors[name] = self
+
+    def _invoke(self, submitted: float, func, args, kwargs):
+        started = time.monotonic()
+        waited = started - submitted
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        ok = False
+        try:
+            result = func(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+                self.failed += not ok
+                self.total_run += elapsed
+                self.max_run = max(self.max_run, elapsed)
+
+    def _on_done(self, future):
+        # Вызов, отмененный до начала выполнения, не дошел до _invoke и остался в счетчике очереди
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет func(*args, **kwargs) в потоке пула, как asyncio.to_thread."""
+        with self._lock:
+            self.queued += 1
+        context = contextvars.copy_context()
+        future = self._executor.submit(context.run, self._invoke, time.monotonic(), func, args, kwargs)
+        future.add_done_callback(self._on_done)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'active': self.active,
+                'queue_depth': self.queued,
+                'completed': self.completed,
+                'failed': self.failed,
+                'avg_wait_ms': round(self.total_wait / self.completed * 1000, 1) if self.completed else 0.0,
+                'max_wait_ms': round(self.max_wait * 1000, 1),
+                'avg_run_ms': round(self.total_run / self.completed * 1000, 1) if self.completed else 0.0,
+                'max_run_ms': round(self.max_run * 1000, 1),
+            }
+
+
+def get_executor_stats() -> dict:
+    """Метрики всех пулов потоков: {имя: stats()}."""
+    return {name: executor.stats() for name, executor in _executors.items()}
@@ -1,10 +1,32 @@
 import gspread
+import requests
+import google.auth.exceptions
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.service_account import Credentials
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote
+import httpx
+from datetime import datetime, timedelta, timezone
+import inspect
 import os
 import logging
 import asyncio
+import threading
+import re
+import time
+import heapq
+import bisect
+import itertools
 from logger import logger
+from rate_limiter import TokenBucket, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from resilience import CircuitBreaker, call_with_retry
+from executors import BoundedExecutor
+from database import (
+    TICKET_COLUMNS, create_ticket, update_ticket, get_ticket, get_tickets, import_tickets,
+    get_sheet_ops, delete_sheet_ops, count_sheet_ops, set_ticket_sheet_rows,
+    get_closed_active_tickets, set_tickets_archived, get_archived_numbers, get_ticket_columns,
+    _get_ticket_sync, _get_ticket_by_topic_id_sync, _get_user_tickets_sync, get_setting, set_setting,
+)
 
 log = logger.get_logger('g_sheets')
 
@@ -17,9 +39,22 @@ credentials_path = os.path.join(script_dir, "credentials.json")
 _worksheet_cache = None
 _worksheet_lock = asyncio.Lock()
 
-# Глобальный кэш для всех записей таблицы и лок для асинхронного доступа
-_tickets_cache = None
-_cache_lock = asyncio.Lock()
+# Номера столбцов по полям тикета (поле -> номер столбца с 1), строится по строке заголовков при подключении
+_column_map = None
+
+# Фоновая задача прогрева подключения к таблице при старте бота
+_warmup_task = None
+
+# Архив: завершенные больше ARCHIVE_AFTER_DAYS дней назад тикеты раз в ARCHIVE_INTERVAL секунд
+# переносятся с основного листа на листы «Архив ГГГГ-ММ» по месяцу закрытия (0 — не архивировать).
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_SHEET_PREFIX = "Архив "
+
+# Сколько секунд список всех тикетов (get_all_tickets) считается свежим.
+# Устаревший список отдается сразу, а обновление выполняется в фоне.
+TICKETS_CACHE_TTL = float(os.getenv("TICKETS_CACHE_TTL", "60"))
 
 # Словарь с часами на решение по каждому уровню приоритета.
 # Вы можете изменить эти значения при необходимости.
@@ -30,6 +65,272 @@ SLA_HOURS = {
     'Низкий': 168 
 }
 
+# Формат дат, в котором время хранится в тикетах и в таблице
+TIME_FORMAT = "%H:%M:%S %d.%m.%Y"
+
+# Заголовки таблицы. Порядок совпадает с колонками tickets в database.TICKET_COLUMNS.
+HEADERS = [
+    "Номер", "Статус обращения", "Приоритет", "ID Пользователя", "Тип", "ФИО", "Логин", "Площадка", "Сообщение", "Фото (File ID)", 
+    "Время получения обращения", "Время взятия в работу", 
+    "Передача на 2 линию", "Передача на 3 Линию",
+    "Время на 1 линии", "Время на 2 линии", "Время на 3 линии",
+    "Время закрытия обращения", "Время решения", "SLA (Время на решение)", "Соответствие SLA", "SLA-уведомление отправлено",
+    "Topic ID",
+    "Ticket URL"
+]
+FIELD_HEADERS = dict(zip(TICKET_COLUMNS, HEADERS))
+# Листы архива создаются ботом с заголовками HEADERS, поэтому порядок столбцов в них известен
+_ARCHIVE_COLUMN_MAP = {field: col for col, field in enumerate(TICKET_COLUMNS, 1)}
+
+# Как часто фоновая задача выгружает изменения тикетов в таблицу (в секундах)
+# и сколько изменений из очереди обрабатывается за один проход.
+SHEET_SYNC_INTERVAL = float(os.getenv("SHEET_SYNC_INTERVAL", "5"))
+SHEET_SYNC_BATCH_SIZE = int(os.getenv("SHEET_SYNC_BATCH_SIZE", "200"))
+_sync_lock = asyncio.Lock()
+# id последнего изменения из sheet_outbox, уже переданного в очередь записи
+_last_queued_op_id = 0
+
+# Очередь записи ячеек: как часто отправлять накопленные изменения (мс)
+# и при каком количестве ячеек отправлять их, не дожидаясь таймера.
+SHEET_FLUSH_INTERVAL_MS = int(os.getenv("SHEET_FLUSH_INTERVAL_MS", "1000"))
+SHEET_FLUSH_MAX_CELLS = int(os.getenv("SHEET_FLUSH_MAX_CELLS", "500"))
+
+# Квоты Google Sheets API на чтение и запись (запросов в минуту) и допустимый всплеск.
+# Запросы сверх квоты не падают с 429, а ждут своей очереди с учетом приоритета.
+SHEETS_READ_PER_MINUTE = int(os.getenv("SHEETS_READ_PER_MINUTE", "60"))
+SHEETS_WRITE_PER_MINUTE = int(os.getenv("SHEETS_WRITE_PER_MINUTE", "60"))
+SHEETS_BURST = int(os.getenv("SHEETS_BURST", "10"))
+_read_bucket = TokenBucket.per_minute("sheets_read", SHEETS_READ_PER_MINUTE, SHEETS_BURST)
+_write_bucket = TokenBucket.per_minute("sheets_write", SHEETS_WRITE_PER_MINUTE, SHEETS_BURST)
+
+# Повторы при временных ошибках (429, 5xx, сетевые сбои) и автомат защиты:
+# после SHEETS_BREAKER_THRESHOLD неудачных вызовов подряд обращения к таблице
+# приостанавливаются на SHEETS_BREAKER_COOLDOWN секунд. Изменения тикетов
+# при этом копятся в sheet_outbox и выгружаются после восстановления.
+SHEETS_RETRY_ATTEMPTS = int(os.getenv("SHEETS_RETRY_ATTEMPTS", "4"))
+SHEETS_RETRY_BASE_DELAY = float(os.getenv("SHEETS_RETRY_BASE_DELAY", "1"))
+SHEETS_RETRY_MAX_DELAY = float(os.getenv("SHEETS_RETRY_MAX_DELAY", "30"))
+SHEETS_BREAKER_THRESHOLD = int(os.getenv("SHEETS_BREAKER_THRESHOLD", "5"))
+SHEETS_BREAKER_COOLDOWN = float(os.getenv("SHEETS_BREAKER_COOLDOWN", "60"))
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Подключение через gspread и обновление токена выполняются в отдельном пуле потоков, размер которого
+# совпадает с числом соединений в пуле HTTP-сессии, — потоки не ждут свободного соединения.
+# Токен обновляется заранее, за SHEETS_TOKEN_REFRESH_MARGIN секунд до истечения, а при простое
+# дольше SHEETS_KEEPALIVE_INTERVAL секунд выполняется легкий запрос, чтобы соединение не закрылось.
+SHEETS_POOL_SIZE = int(os.getenv("SHEETS_POOL_SIZE", "4"))
+SHEETS_HTTP_TIMEOUT = float(os.getenv("SHEETS_HTTP_TIMEOUT", "30"))
+SHEETS_TOKEN_REFRESH_MARGIN = float(os.getenv("SHEETS_TOKEN_REFRESH_MARGIN", "300"))
+SHEETS_KEEPALIVE_INTERVAL = float(os.getenv("SHEETS_KEEPALIVE_INTERVAL", "240"))
+_sheets_executor = BoundedExecutor("sheets", SHEETS_POOL_SIZE)
+# Запросы к данным таблицы идут напрямую в Sheets REST API из цикла событий, без потоков;
+# SHEETS_MAX_CONNECTIONS — сколько таких запросов может выполняться одновременно.
+SHEETS_MAX_CONNECTIONS = int(os.getenv("SHEETS_MAX_CONNECTIONS", "20"))
+_sheets_api = None
+_credentials = None
+_auth_request = None
+_last_sheets_call = 0.0
+_sheets_breaker = CircuitBreaker("google_sheets", SHEETS_BREAKER_THRESHOLD, SHEETS_BREAKER_COOLDOWN)
+
+class SheetsAPIError(Exception):
+    """Ошибка Google Sheets REST API; code — HTTP-статус ответа."""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code}: {message}")
+        self.code = code
+
+def _is_retryable_sheets_error(e: Exception) -> bool:
+    """Временная ли ошибка: превышение квоты, ошибка сервера или сбой сети."""
+    if isinstance(e, (gspread.exceptions.APIError, SheetsAPIError)):
+        return getattr(e, 'code', None) in RETRYABLE_STATUS_CODES
+    return isinstance(e, (
+        httpx.TransportError, requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+        google.auth.exceptions.TransportError, ConnectionError, TimeoutError,
+    ))
+
+async def _sheets_call(func, *args, reads: int = 0, writes: int = 0, priority: int = PRIORITY_NORMAL,
+                       retry: bool = True):
+    """
+    Выполняет функцию работы с таблицей, предварительно получив квоту: reads/writes — сколько
+    запросов чтения и записи она делает. Корутины выполняются в цикле событий,
+    синхронные функции (gspread) — в отдельном потоке.
+    Временные ошибки повторяются с экспоненциальной задержкой (retry=False — для неидемпотентных
+    запросов, которые нельзя повторить вслепую); если автомат разомкнут, сразу бросает CircuitOpenError.
+    """
+    async def attempt():
+        # Каждая попытка расходует квоту заново
+        if reads:
+            await _read_bucket.acquire(priority, reads)
+        if writes:
+            await _write_bucket.acquire(priority, writes)
+        global _last_sheets_call
+        _last_sheets_call = time.monotonic()
+        if inspect.iscoroutinefunction(func):
+            return await func(*args)
+        return await _sheets_executor.run(func, *args)
+
+    return await call_with_retry(
+        attempt,
+        attempts=SHEETS_RETRY_ATTEMPTS if retry else 1,
+        base_delay=SHEETS_RETRY_BASE_DELAY,
+        max_delay=SHEETS_RETRY_MAX_DELAY,
+        is_retryable=_is_retryable_sheets_error,
+        breaker=_sheets_breaker,
+        name=func.__name__,
+    )
+
+def get_rate_limiter_stats() -> dict:
+    """Текущее заполнение корзин квот и очереди ожидания по приоритетам."""
+    return {'read': _read_bucket.stats(), 'write': _write_bucket.stats()}
+
+async def get_sheets_health() -> dict:
+    """Состояние автомата защиты и количество изменений, ожидающих выгрузки в таблицу."""
+    return {**_sheets_breaker.stats(), 'pending_ops': await count_sheet_ops()}
+
+def _pooled_session(session: requests.Session) -> requests.Session:
+    """Настраивает пул keep-alive соединений сессии под размер пула потоков."""
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=SHEETS_POOL_SIZE, pool_block=True)
+    session.mount("https://", adapter)
+    return session
+
+def _build_session(creds) -> AuthorizedSession:
+    """
+    Авторизованная HTTP-сессия с пулом соединений для всех запросов к Google Sheets.
+    Обновление токена идет через отдельную сессию с собственным пулом.
+    """
+    global _credentials, _auth_request
+    _auth_request = Request(session=_pooled_session(requests.Session()))
+    _credentials = creds
+    # Получаем токен сразу, чтобы первый запрос к таблице не ждал его обновления
+    creds.refresh(_auth_request)
+    return _pooled_session(AuthorizedSession(creds, auth_request=_auth_request))
+
+def _token_expires_soon() -> bool:
+    if _credentials is None:
+        return False
+    if not _credentials.valid or _credentials.expiry is None:
+        return True
+    # google-auth хранит expiry как наивное время UTC
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return _credentials.expiry - now < timedelta(seconds=SHEETS_TOKEN_REFRESH_MARGIN)
+
+def _refresh_token_sync():
+    _credentials.refresh(_auth_request)
+    log.info(f"Токен Google API обновлен заранее, действует до {_credentials.expiry} UTC")
+
+class _AsyncSheetsClient:
+    """
+    Асинхронный клиент Google Sheets REST API v4 на httpx: запросы к значениям и структуре
+    таблицы выполняются в цикле событий, соединения переиспользуются (keep-alive).
+    Токен берется из _credentials и обновляется в пуле потоков, когда истекает.
+    """
+    BASE_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+
+    def __init__(self, spreadsheet_id: str, sheet_title: str, sheet_id: int):
+        self.url = f"{self.BASE_URL}/{spreadsheet_id}"
+        self.sheet_title = sheet_title
+        self.sheet_id = sheet_id
+        self._client = httpx.AsyncClient(
+            timeout=SHEETS_HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=SHEETS_MAX_CONNECTIONS, max_keepalive_connections=SHEETS_MAX_CONNECTIONS),
+        )
+        self._token_lock = asyncio.Lock()
+
+    async def aclose(self):
+        """Закрывает соединения с API."""
+        await self._client.aclose()
+
+    def range(self, a1: str = "", title: str | None = None) -> str:
+        """Диапазон в нотации A1 с названием листа (по умолчанию — основного); без a1 — весь лист."""
+        title = (title or self.sheet_title).replace("'", "''")
+        return f"'{title}'!{a1}" if a1 else f"'{title}'"
+
+    async def _token(self) -> str:
+        if _token_expires_soon():
+            async with self._token_lock:
+                if _token_expires_soon():
+                    await _sheets_executor.run(_refresh_token_sync)
+        return _credentials.token
+
+    async def _request(self, method: str, path: str, **kwargs) -> dict:
+        headers = {"Authorization": f"Bearer {await self._token()}"}
+        response = await self._client.request(method, self.url + path, headers=headers, **kwargs)
+        if response.status_code >= 400:
+            try:
+                message = response.json()["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                message = response.text
+            raise SheetsAPIError(response.status_code, message)
+        return response.json() if response.content else {}
+
+    async def metadata(self, fields: str) -> dict:
+        return await self._request("GET", "", params={"fields": fields})
+
+    async def values_get(self, range_name: str) -> list:
+        data = await self._request("GET", f"/values/{quote(range_name, safe='')}")
+        return data.get("values", [])
+
+    async def values_batch_get(self, ranges: list, major_dimension: str = "ROWS") -> list:
+        """Значения нескольких диапазонов одним запросом, в порядке ranges."""
+        params = [("ranges", range_name) for range_name in ranges] + [("majorDimension", major_dimension)]
+        data = await self._request("GET", "/values:batchGet", params=params)
+        return [value_range.get("values", []) for value_range in data.get("valueRanges", [])]
+
+    async def values_append(self, range_name: str, rows: list) -> dict:
+        return await self._request(
+            "POST", f"/values/{quote(range_name, safe='')}:append",
+            params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+            json={"values": rows},
+        )
+
+    async def values_batch_update(self, data: list) -> dict:
+        """Запись нескольких диапазонов одним запросом; data: [{'range': ..., 'values': [[...]]}]."""
+        return await self._request("POST", "/values:batchUpdate", json={"valueInputOption": "RAW", "data": data})
+
+    async def batch_update(self, requests: list) -> dict:
+        """Изменение структуры таблицы (листы, строки) одним запросом spreadsheets.batchUpdate."""
+        return await self._request("POST", ":batchUpdate", json={"requests": requests})
+
+    async def sheet_titles(self) -> dict:
+        """Листы таблицы: {название: sheetId}."""
+        data = await self.metadata("sheets.properties(title,sheetId)")
+        return {sheet["properties"]["title"]: sheet["properties"]["sheetId"] for sheet in data.get("sheets", [])}
+
+async def _ping(api):
+    """Легкий запрос (только id таблицы), чтобы соединение с API не закрылось при простое."""
+    await api.metadata("spreadsheetId")
+
+async def run_sheets_keepalive(check_interval: float = 60):
+    """
+    Фоновая задача: заранее обновляет токен доступа и поддерживает соединение при простое,
+    чтобы первый запрос после паузы не ждал ни обновления токена, ни TLS-рукопожатия.
+    """
+    while True:
+        await asyncio.sleep(check_interval)
+        try:
+            if _token_expires_soon():
+                await _sheets_executor.run(_refresh_token_sync)
+            if (
+                _sheets_api is not None
+                and time.monotonic() - _last_sheets_call > SHEETS_KEEPALIVE_INTERVAL
+                and _sheets_breaker.allows_request()
+            ):
+                await _sheets_call(_ping, _sheets_api, reads=1, priority=PRIORITY_LOW)
+        except Exception as e:
+            log.warning(f"Не удалось поддержать соединение с Google Sheets: {e}")
+
+def _build_column_map(current_headers: list) -> dict:
+    """
+    Сопоставляет поля тикета столбцам по строке заголовков таблицы.
+    Порядок столбцов может быть любым; дублирующиеся заголовки считаются ошибкой схемы.
+    """
+    column_map = {}
+    for field, header in FIELD_HEADERS.items():
+        if current_headers.count(header) > 1:
+            raise ValueError(f"Заголовок '{header}' встречается в таблице несколько раз")
+        column_map[field] = current_headers.index(header) + 1
+    return column_map
+
 def _connect_and_get_worksheet_sync():
     """Синхронная функция для подключения к Google Sheets. Вызывается только при необходимости."""
     log.info("Попытка подключения к Google Sheets")
@@ -44,7 +345,8 @@ def _connect_and_get_worksheet_sync():
             return None
             
         creds = Credentials.from_service_account_file(credentials_path, scopes=scopes)
-        client = gspread.authorize(creds)
+        client = gspread.authorize(None, session=_build_session(creds))
+        client.set_timeout(SHEETS_HTTP_TIMEOUT)
         log.info("Успешная авторизация в Google Sheets API")
         
         sheet_name = os.getenv("GOOGLE_SHEET_NAME")
@@ -57,26 +359,33 @@ def _connect_and_get_worksheet_sync():
         
         log.info("Таблица успешно открыта")
 
-        # Проверяем и обновляем заголовки
-        headers = [
-            "Номер", "Статус обращения", "Приоритет", "ID Пользователя", "Тип", "ФИО", "Логин", "Площадка", "Сообщение", "Фото (File ID)", 
-            "Время получения обращения", "Время взятия в работу", 
-            "Передача на 2 линию", "Передача на 3 Линию",
-            "Время на 1 линии", "Время на 2 линии", "Время на 3 линии",
-            "Время закрытия обращения", "Время решения", "SLA (Время на решение)", "Соответствие SLA", "SLA-уведомление отправлено",
-            "Topic ID",
-            "Ticket URL"  # Новый столбец
-        ]
-        
-        current_headers = worksheet.row_values(1) if worksheet.get_all_values() else []
+        # Проверяем и обновляем заголовки. Читаем только первую строку, а не весь лист
+        current_headers = worksheet.row_values(1)
 
-        if len(current_headers) < len(headers):
-            worksheet.update('A1', [headers])
+        if not current_headers:
+            worksheet.update('A1', [HEADERS])
+            current_headers = list(HEADERS)
             log.info("Заголовки таблицы успешно обновлены")
+        else:
+            # Недостающие столбцы добавляем в конец, чтобы не сдвигать существующие данные
+            missing = [header for header in HEADERS if header not in current_headers]
+            if missing:
+                worksheet.update(gspread.utils.rowcol_to_a1(1, len(current_headers) + 1), [missing])
+                current_headers += missing
+                log.warning(f"В таблицу добавлены недостающие столбцы: {', '.join(missing)}")
+
+        global _column_map
+        try:
+            _column_map = _build_column_map(current_headers)
+        except ValueError as e:
+            log.error(f"Структура таблицы не соответствует ожидаемой: {e}")
+            return None
         
         return worksheet
 
     except Exception as e:
+        if _is_retryable_sheets_error(e):
+            raise
         log.error(f"Ошибка при подключении к Google Sheets: {e}")
         log.exception("Полный стек ошибки:")
         return None
@@ -86,7 +395,7 @@ async def get_worksheet():
     Асинхронно получает объект рабочего листа, используя кэширование.
     Инициализирует соединение при первом вызове.
     """
-    global _worksheet_cache
+    global _worksheet_cache, _sheets_api
     if _worksheet_cache is not None:
         return _worksheet_cache
 
@@ -95,45 +404,231 @@ async def get_worksheet():
         if _worksheet_cache is not None:
             return _worksheet_cache
         
-        worksheet = await asyncio.to_thread(_connect_and_get_worksheet_sync)
+        # Открытие таблицы и чтение заголовков; от подключения зависят все остальные запросы
+        try:
+            worksheet = await _sheets_call(_connect_and_get_worksheet_sync, reads=2, priority=PRIORITY_HIGH)
+        except Exception as e:
+            log.error(f"Google Sheets недоступен, подключение отложено: {e}")
+            return None
         if worksheet:
+            _sheets_api = _AsyncSheetsClient(worksheet.spreadsheet.id, worksheet.title, worksheet.id)
             _worksheet_cache = worksheet
         return worksheet
 
+async def get_sheets_api():
+    """Асинхронный клиент Sheets API для открытой таблицы или None, если подключиться не удалось."""
+    if await get_worksheet() is None:
+        return None
+    return _sheets_api
+
+async def close_sheets():
+    """Закрывает соединения клиента Sheets API; вызывается при остановке бота после выгрузки очереди записи."""
+    global _worksheet_cache, _sheets_api
+    api, _sheets_api, _worksheet_cache = _sheets_api, None, None
+    if api is not None:
+        await api.aclose()
+        log.info("Соединения с Google Sheets API закрыты.")
+
+async def _warm_up_worksheet():
+    worksheet = await get_worksheet()
+    if worksheet:
+        log.info("Подключение к Google Sheets установлено заранее.")
+    else:
+        log.warning("Не удалось заранее подключиться к Google Sheets, подключение будет выполнено при первом обращении.")
+
+def start_worksheet_warmup():
+    """
+    Запускает подключение к таблице в фоне, чтобы первое обращение после перезапуска
+    не ждало авторизацию и открытие таблицы.
+    """
+    global _warmup_task
+    if _warmup_task is None or _warmup_task.done():
+        _warmup_task = asyncio.create_task(_warm_up_worksheet())
+    return _warmup_task
+
+
+class _TicketIndex:
+    """
+    Индекс тикетов в памяти: номер -> краткие данные, Topic ID -> номер,
+    (пользователь, статус) -> номера. Строится один раз при старте и обновляется
+    при каждой записи, поэтому пересылка сообщений не обращается ни к таблице, ни к БД.
+    """
+    FIELDS = ("user_id", "topic_id", "status")
+
+    def __init__(self):
+        # Поиск вызывается и из потоков пула SQLite (db_executor), поэтому изменения под локом
+        self._lock = threading.Lock()
+        self._tickets = {}
+        self._by_topic = {}
+        self._by_user_status = {}
+        self.ready = False
+
+    @staticmethod
+    def _user_status_key(entry):
+        return (entry.get("user_id"), (entry.get("status") or "").lower())
+
+    def build(self, tickets: list[dict]):
+        with self._lock:
+            self._tickets.clear()
+            self._by_topic.clear()
+            self._by_user_status.clear()
+            for ticket in tickets:
+                self._update_locked(ticket["number"], ticket)
+            self.ready = True
+
+    def update(self, number: int, fields: dict, new: bool = False):
+        """Обновляет тикет в индексе; неизвестный номер добавляется, только если это новый тикет (new)."""
+        if number not in self._tickets and not new:
+            return
+        if not any(field in fields for field in self.FIELDS) and number in self._tickets:
+            return
+        with self._lock:
+            self._update_locked(number, fields)
+
+    def _update_locked(self, number: int, fields: dict):
+        entry = self._tickets.get(number)
+        if entry is None:
+            entry = self._tickets[number] = {"number": number, "user_id": None, "topic_id": None, "status": None}
+        else:
+            # Убираем старые ключи, прежде чем проиндексировать новые значения
+            if entry["topic_id"] is not None and self._by_topic.get(entry["topic_id"]) == number:
+                del self._by_topic[entry["topic_id"]]
+            numbers = self._by_user_status.get(self._user_status_key(entry))
+            if numbers:
+                numbers.discard(number)
+
+        for field in self.FIELDS:
+            if field in fields:
+                value = fields[field]
+                if field in ("user_id", "topic_id") and value not in (None, ""):
+                    value = int(value)
+                entry[field] = value if value != "" else None
+
+        if entry["topic_id"] is not None:
+            self._by_topic[entry["topic_id"]] = number
+        self._by_user_status.setdefault(self._user_status_key(entry), set()).add(number)
+
+    def remove(self, numbers):
+        """Убирает тикеты из индекса (например, перенесенные в архив)."""
+        with self._lock:
+            for number in numbers:
+                entry = self._tickets.pop(number, None)
+                if entry is None:
+                    continue
+                if entry["topic_id"] is not None and self._by_topic.get(entry["topic_id"]) == number:
+                    del self._by_topic[entry["topic_id"]]
+                found = self._by_user_status.get(self._user_status_key(entry))
+                if found:
+                    found.discard(number)
+
+    def get(self, number: int) -> dict | None:
+        entry = self._tickets.get(number)
+        return dict(entry) if entry else None
+
+    def get_by_topic(self, topic_id: int) -> dict | None:
+        number = self._by_topic.get(topic_id)
+        return self.get(number) if number is not None else None
+
+    def last_by_user_status(self, user_id: int, status: str) -> dict | None:
+        with self._lock:
+            numbers = self._by_user_status.get((user_id, status.lower()))
+            number = max(numbers) if numbers else None
+        return self.get(number) if number is not None else None
+
+_ticket_index = _TicketIndex()
+
+async def build_ticket_index():
+    """Строит индекс тикетов в памяти по данным локальной БД (без архива). Вызывается один раз при старте."""
+    fields = ("number",) + _TicketIndex.FIELDS
+    tickets = [dict(zip(fields, row)) for row in await get_ticket_columns(fields)]
+    _ticket_index.build(tickets)
+    log.info(f"Индекс тикетов построен: {len(tickets)} записей.")
+
+async def _save_ticket_fields(number: int, fields: dict) -> bool:
+    """Сохраняет изменения тикета в БД и обновляет индекс и очередь SLA."""
+    previous = None
+    if fields.get("status") not in (None, "Завершено") and number not in _sla_schedule:
+        # При завершении тикет снимается с контроля SLA; если его переоткрывают, ставим обратно
+        previous = await get_ticket(number)
+    saved = await update_ticket(number, fields)
+    if saved:
+        _ticket_index.update(number, fields)
+        _tickets_cache.patch(number, fields)
+        if fields.get("status") == "Завершено" or fields.get("sla_notified"):
+            _sla_schedule.discard(number)
+        elif previous and previous.get("status") == "Завершено":
+            if (deadline := _sla_deadline({**previous, **fields})) is not None:
+                _sla_schedule.push(number, deadline)
+    return saved
 
-def _add_feedback_sync(worksheet, user_id, feedback_type, fio, username, platform, message, photo_id):
-    log.info(f"Добавление обращения в Google Sheets для user_id={user_id}, type={feedback_type}")
+def _ticket_details(entry: dict) -> dict:
+    return {
+        'id': entry.get('number'),
+        'user_id': entry.get('user_id'),
+        'topic_id': entry.get('topic_id'),
+        'status': entry.get('status'),
+    }
+
+def _ticket_to_record(ticket: dict) -> dict:
+    """Представляет тикет из БД в виде строки таблицы (ключи — заголовки столбцов)."""
+    return {FIELD_HEADERS[field]: ("" if ticket.get(field) is None else ticket.get(field)) for field in TICKET_COLUMNS}
+
+def _ticket_to_row(ticket: dict, column_map: dict) -> list:
+    """Раскладывает тикет по столбцам таблицы согласно column_map."""
+    row = [""] * max(column_map.values())
+    for field, col in column_map.items():
+        if ticket.get(field) is not None:
+            row[col - 1] = ticket.get(field)
+    return row
+
+def _record_to_ticket(record: dict, sheet_row: int | None = None) -> dict | None:
+    """Преобразует строку таблицы (get_all_records) в тикет для БД. Строки без номера пропускаются."""
     try:
-        current_time = datetime.now().strftime("%H:%M:%S %d.%m.%Y")
-        new_row = ["", "Зарегистрировано", "", str(user_id), feedback_type, fio, username or "", platform, message, photo_id, current_time]
-        new_row.extend([""] * 11)
-        worksheet.append_row(new_row)
-        # Теперь ищем строку по уникальным данным
-        all_values = worksheet.get_all_values()
-        for idx, row in enumerate(all_values[1:], 1):  # пропускаем заголовки
-            if (
-                row[3] == str(user_id)
-                and row[4] == feedback_type
-                and row[5] == fio
-                and row[10] == current_time
-            ):
-                # Проставляем номер обращения в первый столбец
-                worksheet.update_cell(idx + 1, 1, str(idx))
-                return idx
-        log.error("Не удалось найти только что добавленную строку для user_id=%s, feedback_type=%s", user_id, feedback_type)
-        return None
-    except Exception as e:
-        log.error(f"Ошибка при добавлении записи в Google Sheets: {e}")
-        log.exception("Полный стек ошибки:")
+        number = int(record.get("Номер"))
+    except (ValueError, TypeError):
         return None
+    ticket = {"sheet_row": sheet_row}
+    for field, header in FIELD_HEADERS.items():
+        value = record.get(header, "")
+        ticket[field] = str(value) if value != "" else None
+    ticket["number"] = number
+    for field in ("user_id", "topic_id"):
+        try:
+            ticket[field] = int(ticket[field]) if ticket[field] else None
+        except ValueError:
+            pass
+    return ticket
+
+def _parse_time(time_str):
+    return datetime.strptime(time_str, TIME_FORMAT) if time_str and isinstance(time_str, str) else None
 
 async def add_feedback(user_id, feedback_type, fio, username, platform, message, photo_id):
-    """Асинхронно добавляет новую запись в Google Sheet и возвращает ее номер."""
-    worksheet = await get_worksheet()
-    if not worksheet:
-        log.error("Не удалось получить доступ к рабочему листу для добавления отзыва")
+    """Асинхронно создает обращение в локальной БД и возвращает его номер. В таблицу оно попадет фоном."""
+    log.info(f"Добавление обращения для user_id={user_id}, type={feedback_type}")
+    # До импорта из таблицы SQLite выдал бы номера, которые уже заняты тикетами в Google Sheets
+    if not await load_tickets_from_sheet():
+        log.error("Тикеты из Google Sheets еще не импортированы, обращение не создано.")
+        return None
+    try:
+        fields = {
+            "status": "Зарегистрировано",
+            "user_id": user_id,
+            "type": feedback_type,
+            "fio": fio,
+            "username": username or "",
+            "platform": platform,
+            "message": message,
+            "photo_id": photo_id,
+            "created_at": datetime.now().strftime(TIME_FORMAT),
+        }
+        number = await create_ticket(fields)
+        _ticket_index.update(number, fields, new=True)
+        _tickets_cache.patch(number, fields, new=True)
+        return number
+    except Exception as e:
+        log.error(f"Ошибка при создании обращения в БД: {e}")
+        log.exception("Полный стек ошибки:")
         return None
-    return await asyncio.to_thread(_add_feedback_sync, worksheet, user_id, feedback_type, fio, username, platform, message, photo_id)
 
 def format_delta(delta):
     """Форматирует timedelta в строку ЧЧ:ММ:СС."""
@@ -142,312 +637,404 @@ def format_delta(delta):
     minutes, seconds = divmod(remainder, 60)
     return f"{hours:02}:{minutes:02}:{seconds:02}"
 
-def _set_priority_and_sla_sync(worksheet, entry_id, priority):
+async def set_priority_and_sla(entry_id, priority):
+    """Асинхронно записывает приоритет и рассчитывает SLA."""
     log.info(f"Установление приоритета {priority} и SLA для обращения #{entry_id}")
     try:
-        row_number = int(entry_id) + 1
-        
-        COL_PRIORITY = 2
-        COL_CREATION_TIME = 10
-        COL_SLA = 19
-
-        creation_time_str = worksheet.cell(row_number, COL_CREATION_TIME + 1).value
-        if not creation_time_str:
+        ticket = await get_ticket(int(entry_id))
+        if not ticket or not ticket.get("created_at"):
             return
-        
-        creation_time = datetime.strptime(creation_time_str, "%H:%M:%S %d.%m.%Y")
-        
+
+        creation_time = datetime.strptime(ticket["created_at"], TIME_FORMAT)
+
         sla_hours = SLA_HOURS.get(priority)
         if sla_hours is None:
             return
-            
+
         sla_deadline = creation_time + timedelta(hours=sla_hours)
-        sla_deadline_str = sla_deadline.strftime("%H:%M:%S %d.%m.%Y")
+        fields = {"priority": priority, "sla_deadline": sla_deadline.strftime(TIME_FORMAT)}
+        if not await _save_ticket_fields(int(entry_id), fields):
+            return
 
-        worksheet.update_cell(row_number, COL_PRIORITY + 1, priority)
-        worksheet.update_cell(row_number, COL_SLA + 1, sla_deadline_str)
+        # Ставим тикет на контроль SLA или снимаем, если приоритет больше не требует уведомления
+        if (deadline := _sla_deadline({**ticket, **fields})) is not None:
+            _sla_schedule.push(int(entry_id), deadline)
+        else:
+            _sla_schedule.discard(int(entry_id))
 
         log.info(f"Приоритет и SLA успешно установлены для обращения #{entry_id}")
     except Exception as e:
         log.error(f"Ошибка при установке приоритета для #{entry_id}: {e}")
 
-async def set_priority_and_sla(entry_id, priority):
-    """Асинхронно записывает приоритет и рассчитывает SLA."""
-    worksheet = await get_worksheet()
-    if not worksheet:
-        log.error("Не удалось получить доступ к рабочему листу для установки приоритета")
-        return
-    await asyncio.to_thread(_set_priority_and_sla_sync, worksheet, entry_id, priority)
+# Поля, по которым определяется дедлайн SLA (см. _sla_deadline)
+SLA_FIELDS = ("status", "priority", "sla_notified", "sla_deadline")
 
-def _get_open_tickets_for_sla_check_sync(worksheet):
-    log.info("Поиск открытых обращений для проверки sla")
+def _sla_deadline(ticket: dict) -> datetime | None:
+    """Дедлайн SLA, если по тикету нужно уведомление: критичный, не завершен, SLA установлено, уведомление не отправлено."""
+    if (
+        ticket.get("status") == "Завершено"
+        or ticket.get("priority") != "Критичный"
+        or ticket.get("sla_notified")
+    ):
+        return None
     try:
-        all_records = worksheet.get_all_records()
-        log.info(f"Получено {len(all_records)} записей для проверки соответствия sla")
-
-        open_tickets = []
-        for record in all_records:
-            number = record.get("Номер")
-            status = record.get("Статус обращения")
-            sla_time = record.get("SLA (Время на решение)")
-            notification_sent = record.get("SLA-уведомление отправлено")
-            priority = record.get("Приоритет")
-
-            # Только критичные, не завершённые, с SLA, и без отправленного уведомления
-            if status != "Завершено" and sla_time and priority == "Критичный" and not notification_sent:
-                log.info(f"Найдено незавершённых критичных обращений #{number}")
-                open_tickets.append(record)
-        log.info(f"Всего найдено {len(open_tickets)} незавершённых критичных обращений")        
-        return open_tickets
-    except Exception as e:
-        log.error(f"Ошибка при получении заявок для проверки SLA: {e}")
-        return []
+        return _parse_time(ticket.get("sla_deadline"))
+    except ValueError:
+        log.error(f"Некорректный срок SLA у обращения #{ticket.get('number')}: {ticket.get('sla_deadline')}")
+        return None
 
-async def get_open_tickets_for_sla_check():
-    """Асинхронно возвращает все строки, где статус не 'Завершено', SLA установлено, приоритет 'Критичный' и уведомление ещё не отправлено."""
-    worksheet = await get_worksheet()
-    if not worksheet:
-        log.error("Не удалось получить доступ к рабочему листу для проверки SLA")
+class _SlaSchedule:
+    """
+    Дедлайны SLA открытых тикетов в виде min-heap: ближайший всегда на вершине.
+    Снятые с контроля тикеты удаляются лениво — запись в куче считается устаревшей,
+    если не совпадает с актуальным дедлайном в _deadlines. При смене ближайшего
+    дедлайна вызывается listener, чтобы переставить таймер проверки.
+    """
+
+    def __init__(self):
+        self._heap = []        # (дедлайн, номер)
+        self._deadlines = {}   # номер -> актуальный дедлайн
+        self._listener = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, number: int) -> bool:
+        return number in self._deadlines
+
+    def set_listener(self, listener):
+        self._listener = listener
+
+    def _notify(self):
+        if self._listener:
+            self._listener()
+
+    def build(self, tickets):
+        self._deadlines = {}
+        for ticket in tickets:
+            if (deadline := _sla_deadline(ticket)) is not None:
+                self._deadlines[ticket["number"]] = deadline
+        self._heap = [(deadline, number) for number, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
+        self._notify()
+
+    def push(self, number: int, deadline: datetime):
+        head = self.next_deadline()
+        self._deadlines[number] = deadline
+        heapq.heappush(self._heap, (deadline, number))
+        if head is None or deadline < head:
+            self._notify()
+
+    def discard(self, number: int):
+        if self._deadlines.pop(number, None) is None:
+            return
+        # Не даем куче разрастись устаревшими записями
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(deadline, number) for number, deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def _prune(self):
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_deadline(self) -> datetime | None:
+        self._prune()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime) -> list[int]:
+        """Снимает с контроля и возвращает номера тикетов, дедлайн которых наступил."""
+        due = []
+        self._prune()
+        while self._heap and self._heap[0][0] <= now:
+            _, number = heapq.heappop(self._heap)
+            del self._deadlines[number]
+            due.append(number)
+            self._prune()
+        return due
+
+_sla_schedule = _SlaSchedule()
+
+async def build_sla_schedule():
+    """Заполняет очередь дедлайнов SLA открытыми тикетами из локальной БД."""
+    fields = ("number",) + SLA_FIELDS
+    _sla_schedule.build(dict(zip(fields, row)) for row in await get_ticket_columns(fields))
+    log.info(f"Очередь SLA построена: {len(_sla_schedule)} обращений на контроле.")
+
+def set_sla_listener(listener):
+    """Задает функцию, вызываемую при смене ближайшего дедлайна SLA (для перестановки таймера)."""
+    _sla_schedule.set_listener(listener)
+
+def get_next_sla_deadline() -> datetime | None:
+    """Ближайший дедлайн SLA среди тикетов на контроле."""
+    return _sla_schedule.next_deadline()
+
+async def get_due_sla_tickets() -> list:
+    """
+    Снимает с контроля тикеты с наступившим дедлайном SLA и возвращает их в виде строк таблицы.
+    Состояние перепроверяется по БД на случай изменений, не прошедших через очередь.
+    """
+    due = _sla_schedule.pop_due(datetime.now())
+    if not due:
         return []
-    return await asyncio.to_thread(_get_open_tickets_for_sla_check_sync, worksheet)
+    tickets = [ticket for ticket in await get_tickets(due) if _sla_deadline(ticket) is not None]
+    log.info(f"Наступил срок SLA по {len(tickets)} обращениям")
+    return [_ticket_to_record(ticket) for ticket in tickets]
 
-def _mark_sla_notification_sent_sync(worksheet, entry_id):
+async def mark_sla_notification_sent(entry_id):
+    """Асинхронно отмечает, что уведомление по SLA было отправлено."""
     try:
-        row_number = int(entry_id) + 1
-        col_index = 22 
-        worksheet.update_cell(row_number, col_index, "Да")
+        await _save_ticket_fields(int(entry_id), {"sla_notified": "Да"})
         log.info(f"sla уведомление отмечено как отправленное для обращения #{entry_id}")
     except Exception as e:
-         log.error(f"Ошибка при отметке SLA-уведомления для #{entry_id}: {e}")
+        log.error(f"Ошибка при отметке SLA-уведомления для #{entry_id}: {e}")
 
-async def mark_sla_notification_sent(entry_id):
-    """Асинхронно отмечает, что уведомление по SLA было отправлено."""
-    worksheet = await get_worksheet()
-    if not worksheet:
-        log.error("Не удалось получить доступ к рабочему листу для отметки SLA-уведомления")
-        return
-    await asyncio.to_thread(_mark_sla_notification_sent_sync, worksheet, entry_id)
+def _action_updates(ticket: dict, action, action_time, status=None) -> dict:
+    """Вычисляет поля тикета, которые меняются при действии, и длительности этапов."""
+    updates = {}
+    action_time_str = action_time.strftime(TIME_FORMAT)
 
-def _record_action_sync(worksheet, entry_id, action, action_time, status=None):
-    try:
-        row_number = int(entry_id) + 1
-        try:
-            row_values = worksheet.row_values(row_number)
-        except gspread.exceptions.CellNotFound:
-             log.error(f"Не удалось найти строку для обращения #{entry_id}")
-             return
-
-        COL_STATUS = 1
-        COL_DATE = 10
-        COL_TAKEN_TIME = 11
-        COL_TRANSFER_L2 = 12
-        COL_TRANSFER_L3 = 13
-        COL_DURATION_L1 = 14
-        COL_DURATION_L2 = 15
-        COL_DURATION_L3 = 16
-        COL_CLOSE_TIME = 17
-        COL_RESOLUTION_TIME = 18
-        COL_SLA_TIME = 19
-        COL_SLA_COMPLIANCE = 20
-        EXPECTED_COLS = 22
-
-        if len(row_values) < EXPECTED_COLS:
-            row_values.extend([""] * (EXPECTED_COLS - len(row_values)))
-
-        def parse_time(time_str):
-            return datetime.strptime(time_str, "%H:%M:%S %d.%m.%Y") if time_str and isinstance(time_str, str) else None
-        
-        updates = []
-        action_time_str = action_time.strftime("%H:%M:%S %d.%m.%Y")
+    if status:
+        updates["status"] = status
 
-        if status:
-            updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_STATUS + 1), 'values': [[status]]})
+    if action == 'taken' and not ticket.get("taken_at"):
+        updates["taken_at"] = action_time_str
 
-        if action == 'taken' and not row_values[COL_TAKEN_TIME]:
-            updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_TAKEN_TIME + 1), 'values': [[action_time_str]]})
-        
-        elif action == 'transfer_l2' and not row_values[COL_TRANSFER_L2]:
-            updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_TRANSFER_L2 + 1), 'values': [[action_time_str]]})
-            if not row_values[COL_TAKEN_TIME]:
-                updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_TAKEN_TIME + 1), 'values': [[action_time_str]]})
-            if not row_values[COL_DURATION_L1]:
-                creation_time = parse_time(row_values[COL_DATE])
-                if creation_time:
-                    duration = action_time - creation_time
-                    updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_DURATION_L1 + 1), 'values': [[format_delta(duration)]]})
-
-        elif action == 'transfer_l3' and not row_values[COL_TRANSFER_L3]:
-            updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_TRANSFER_L3 + 1), 'values': [[action_time_str]]})
-            if not row_values[COL_TAKEN_TIME]:
-                updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_TAKEN_TIME + 1), 'values': [[action_time_str]]})
-            if not row_values[COL_DURATION_L1]:
-                creation_time = parse_time(row_values[COL_DATE])
-                if creation_time:
-                    duration = action_time - creation_time
-                    updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_DURATION_L1 + 1), 'values': [[format_delta(duration)]]})
-            if not row_values[COL_DURATION_L2]:
-                transfer_l2_time = parse_time(row_values[COL_TRANSFER_L2])
-                if transfer_l2_time:
-                    duration = action_time - transfer_l2_time
-                    updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_DURATION_L2 + 1), 'values': [[format_delta(duration)]]})
-        
-        elif action == 'closed' and not row_values[COL_CLOSE_TIME]:
-            updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_CLOSE_TIME + 1), 'values': [[action_time_str]]})
-            
-            creation_time = parse_time(row_values[COL_DATE])
-            if creation_time and not row_values[COL_RESOLUTION_TIME]:
-                duration = action_time - creation_time
-                updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_RESOLUTION_TIME + 1), 'values': [[format_delta(duration)]]})
-
-            # Расчет времени на последней линии
-            transfer_l3_time = parse_time(row_values[COL_TRANSFER_L3])
-            transfer_l2_time = parse_time(row_values[COL_TRANSFER_L2])
-            taken_time = parse_time(row_values[COL_TAKEN_TIME])
-
-            if transfer_l3_time and not row_values[COL_DURATION_L3]:
-                duration_l3 = action_time - transfer_l3_time
-                updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_DURATION_L3 + 1), 'values': [[format_delta(duration_l3)]]})
-            elif transfer_l2_time and not row_values[COL_DURATION_L2]:
-                duration_l2 = action_time - transfer_l2_time
-                updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_DURATION_L2 + 1), 'values': [[format_delta(duration_l2)]]})
-            elif taken_time and not row_values[COL_DURATION_L1]:
-                duration_l1 = action_time - taken_time
-                updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_DURATION_L1 + 1), 'values': [[format_delta(duration_l1)]]})
-
-            sla_time = parse_time(row_values[COL_SLA_TIME])
-            if sla_time:
-                compliance = "В срок" if action_time <= sla_time else "Просрочено"
-                updates.append({'range': gspread.utils.rowcol_to_a1(row_number, COL_SLA_COMPLIANCE + 1), 'values': [[compliance]]})
+    elif action == 'transfer_l2' and not ticket.get("transfer_l2_at"):
+        updates["transfer_l2_at"] = action_time_str
+        if not ticket.get("taken_at"):
+            updates["taken_at"] = action_time_str
+        if not ticket.get("duration_l1"):
+            creation_time = _parse_time(ticket.get("created_at"))
+            if creation_time:
+                updates["duration_l1"] = format_delta(action_time - creation_time)
 
-        if updates:
-            worksheet.batch_update(updates)
-            log.info(f"Действие '{action}' успешно записано в Google Sheets для обращения #{entry_id}")
-            
-    except Exception as e:
-        log.error(f"Ошибка при записи действия для #{entry_id}: {e}")
-        log.exception("Полный стек ошибки:")
+    elif action == 'transfer_l3' and not ticket.get("transfer_l3_at"):
+        updates["transfer_l3_at"] = action_time_str
+        if not ticket.get("taken_at"):
+            updates["taken_at"] = action_time_str
+        if not ticket.get("duration_l1"):
+            creation_time = _parse_time(ticket.get("created_at"))
+            if creation_time:
+                updates["duration_l1"] = format_delta(action_time - creation_time)
+        if not ticket.get("duration_l2"):
+            transfer_l2_time = _parse_time(ticket.get("transfer_l2_at"))
+            if transfer_l2_time:
+                updates["duration_l2"] = format_delta(action_time - transfer_l2_time)
+
+    elif action == 'closed' and not ticket.get("closed_at"):
+        updates["closed_at"] = action_time_str
+
+        creation_time = _parse_time(ticket.get("created_at"))
+        if creation_time and not ticket.get("resolution_time"):
+            updates["resolution_time"] = format_delta(action_time - creation_time)
+
+        # Расчет времени на последней линии
+        transfer_l3_time = _parse_time(ticket.get("transfer_l3_at"))
+        transfer_l2_time = _parse_time(ticket.get("transfer_l2_at"))
+        taken_time = _parse_time(ticket.get("taken_at"))
+
+        if transfer_l3_time and not ticket.get("duration_l3"):
+            updates["duration_l3"] = format_delta(action_time - transfer_l3_time)
+        elif transfer_l2_time and not ticket.get("duration_l2"):
+            updates["duration_l2"] = format_delta(action_time - transfer_l2_time)
+        elif taken_time and not ticket.get("duration_l1"):
+            updates["duration_l1"] = format_delta(action_time - taken_time)
+
+        sla_time = _parse_time(ticket.get("sla_deadline"))
+        if sla_time:
+            updates["sla_compliance"] = "В срок" if action_time <= sla_time else "Просрочено"
+
+    return updates
 
 async def record_action(entry_id, action, action_time, status=None):
     """Асинхронно записывает действие, его время и вычисляет длительность этапов."""
-    worksheet = await get_worksheet()
-    if not worksheet:
-        log.error("Не удалось получить доступ к рабочему листу для записи действия")
-        return
-    await asyncio.to_thread(_record_action_sync, worksheet, entry_id, action, action_time, status)
+    try:
+        ticket = await get_ticket(int(entry_id))
+        if not ticket:
+            log.error(f"Не удалось найти обращение #{entry_id}")
+            return
 
+        updates = _action_updates(ticket, action, action_time, status)
+        if updates:
+            await _save_ticket_fields(int(entry_id), updates)
+            log.info(f"Действие '{action}' успешно записано для обращения #{entry_id}")
 
-def _update_cell_sync(worksheet, entry_id, column_name, value):
-    """Синхронно обновляет одну ячейку в строке по ID обращения."""
+    except Exception as e:
+        log.error(f"Ошибка при записи действия для #{entry_id}: {e}")
+        log.exception("Полный стек ошибки:")
+
+async def _update_ticket_field(entry_id, field, value) -> bool:
+    """Обновляет одно поле тикета в БД."""
     try:
-        log.info(f"Обновление ячейки для обращения #{entry_id}. Колонка: {column_name}, Значение: {value}")
-        headers = worksheet.row_values(1)
-        if column_name not in headers:
-            log.error(f"Столбец '{column_name}' не найден в таблице.")
+        log.info(f"Обновление поля для обращения #{entry_id}. Поле: {field}, Значение: {value}")
+        if not await _save_ticket_fields(int(entry_id), {field: value}):
+            log.error(f"Обращение #{entry_id} не найдено.")
             return False
-        
-        col_index = headers.index(column_name) + 1
-        row_number = int(entry_id) + 1 # +1 потому что нумерация с 1, и +1 из-за заголовков
-
-        worksheet.update_cell(row_number, col_index, str(value))
-        log.info(f"Ячейка для обращения #{entry_id} успешно обновлена.")
         return True
     except Exception as e:
-        log.error(f"Ошибка при обновлении ячейки для #{entry_id}: {e}")
+        log.error(f"Ошибка при обновлении поля для #{entry_id}: {e}")
         log.exception("Полный стек ошибки:")
         return False
 
 async def update_ticket_status(entry_id: str, status: str):
     """Асинхронно обновляет статус обращения."""
-    worksheet = await get_worksheet()
-    if not worksheet:
-        log.error("Не удалось получить доступ к рабочему листу для обновления статуса.")
+    if not await _update_ticket_field(entry_id, "status", status):
         return
-    await asyncio.to_thread(_update_cell_sync, worksheet, entry_id, "Статус обращения", status)
     # Дополнительно вызываем record_action для фиксации времени закрытия, если статус "Завершено"
     if status == "Завершено":
         await record_action(entry_id, 'closed', datetime.now(), status=status)
-    global _tickets_cache
-    _tickets_cache = None
 
 
 async def update_ticket_topic_id(entry_id: int, topic_id: int):
     """Асинхронно обновляет Topic ID для обращения."""
-    worksheet = await get_worksheet()
-    if not worksheet:
-        log.error("Не удалось получить доступ к рабочему листу для обновления Topic ID.")
-        return
-    await asyncio.to_thread(_update_cell_sync, worksheet, entry_id, "Topic ID", topic_id)
-    global _tickets_cache
-    _tickets_cache = None
+    await _update_ticket_field(entry_id, "topic_id", int(topic_id))
 
 
-def _get_all_tickets_sync(worksheet):
-    """Синхронно получает все записи из таблицы."""
-    try:
-        log.info("Запрос всех записей из Google Sheets.")
-        records = worksheet.get_all_records()
-        log.info(f"Найдено {len(records)} записей.")
-        return records
-    except Exception as e:
-        log.error(f"Ошибка при получении всех записей из Google Sheets: {e}")
+def _values_to_records(values: list) -> list:
+    """Строки листа в записи {заголовок: значение}, как get_all_records; короткие строки дополняются пустыми значениями."""
+    if not values:
         return []
+    headers = values[0]
+    return [dict(zip(headers, row + [""] * (len(headers) - len(row)))) for row in values[1:]]
+
+async def _get_all_tickets(api):
+    """
+    Получает все записи основного листа. Ошибки не подменяются пустым списком:
+    иначе неудачный импорт считался бы выполненным, а номера новых тикетов совпали бы с уже выданными.
+    """
+    log.info("Запрос всех записей из Google Sheets.")
+    records = _values_to_records(await api.values_get(api.range()))
+    log.info(f"Найдено {len(records)} записей.")
+    return records
+
+class _TicketsCache:
+    """
+    Кэш всех тикетов в виде строк таблицы для get_all_tickets.
+    В пределах TTL отдается без обращения к БД; после истечения TTL устаревшие данные
+    отдаются сразу, а обновление запускается одной фоновой задачей. Запись тикетов
+    правит кэш на месте, поэтому изменения видны сразу, не дожидаясь обновления.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._records = None  # номер -> строка таблицы
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+        # Изменения, сделанные во время загрузки: загрузка могла прочитать БД до них
+        self._patches_during_load = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    async def _load(self):
+        self._patches_during_load = []
+        try:
+            records = {ticket['number']: _ticket_to_record(ticket) for ticket in await get_tickets(active_only=True)}
+            patches = self._patches_during_load
+        finally:
+            self._patches_during_load = None
+        self._records = records
+        self._loaded_at = time.monotonic()
+        for number, fields, new in patches:
+            self.patch(number, fields, new)
+
+    async def _refresh(self):
+        async with self._lock:
+            try:
+                await self._load()
+            except Exception as e:
+                log.error(f"Ошибка при обновлении кэша тикетов: {e}")
+
+    async def get(self) -> list:
+        """Тикеты из кэша; если загрузить их не удалось, возвращает пустой список (как чтение до кэша)."""
+        if self._records is None:
+            async with self._lock:
+                if self._records is None:
+                    self.misses += 1
+                    try:
+                        await self._load()
+                    except Exception as e:
+                        log.error(f"Ошибка при загрузке кэша тикетов: {e}")
+                        return []
+        elif time.monotonic() - self._loaded_at > self.ttl:
+            self.stale_hits += 1
+            if self._refresh_task is None or self._refresh_task.done():
+                self._refresh_task = asyncio.create_task(self._refresh())
+        else:
+            self.hits += 1
+        return list(self._records.values())
+
+    def patch(self, number: int, fields: dict, new: bool = False):
+        """Применяет изменения тикета к кэшу; new — только что созданный тикет."""
+        if self._patches_during_load is not None:
+            self._patches_during_load.append((number, fields, new))
+        if self._records is None:
+            return
+        record = self._records.get(number)
+        if record is None:
+            # Изменения тикетов из архива в кэш активных не попадают
+            if new:
+                self._records[number] = _ticket_to_record({**fields, 'number': number})
+            return
+        for field, value in fields.items():
+            if field in FIELD_HEADERS:
+                record[FIELD_HEADERS[field]] = "" if value is None else value
+
+    def remove(self, numbers):
+        if self._records is not None:
+            for number in numbers:
+                self._records.pop(number, None)
+
+    def invalidate(self):
+        self._records = None
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._records) if self._records is not None else 0,
+            'age': round(time.monotonic() - self._loaded_at, 1) if self._records is not None else None,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+        }
+
+_tickets_cache = _TicketsCache(TICKETS_CACHE_TTL)
 
 async def get_all_tickets():
-    """Асинхронно получает все записи из таблицы."""
-    worksheet = await get_worksheet()
-    if not worksheet:
-        log.error("Не удалось получить доступ к рабочему листу для получения всех записей.")
-        return []
-    async with _cache_lock:
-        if _tickets_cache is None:
-            _tickets_cache = await asyncio.to_thread(_get_all_tickets_sync, worksheet)
-        return _tickets_cache
+    """Асинхронно получает все тикеты из локальной БД в виде строк таблицы (через кэш)."""
+    return await _tickets_cache.get()
+
+def get_tickets_cache_stats() -> dict:
+    """Размер и возраст кэша get_all_tickets, число попаданий, устаревших ответов и промахов."""
+    return _tickets_cache.stats()
 
 def get_ticket_details_by_id(ticket_id: int) -> dict | None:
     """Получает детали тикета по его ID."""
-    worksheet = _worksheet_cache
-    if not worksheet:
-        # В идеале, здесь нужно асинхронно получить worksheet,
-        # но для простоты предположим, что он уже кэширован.
-        # В синхронном контексте это единственный вариант.
-        log.error("Worksheet не кэширован для get_ticket_details_by_id")
-        return None
     try:
-        all_records = _get_all_tickets_sync(worksheet)
-        for record in all_records:
-            if str(record.get('Номер', '')) == str(ticket_id):
-                return {
-                    'user_id': record.get('ID Пользователя'),
-                    'topic_id': record.get('Topic ID'), # Убедитесь, что колонка 'topic_id' существует
-                }
-        log.warning(f"Тикет с ID {ticket_id} не найден в Google Sheets.")
+        entry = _ticket_index.get(int(ticket_id)) if _ticket_index.ready else None
+        if entry is None:
+            # В индексе только активные тикеты; перенесенные в архив ищем в БД
+            entry = _get_ticket_sync(int(ticket_id))
+        if entry:
+            return {
+                'user_id': entry.get('user_id'),
+                'topic_id': entry.get('topic_id'),
+            }
+        log.warning(f"Тикет с ID {ticket_id} не найден.")
         return None
     except Exception as e:
-        log.error(f"Ошибка при получении деталей тикета {ticket_id} из Google Sheets: {e}")
+        log.error(f"Ошибка при получении деталей тикета {ticket_id}: {e}")
         return None
 
 def get_ticket_details_by_topic_id(topic_id: int) -> dict | None:
     """Получает детали тикета по ID топика."""
-    worksheet = _worksheet_cache
-    if not worksheet:
-        log.error("Worksheet не кэширован для get_ticket_details_by_topic_id")
-        return None
     try:
-        all_records = _get_all_tickets_sync(worksheet)
-        for record in all_records:
-            try:
-                record_topic_id = int(record.get('Topic ID', ''))
-            except (ValueError, TypeError):
-                continue
-
-            if record_topic_id == topic_id:
-                return {
-                    'id': record.get('Номер'),
-                    'user_id': record.get('ID Пользователя'),
-                    'topic_id': record.get('Topic ID'),
-                    'status': record.get('Статус обращения'),
-                }
-        log.warning(f"Тикет с topic_id {topic_id} не найден в Google Sheets.")
+        entry = _ticket_index.get_by_topic(int(topic_id)) if _ticket_index.ready else None
+        if entry is None:
+            entry = _get_ticket_by_topic_id_sync(int(topic_id))
+        if entry:
+            return _ticket_details(entry)
+        log.warning(f"Тикет с topic_id {topic_id} не найден.")
         return None
     except Exception as e:
         log.error(f"Ошибка при получении деталей тикета по topic_id {topic_id}: {e}")
@@ -455,21 +1042,16 @@ def get_ticket_details_by_topic_id(topic_id: int) -> dict | None:
 
 def get_last_open_ticket_by_user_id(user_id: int) -> dict | None:
     """Получает последнее открытое обращение пользователя."""
-    worksheet = _worksheet_cache
-    if not worksheet:
-        log.error("Worksheet не кэширован для get_last_open_ticket_by_user_id")
-        return None
     try:
-        all_records = _get_all_tickets_sync(worksheet)
-        user_tickets = [
-            r for r in all_records 
-            if str(r.get('ID Пользователя')) == str(user_id) and r.get('Статус обращения', '').lower() == 'в работе'
-        ]
-        if not user_tickets:
-            return None
-        
-        user_tickets.sort(key=lambda x: int(x.get('Номер', 0)), reverse=True)
-        return user_tickets[0]
+        if _ticket_index.ready:
+            entry = _ticket_index.last_by_user_status(int(user_id), 'в работе')
+            return _ticket_details(entry) if entry else None
+
+        # Тикеты отсортированы по номеру по убыванию, первый подходящий — последний
+        for ticket in _get_user_tickets_sync(int(user_id)):
+            if (ticket.get('status') or '').lower() == 'в работе':
+                return _ticket_details(ticket)
+        return None
 
     except Exception as e:
         log.error(f"Ошибка при поиске последнего открытого тикета для user_id {user_id}: {e}")
@@ -477,10 +1059,464 @@ def get_last_open_ticket_by_user_id(user_id: int) -> dict | None:
 
 async def update_ticket_url(entry_id: int, url: str):
     """Асинхронно обновляет Ticket URL для обращения."""
-    worksheet = await get_worksheet()
-    if not worksheet:
-        log.error("Не удалось получить доступ к рабочему листу для обновления Ticket URL.")
-        return
-    await asyncio.to_thread(_update_cell_sync, worksheet, entry_id, "Ticket URL", url)
-    global _tickets_cache
-    _tickets_cache = None
+    await _update_ticket_field(entry_id, "ticket_url", url)
+
+# Отметка в settings: тикеты из Google Sheets импортированы в локальную БД
+TICKETS_IMPORTED_SETTING = "tickets_imported"
+_tickets_imported = False
+
+async def load_tickets_from_sheet() -> bool:
+    """
+    Импортирует тикеты из Google Sheets в локальную БД. Пока импорт не прошел успешно (отметка
+    в settings), он повторяется при каждом запуске и перед созданием тикета; уже существующие
+    номера пропускаются, поэтому повтор безопасен. Возвращает, импортированы ли тикеты.
+    """
+    global _tickets_imported
+    if _tickets_imported:
+        return True
+    if await get_setting(TICKETS_IMPORTED_SETTING) == "1":
+        _tickets_imported = True
+        return True
+    api = await get_sheets_api()
+    if not api:
+        log.error("Не удалось получить доступ к рабочему листу для загрузки тикетов в БД.")
+        return False
+    try:
+        records = await _sheets_call(_get_all_tickets, api, reads=1, priority=PRIORITY_LOW)
+    except Exception as e:
+        log.error(f"Не удалось загрузить тикеты из Google Sheets, повторим позже: {e}")
+        return False
+    # Данные начинаются со второй строки (первая — заголовки)
+    tickets = [ticket for idx, record in enumerate(records, 2) if (ticket := _record_to_ticket(record, idx))]
+    imported = await import_tickets(tickets)
+
+    # Тикеты с листов архива импортируем с пометкой, чтобы поиск по номеру находил и их
+    try:
+        archives = await _sheets_call(_get_archive_records, api, reads=2, priority=PRIORITY_LOW)
+    except Exception as e:
+        log.error(f"Не удалось загрузить тикеты из архива Google Sheets, повторим позже: {e}")
+        _tickets_cache.invalidate()
+        return False
+    for title, archive_records in archives:
+        archived = []
+        for idx, record in enumerate(archive_records, 2):
+            if ticket := _record_to_ticket(record, idx):
+                ticket["archive_sheet"] = title
+                archived.append(ticket)
+        imported += await import_tickets(archived)
+
+    await set_setting(TICKETS_IMPORTED_SETTING, "1")
+    _tickets_imported = True
+    _tickets_cache.invalidate()
+    log.info(f"Из Google Sheets в локальную БД импортировано {imported} тикетов.")
+    return True
+
+def _first_updated_row(response: dict) -> int | None:
+    """Извлекает номер первой записанной строки из ответа values.append (updates.updatedRange, например 'Лист1'!A42:X43)."""
+    updated_range = (response or {}).get('updates', {}).get('updatedRange', '')
+    match = re.search(r"![A-Z]+(\d+)", updated_range)
+    return int(match.group(1)) if match else None
+
+async def _append_ticket_rows(api, rows) -> int | None:
+    """
+    Добавляет строки новых тикетов в конец таблицы одним запросом values.append.
+    Номер тикета уже записан в строке, поэтому перечитывать таблицу не нужно.
+    Возвращает номер первой добавленной строки или None при ошибке.
+    """
+    try:
+        response = await api.values_append(api.range('A1'), rows)
+        log.info(f"В Google Sheets добавлено {len(rows)} новых обращений.")
+        first_row = _first_updated_row(response)
+        if first_row is None:
+            # Строки добавлены; их номера найдем по столбцу номеров перед первым обновлением ячеек
+            log.warning(f"Не удалось определить номер строки из ответа Google Sheets: {response}")
+            return 0
+        return first_row
+    except Exception as e:
+        if _is_retryable_sheets_error(e):
+            raise
+        log.error(f"Ошибка при добавлении обращений в Google Sheets: {e}")
+        log.exception("Полный стек ошибки:")
+        return None
+
+async def _update_ticket_cells(api, cells: dict) -> bool:
+    """Записывает измененные ячейки одним values.batchUpdate. cells: {(строка, столбец): значение}."""
+    try:
+        data = [
+            {'range': api.range(gspread.utils.rowcol_to_a1(row, col)), 'values': [[value]]}
+            for (row, col), value in cells.items()
+        ]
+        await api.values_batch_update(data)
+        log.info(f"В Google Sheets обновлено {len(cells)} ячеек.")
+        return True
+    except Exception as e:
+        if _is_retryable_sheets_error(e):
+            raise
+        log.error(f"Ошибка при обновлении ячеек в Google Sheets: {e}")
+        log.exception("Полный стек ошибки:")
+        return False
+
+class _SheetWriteQueue:
+    """
+    Очередь записи ячеек в Google Sheets. Собирает изменения всех тикетов и отправляет
+    их одним batch_update раз в interval_ms или сразу при накоплении max_cells ячеек.
+    Повторная запись в ту же ячейку заменяет еще не отправленное значение.
+    """
+
+    def __init__(self, interval_ms: int, max_cells: int):
+        self.interval = interval_ms / 1000
+        self.max_cells = max_cells
+        self._pending = {}     # (строка, столбец) -> значение
+        self._op_ids = set()   # изменения из sheet_outbox, которые закроет следующая отправка
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.cells_written = 0
+        self.merged_writes = 0
+        self.last_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def put(self, row: int, col: int, value, op_id: int | None = None):
+        key = (row, col)
+        if key in self._pending:
+            self.merged_writes += 1
+        self._pending[key] = value
+        if op_id is not None:
+            self._op_ids.add(op_id)
+        if len(self._pending) >= self.max_cells:
+            self._wakeup.set()
+
+    def add_op_ids(self, op_ids):
+        """Добавляет изменения, которые не требуют записи ячеек, но должны быть закрыты после отправки."""
+        self._op_ids.update(op_ids)
+
+    async def flush(self) -> bool:
+        async with self._flush_lock:
+            if not self._pending and not self._op_ids:
+                return True
+            if self._pending and not _sheets_breaker.allows_request():
+                # Таблица недоступна: изменения остаются в очереди и в sheet_outbox
+                return False
+            cells, op_ids = self._pending, self._op_ids
+            self._pending, self._op_ids = {}, set()
+
+            started = time.monotonic()
+            ok = True
+            if cells:
+                api = await get_sheets_api()
+                try:
+                    ok = bool(api) and await _sheets_call(
+                        _update_ticket_cells, api, cells, writes=1, priority=PRIORITY_NORMAL
+                    )
+                except Exception as e:
+                    log.error(f"Не удалось записать {len(cells)} ячеек в Google Sheets, повторим позже: {e}")
+                    ok = False
+            if not ok:
+                # Возвращаем в очередь; значения, записанные за время отправки, новее и имеют приоритет
+                for key, value in cells.items():
+                    self._pending.setdefault(key, value)
+                self._op_ids |= op_ids
+                self.failed_flushes += 1
+                return False
+
+            await delete_sheet_ops(list(op_ids))
+            elapsed_ms = (time.monotonic() - started) * 1000
+            self.flushes += 1
+            self.cells_written += len(cells)
+            self.last_batch_size = len(cells)
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            return True
+
+    async def run(self):
+        """Фоновая отправка очереди: по таймеру или при достижении порога размера."""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error(f"Ошибка при отправке очереди записи в Google Sheets: {e}")
+                log.exception("Полный стек ошибки:")
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self.depth,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'cells_written': self.cells_written,
+            'merged_writes': self.merged_writes,
+            'last_batch_size': self.last_batch_size,
+            'last_flush_ms': round(self.last_flush_ms, 1),
+            'max_flush_ms': round(self.max_flush_ms, 1),
+        }
+
+_write_queue = _SheetWriteQueue(SHEET_FLUSH_INTERVAL_MS, SHEET_FLUSH_MAX_CELLS)
+
+async def run_sheet_writer():
+    """Запускает фоновую отправку очереди записи ячеек в Google Sheets."""
+    await _write_queue.run()
+
+async def flush_sheet_writes() -> bool:
+    """Сразу отправляет накопленные ячейки (при остановке бота). Неотправленное остается в sheet_outbox."""
+    try:
+        return await _write_queue.flush()
+    except Exception as e:
+        log.error(f"Не удалось отправить очередь записи в Google Sheets при остановке: {e}")
+        return False
+
+def get_write_queue_stats() -> dict:
+    """Возвращает метрики очереди записи: глубину, размер и время последних отправок."""
+    return _write_queue.stats()
+
+async def sync_tickets_to_sheet():
+    """
+    Выгружает накопленные изменения тикетов из очереди sheet_outbox в Google Sheets.
+    Новые тикеты добавляются одной пачкой append_rows, изменения ячеек передаются
+    в очередь записи (_write_queue). Изменение удаляется из sheet_outbox только после
+    успешной записи, поэтому при недоступности таблицы ничего не теряется.
+    """
+    global _last_queued_op_id
+    async with _sync_lock:
+        if not _sheets_breaker.allows_request():
+            # Таблица недоступна: изменения копятся в sheet_outbox до восстановления
+            return
+        ops = await get_sheet_ops(SHEET_SYNC_BATCH_SIZE, after_id=_last_queued_op_id)
+        if not ops:
+            return
+        api = await get_sheets_api()
+        if not api:
+            log.error("Не удалось получить доступ к рабочему листу для выгрузки тикетов.")
+            return
+
+        # Значения берем из текущего состояния тикета, поэтому повторные изменения одного поля схлопываются
+        tickets = {ticket['number']: ticket for ticket in await get_tickets(sorted({op['number'] for op in ops}))}
+
+        append_ops = [op for op in ops if op['op'] == 'append']
+        appended = {op['number'] for op in append_ops}
+        if append_ops:
+            numbers = [op['number'] for op in append_ops if op['number'] in tickets]
+            if numbers:
+                # Новые обращения выгружаются раньше обновлений ячеек и фоновых чтений
+                try:
+                    first_row = await _sheets_call(
+                        _append_ticket_rows, api, [_ticket_to_row(tickets[number], _column_map) for number in numbers],
+                        writes=1, priority=PRIORITY_HIGH
+                    )
+                except Exception as e:
+                    log.error(f"Не удалось добавить новые обращения в Google Sheets, повторим позже: {e}")
+                    return
+                if first_row is None:
+                    return
+                if first_row:
+                    # Строки добавляются подряд, запоминаем, где оказался каждый тикет
+                    sheet_rows = {number: first_row + offset for offset, number in enumerate(numbers)}
+                    await set_ticket_sheet_rows(sheet_rows)
+                    for number, row in sheet_rows.items():
+                        tickets[number]['sheet_row'] = row
+            await delete_sheet_ops([op['id'] for op in append_ops])
+
+        update_ops = []
+        for op in ops:
+            if op['op'] != 'update':
+                continue
+            ticket = tickets.get(op['number'])
+            # Только что добавленная строка уже содержит актуальные значения.
+            # Тикеты в архиве не правятся: их строки на основном листе уже удалены
+            if not ticket or op['number'] in appended or ticket.get('archive_sheet'):
+                _write_queue.add_op_ids([op['id']])
+                continue
+            update_ops.append(op)
+
+        # Строка неизвестна у тикетов, добавленных до учета sheet_row или когда ответ append не разобран.
+        # Угадывать ее по номеру нельзя: после архивации строки сдвигаются, поэтому читаем столбец номеров
+        unknown = {op['number'] for op in update_ops if not tickets[op['number']].get('sheet_row')}
+        if unknown:
+            try:
+                rows = await _sheets_call(_get_ticket_rows, api, _column_map, reads=1, priority=PRIORITY_NORMAL)
+            except Exception as e:
+                log.error(f"Не удалось найти строки тикетов в Google Sheets, повторим позже: {e}")
+                return
+            found = {number: rows[number] for number in unknown if number in rows}
+            if found:
+                await set_ticket_sheet_rows(found)
+                for number, row in found.items():
+                    tickets[number]['sheet_row'] = row
+            if len(found) < len(unknown):
+                log.warning(f"Тикеты {sorted(unknown - found.keys())} не найдены в Google Sheets, их изменения отложены.")
+
+        for op in update_ops:
+            ticket = tickets[op['number']]
+            row_number = ticket.get('sheet_row')
+            if not row_number:
+                # Изменение остается в sheet_outbox и будет выгружено после перезапуска
+                continue
+            for field in op['fields']:
+                value = ticket.get(field)
+                _write_queue.put(row_number, _column_map[field], "" if value is None else value, op['id'])
+        _last_queued_op_id = ops[-1]['id']
+
+
+def _archive_sheet_title(ticket: dict) -> str:
+    return f"{ARCHIVE_SHEET_PREFIX}{_parse_time(ticket['closed_at']):%Y-%m}"
+
+async def _read_columns(api, column_map: dict, fields: tuple, title: str | None = None) -> list[tuple]:
+    """
+    Читает с листа title (по умолчанию — основного) только столбцы fields одним values.batchGet
+    и возвращает кортежи значений по строкам данных (начиная со второй строки листа).
+    """
+    letters = [re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, column_map[field])) for field in fields]
+    value_ranges = await api.values_batch_get([api.range(f"{letter}2:{letter}", title) for letter in letters], major_dimension="COLUMNS")
+    # Пустой столбец приходит без значений; хвостовые пустые ячейки API не возвращает
+    columns = [value_range[0] if value_range else [] for value_range in value_ranges]
+    return list(itertools.zip_longest(*columns, fillvalue=""))
+
+async def _get_ticket_rows(api, column_map: dict, title: str | None = None) -> dict:
+    """Читает столбец номеров листа title (по умолчанию — основного) и возвращает {номер тикета: строка на листе}."""
+    rows = {}
+    for row, (value,) in enumerate(await _read_columns(api, column_map, ("number",), title), 2):
+        try:
+            rows[int(value)] = row
+        except (ValueError, TypeError):
+            continue
+    return rows
+
+async def _get_archive_records(api) -> list:
+    """Читает все листы архива одним values.batchGet: [(название листа, записи)]."""
+    titles = [title for title in await api.sheet_titles() if title.startswith(ARCHIVE_SHEET_PREFIX)]
+    if not titles:
+        return []
+    value_ranges = await api.values_batch_get([api.range(title=title) for title in titles])
+    return [(title, _values_to_records(values)) for title, values in zip(titles, value_ranges)]
+
+async def _create_archive_sheet(api, title: str):
+    """Создает лист архива с заголовками; при повторе после сбоя уже созданный лист не создается заново."""
+    if title not in await api.sheet_titles():
+        await api.batch_update([{"addSheet": {"properties": {
+            "title": title, "gridProperties": {"rowCount": 1, "columnCount": len(HEADERS)},
+        }}}])
+    await api.values_batch_update([{"range": api.range("A1", title), "values": [HEADERS]}])
+    log.info(f"Создан лист архива '{title}'")
+
+async def _append_archive_rows(api, title: str, tickets: list) -> dict:
+    """
+    Добавляет тикеты на существующий лист архива. Тикеты, которые уже есть на листе (append выполнился,
+    но ответ не дошел), повторно не добавляются, поэтому вызов можно повторять.
+    Возвращает {номер тикета: строка на листе архива или None, если ее не удалось определить}.
+    """
+    rows = await _get_ticket_rows(api, _ARCHIVE_COLUMN_MAP, title)
+    new = [ticket for ticket in tickets if ticket["number"] not in rows]
+    if new:
+        response = await api.values_append(api.range("A1", title), [_ticket_to_row(ticket, _ARCHIVE_COLUMN_MAP) for ticket in new])
+        first_row = _first_updated_row(response)
+        rows.update({ticket["number"]: first_row + offset if first_row else None for offset, ticket in enumerate(new)})
+        log.info(f"На лист '{title}' перенесено {len(new)} обращений.")
+    return {ticket["number"]: rows[ticket["number"]] for ticket in tickets}
+
+async def _delete_rows(api, rows: list[int]):
+    """Удаляет строки основного листа одним batchUpdate; подряд идущие строки — одним диапазоном."""
+    ranges = []
+    for row in sorted(rows):
+        if ranges and ranges[-1][1] == row - 1:
+            ranges[-1][1] = row
+        else:
+            ranges.append([row, row])
+    # Удаляем снизу вверх, чтобы удаление не сдвигало еще не удаленные диапазоны
+    requests = [
+        {"deleteDimension": {"range": {"sheetId": api.sheet_id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end}}}
+        for start, end in reversed(ranges)
+    ]
+    await api.batch_update(requests)
+    log.info(f"С основного листа удалено {len(rows)} строк.")
+
+async def archive_closed_tickets() -> int:
+    """
+    Переносит завершенные больше ARCHIVE_AFTER_DAYS дней назад тикеты с основного листа
+    на листы архива по месяцу закрытия. Номера тикетов не меняются: в БД тикет остается
+    с пометкой листа архива, поэтому поиск по номеру по-прежнему его находит.
+    Возвращает количество перенесенных тикетов.
+    """
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    candidates = []
+    for ticket in await get_closed_active_tickets():
+        try:
+            closed_at = _parse_time(ticket.get("closed_at"))
+        except ValueError:
+            continue
+        if closed_at and closed_at <= cutoff:
+            candidates.append(ticket)
+    candidates = candidates[:ARCHIVE_BATCH_SIZE]
+
+    # Удаление строк сдвигает номера строк, поэтому выгрузка изменений на это время останавливается,
+    # а уже поставленные в очередь ячейки (привязанные к старым номерам строк) сначала отправляются
+    async with _sync_lock:
+        if not _sheets_breaker.allows_request():
+            return 0
+        if not await _write_queue.flush():
+            log.info("Архивирование отложено: не удалось выгрузить очередь записи.")
+            return 0
+        api = await get_sheets_api()
+        if not api:
+            return 0
+
+        archived = {}
+        try:
+            sheet_rows = await _sheets_call(
+                _get_ticket_rows, api, _column_map, reads=1, priority=PRIORITY_LOW
+            )
+            by_title = {}
+            for ticket in candidates:
+                # Тикет, еще не выгруженный на основной лист, перенесем в следующий раз
+                if ticket["number"] in sheet_rows:
+                    by_title.setdefault(_archive_sheet_title(ticket), []).append(ticket)
+
+            # Листы читаем один раз: квота списывается по числу запросов, которые действительно будут сделаны
+            existing_titles = await _sheets_call(api.sheet_titles, reads=1, priority=PRIORITY_LOW) if by_title else {}
+            for title, tickets in by_title.items():
+                if title not in existing_titles:
+                    await _sheets_call(_create_archive_sheet, api, title, reads=1, writes=2, priority=PRIORITY_LOW)
+                archive_rows = await _sheets_call(
+                    _append_archive_rows, api, title, tickets, reads=1, writes=1, priority=PRIORITY_LOW
+                )
+                moved = {number: (title, row) for number, row in archive_rows.items()}
+                # Отмечаем сразу: если удаление ниже не пройдет, строки удалятся при следующем запуске
+                await set_tickets_archived(moved)
+                archived.update(moved)
+
+            # Удаляем с основного листа строки всех тикетов из архива, включая оставшиеся после прошлых сбоев
+            archived_numbers = await get_archived_numbers(list(sheet_rows))
+            rows_to_delete = sorted(sheet_rows[number] for number in archived_numbers)
+            if rows_to_delete:
+                # Удаление по индексам строк нельзя повторять: если первый запрос выполнился, а ответ потерян,
+                # повтор удалит сдвинувшиеся на их место строки других тикетов. При ошибке следующий запуск
+                # заново прочитает столбец номеров и удалит только оставшиеся строки архивных тикетов
+                try:
+                    await _sheets_call(_delete_rows, api, rows_to_delete, writes=1, priority=PRIORITY_LOW, retry=False)
+                except Exception:
+                    # Неизвестно, сдвинулись ли строки: тикеты ниже первой удаляемой строки выгрузка найдет заново по номеру
+                    await set_ticket_sheet_rows({number: None for number, row in sheet_rows.items() if row > rows_to_delete[0]})
+                    raise
+                # Строки ниже удаленных сдвинулись вверх
+                await set_ticket_sheet_rows({
+                    number: row - bisect.bisect_left(rows_to_delete, row)
+                    for number, row in sheet_rows.items() if number not in archived_numbers
+                })
+        except Exception as e:
+            log.error(f"Ошибка при архивировании обращений: {e}")
+            log.exception("Полный стек ошибки:")
+        finally:
+            _ticket_index.remove(archived)
+            _tickets_cache.remove(archived)
+
+    if archived:
+        log.info(f"В архив перенесено {len(archived)} обращений.")
+    return len(archived)
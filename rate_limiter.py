@@ -0,0 +1,121 @@
+import asyncio
+import heapq
+import itertools
+import time
+from logger import logger
+
+log = logger.get_logger('rate_limiter')
+
+# Приоритеты очереди ожидания: чем меньше число, тем раньше запрос получит токен
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+PRIORITY_NAMES = {PRIORITY_HIGH: "high", PRIORITY_NORMAL: "normal", PRIORITY_LOW: "low"}
+
+
+class TokenBucket:
+    """
+    Асинхронный token bucket с приоритетной очередью ожидания.
+    Пополняется со скоростью rate токенов в секунду до capacity. Когда токенов нет,
+    запросы не отклоняются, а ждут своей очереди: сначала более приоритетные,
+    внутри одного приоритета — в порядке поступления.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: float):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._waiters = []  # (приоритет, порядковый номер, стоимость, future)
+        self._seq = itertools.count()
+        self._timer = None
+        self.granted = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @classmethod
+    def per_minute(cls, name: str, limit: int, burst: int | None = None):
+        """Корзина под квоту вида «limit запросов в минуту», с запасом на всплеск burst."""
+        return cls(name, limit / 60, burst or limit)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL, cost: float = 1) -> float:
+        """Ждет, пока в корзине появится cost токенов, и возвращает время ожидания в секундах."""
+        cost = min(cost, self.capacity)
+        self._refill()
+        if not self._waiters and self._tokens >= cost:
+            self._tokens -= cost
+            self.granted += 1
+            return 0.0
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), cost, future))
+        self._schedule()
+        started = time.monotonic()
+        await future
+
+        waited = time.monotonic() - started
+        self.granted += 1
+        self.throttled += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        if waited > 1:
+            log.info(f"Запрос к '{self.name}' (приоритет {PRIORITY_NAMES.get(priority, priority)}) ждал квоту {waited:.1f} с")
+        return waited
+
+    def set_rate(self, rate: float):
+        """Меняет скорость пополнения (для адаптивных ограничений); время ожидания в очереди пересчитывается."""
+        self._refill()
+        self.rate = rate
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._waiters:
+            self._schedule()
+
+    def _schedule(self):
+        """Планирует выдачу токена первому в очереди, как только его хватит."""
+        # Отмененные ожидания в голове очереди не должны задерживать остальных
+        while self._waiters and self._waiters[0][3].done():
+            heapq.heappop(self._waiters)
+        if self._timer is not None or not self._waiters:
+            return
+        self._refill()
+        cost = self._waiters[0][2]
+        delay = max(0.0, (cost - self._tokens) / self.rate)
+        self._timer = asyncio.get_running_loop().call_later(delay, self._release)
+
+    def _release(self):
+        self._timer = None
+        self._refill()
+        while self._waiters and self._tokens >= self._waiters[0][2]:
+            _, _, cost, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._tokens -= cost
+            future.set_result(None)
+        self._schedule()
+
+    def stats(self) -> dict:
+        self._refill()
+        waiting = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, _, future in self._waiters:
+            if not future.done():
+                waiting[PRIORITY_NAMES.get(priority, str(priority))] += 1
+        return {
+            'level': round(self._tokens, 2),
+            'capacity': self.capacity,
+            'rate_per_minute': round(self.rate * 60, 2),
+            'waiting': waiting,
+            'granted': self.granted,
+            'throttled': self.throttled,
+            'avg_wait_ms': round(self.total_wait / self.throttled * 1000, 1) if self.throttled else 0.0,
+            'max_wait_ms': round(self.max_wait * 1000, 1),
+        }
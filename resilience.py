@@ -0,0 +1,122 @@
+import asyncio
+import random
+import time
+from logger import logger
+
+log = logger.get_logger('resilience')
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонен без попытки: сервис недоступен и автомат разомкнут."""
+
+
+class CircuitBreaker:
+    """
+    Автомат защиты внешнего сервиса. После failure_threshold неудачных вызовов подряд
+    размыкается на cooldown секунд: вызовы сразу отклоняются, не дожидаясь таймаутов.
+    По истечении паузы пропускает один пробный вызов — успех замыкает автомат, ошибка снова размыкает.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, cooldown: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._probe_in_flight = False
+
+    def allows_request(self) -> bool:
+        """Можно ли сейчас обращаться к сервису (без учета пробного вызова)."""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+            log.info(f"Автомат '{self.name}': пауза истекла, пропускаю пробный вызов.")
+        return self.state == self.CLOSED or (self.state == self.HALF_OPEN and not self._probe_in_flight)
+
+    def before_call(self):
+        """Вызывается перед обращением к сервису; бросает CircuitOpenError, если автомат разомкнут."""
+        if not self.allows_request():
+            self.rejected += 1
+            raise CircuitOpenError(f"Сервис '{self.name}' временно недоступен")
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = True
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            log.info(f"Автомат '{self.name}' замкнут: сервис снова доступен.")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_neutral(self):
+        """Вызов завершился ошибкой, не говорящей о состоянии сервиса (например, 4xx): освобождает пробный вызов, не меняя состояние."""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.times_opened += 1
+                log.warning(
+                    f"Автомат '{self.name}' разомкнут после {self.consecutive_failures} ошибок подряд, "
+                    f"повтор через {self.cooldown:.0f} с."
+                )
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        self.allows_request()
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'times_opened': self.times_opened,
+            'rejected': self.rejected,
+            'retry_in': round(max(0.0, self.cooldown - (time.monotonic() - self.opened_at)), 1) if self.state == self.OPEN else 0.0,
+        }
+
+
+def backoff_delay(attempt: int, base: float, maximum: float) -> float:
+    """Задержка перед повтором attempt (с 1): экспонента с полным случайным разбросом (full jitter)."""
+    return random.uniform(0, min(maximum, base * 2 ** (attempt - 1)))
+
+
+async def call_with_retry(call, *, attempts: int, base_delay: float, max_delay: float,
+                          is_retryable, breaker: CircuitBreaker | None = None, name: str = ""):
+    """
+    Выполняет корутину call() с повторами при временных ошибках (is_retryable(e) -> bool).
+    Каждая попытка проходит через breaker; исчерпанные повторы засчитываются ему как одна ошибка.
+    Невременные ошибки пробрасываются сразу и на автомат не влияют.
+    """
+    for attempt in range(1, attempts + 1):
+        if breaker:
+            breaker.before_call()
+        try:
+            result = await call()
+        except Exception as e:
+            if not is_retryable(e):
+                # Такая ошибка не доказывает, что сервис восстановился: пробный вызов не замыкает автомат
+                if breaker:
+                    breaker.record_neutral()
+                raise
+            if attempt == attempts:
+                if breaker:
+                    breaker.record_failure()
+                raise
+            if breaker:
+                # Пробный вызов в полуоткрытом состоянии не повторяем: сразу размыкаем автомат
+                if breaker.state == CircuitBreaker.HALF_OPEN:
+                    breaker.record_failure()
+                    raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            log.warning(f"{name}: временная ошибка ({e}), попытка {attempt}/{attempts}, повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+        else:
+            if breaker:
+                breaker.record_success()
+            return result
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+import g_sheets  # noqa: E402
+from rate_limiter import TokenBucket  # noqa: E402
+from resilience import CircuitBreaker  # noqa: E402
+from benchmarks.fake_sheets import FakeWorksheet, FakeSheetsAPI  # noqa: E402
+
+
+def make_ticket(number: int, status: str = "Зарегистрировано", **fields) -> dict:
+    """Тикет в формате БД; created_at и closed_at (для завершенных) — 60 дней назад."""
+    created = datetime.now() - timedelta(days=60)
+    ticket = {
+        "number": number,
+        "status": status,
+        "priority": "Средний",
+        "user_id": number,
+        "type": "Ошибка",
+        "fio": f"Пользователь {number}",
+        "username": f"user{number}",
+        "platform": "Площадка",
+        "message": f"Текст обращения {number}",
+        "created_at": created.strftime(g_sheets.TIME_FORMAT),
+        "sla_deadline": (created + timedelta(hours=g_sheets.SLA_HOURS["Средний"])).strftime(g_sheets.TIME_FORMAT),
+        "topic_id": 100000 + number,
+        "sheet_row": number + 1,
+    }
+    if status == "Завершено":
+        ticket["closed_at"] = created.strftime(g_sheets.TIME_FORMAT)
+    ticket.update(fields)
+    return ticket
+
+
+@pytest.fixture
+def sheets(tmp_path, monkeypatch):
+    """
+    Локальная БД во временном каталоге и таблица в памяти вместо Google Sheets.
+    Возвращает корутину prepare(tickets, imported=True) -> FakeWorksheet: тикеты попадают
+    и в БД, и на основной лист; imported=False оставляет БД пустой, как до импорта.
+    """
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    column_map = g_sheets._build_column_map(g_sheets.HEADERS)
+    monkeypatch.setattr(g_sheets, "_column_map", column_map)
+    monkeypatch.setattr(g_sheets, "_sync_lock", asyncio.Lock())
+    monkeypatch.setattr(g_sheets, "_write_queue", g_sheets._SheetWriteQueue(g_sheets.SHEET_FLUSH_INTERVAL_MS, g_sheets.SHEET_FLUSH_MAX_CELLS))
+    monkeypatch.setattr(g_sheets, "_last_queued_op_id", 0)
+    monkeypatch.setattr(g_sheets, "_tickets_cache", g_sheets._TicketsCache(g_sheets.TICKETS_CACHE_TTL))
+    monkeypatch.setattr(g_sheets, "_ticket_index", g_sheets._TicketIndex())
+    monkeypatch.setattr(g_sheets, "_sla_schedule", g_sheets._SlaSchedule())
+    monkeypatch.setattr(g_sheets, "_sheets_breaker", CircuitBreaker("test_sheets", 5, 60))
+    monkeypatch.setattr(g_sheets, "_read_bucket", TokenBucket("test_read", 1e9, 1e9))
+    monkeypatch.setattr(g_sheets, "_write_bucket", TokenBucket("test_write", 1e9, 1e9))
+    monkeypatch.setattr(g_sheets, "SHEETS_RETRY_BASE_DELAY", 0)
+
+    async def prepare(tickets: list, imported: bool = True) -> FakeWorksheet:
+        await database.initialize_db()
+        if imported:
+            await database.import_tickets(tickets)
+        worksheet = FakeWorksheet.create(g_sheets.HEADERS, [g_sheets._ticket_to_row(ticket, column_map) for ticket in tickets])
+        monkeypatch.setattr(g_sheets, "_worksheet_cache", worksheet)
+        monkeypatch.setattr(g_sheets, "_sheets_api", FakeSheetsAPI(worksheet))
+        monkeypatch.setattr(g_sheets, "_tickets_imported", imported)
+        return worksheet
+
+    yield prepare
+    asyncio.run(database.close_db())
+
+
+def sheet_column(worksheet: FakeWorksheet, field: str) -> list:
+    """Значения поля на листе по строкам данных."""
+    col = g_sheets._column_map[field] - 1
+    return [row[col] if len(row) > col else "" for row in worksheet.rows[1:]]
@@ -0,0 +1,107 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+
+import g_sheets
+from benchmarks.fake_sheets import FakeSheetsAPI
+from g_sheets import SheetsAPIError
+from conftest import make_ticket, sheet_column
+
+
+def test_sync_writes_each_ticket_its_own_values(sheets):
+    async def scenario():
+        worksheet = await sheets([make_ticket(number) for number in (1, 2, 3)])
+        await g_sheets.update_ticket_status(1, "В работе")
+        await g_sheets.update_ticket_status(2, "Передано на L2")
+        await g_sheets.update_ticket_status(3, "Передано на L3")
+        await g_sheets.sync_tickets_to_sheet()
+        assert await g_sheets._write_queue.flush()
+        return worksheet
+
+    worksheet = asyncio.run(scenario())
+    assert sheet_column(worksheet, "status") == ["В работе", "Передано на L2", "Передано на L3"]
+
+
+class _LostResponseAPI(FakeSheetsAPI):
+    """Выполняет первый append и первое удаление строк, но вместо ответа бросает сетевую ошибку."""
+
+    def __init__(self, worksheet):
+        super().__init__(worksheet)
+        self.lost = {"append", "deleteDimension"}
+
+    async def _request(self, method, path, params=None, json=None):
+        response = await super()._request(method, path, params, json)
+        if path.endswith(":append"):
+            kind = "append"
+        elif path == ":batchUpdate" and "deleteDimension" in json["requests"][0]:
+            kind = "deleteDimension"
+        else:
+            return response
+        if kind in self.lost:
+            self.lost.discard(kind)
+            raise httpx.ReadTimeout("response lost")
+        return response
+
+
+def test_archive_survives_lost_responses(sheets, monkeypatch):
+    async def scenario():
+        tickets = [make_ticket(number, "Завершено" if number in (2, 3) else "В работе") for number in range(1, 7)]
+        worksheet = await sheets(tickets)
+        api = _LostResponseAPI(worksheet)
+        monkeypatch.setattr(g_sheets, "_sheets_api", api)
+        await g_sheets.archive_closed_tickets()
+        assert not api.lost
+        # Выгрузка после сбоя удаления находит сдвинувшиеся строки по номеру
+        await g_sheets.update_ticket_status(6, "Передано на L2")
+        await g_sheets.sync_tickets_to_sheet()
+        assert await g_sheets._write_queue.flush()
+        await g_sheets.archive_closed_tickets()
+        return worksheet
+
+    worksheet = asyncio.run(scenario())
+    assert [int(number) for number in sheet_column(worksheet, "number")] == [1, 4, 5, 6]
+    assert sheet_column(worksheet, "status")[-1] == "Передано на L2"
+    archive = next(sheet for title, sheet in worksheet.spreadsheet._sheets.items() if title.startswith(g_sheets.ARCHIVE_SHEET_PREFIX))
+    assert [row[0] for row in archive.rows[1:]] == [2, 3]
+
+
+class _ForbiddenAPI(FakeSheetsAPI):
+    """Отвечает 403 на чтение значений, пока forbidden=True."""
+
+    forbidden = True
+
+    async def _request(self, method, path, params=None, json=None):
+        if self.forbidden and path.startswith("/values/"):
+            raise SheetsAPIError(403, "The caller does not have permission")
+        return await super()._request(method, path, params, json)
+
+
+def test_failed_import_blocks_ticket_creation(sheets, monkeypatch):
+    async def scenario():
+        worksheet = await sheets([make_ticket(number) for number in range(1, 51)], imported=False)
+        api = _ForbiddenAPI(worksheet)
+        monkeypatch.setattr(g_sheets, "_sheets_api", api)
+        assert not await g_sheets.load_tickets_from_sheet()
+        assert await g_sheets.get_setting(g_sheets.TICKETS_IMPORTED_SETTING) != "1"
+        assert await g_sheets.add_feedback(1, "Ошибка", "ФИО", "user", "Площадка", "Текст", "") is None
+
+        api.forbidden = False
+        return await g_sheets.add_feedback(1, "Ошибка", "ФИО", "user", "Площадка", "Текст", "")
+
+    assert asyncio.run(scenario()) == 51
+
+
+def test_reopened_ticket_returns_to_sla_schedule(sheets):
+    async def scenario():
+        deadline = (datetime.now() + timedelta(hours=1)).replace(microsecond=0)
+        await sheets([make_ticket(1, priority="Критичный", sla_deadline=deadline.strftime(g_sheets.TIME_FORMAT))])
+        await g_sheets.build_sla_schedule()
+        assert g_sheets.get_next_sla_deadline() == deadline
+        await g_sheets.update_ticket_status(1, "Завершено")
+        assert g_sheets.get_next_sla_deadline() is None
+        await g_sheets.update_ticket_status(1, "В работе")
+        return deadline, g_sheets.get_next_sla_deadline()
+
+    deadline, scheduled = asyncio.run(scenario())
+    assert scheduled == deadline